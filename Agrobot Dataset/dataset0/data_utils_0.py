@@ -1,20 +1,380 @@
+import os
+import json
+import hashlib
+import shutil
 import pandas as pd
 import numpy as np
-from gtda.time_series import SlidingWindow
 import matplotlib.pyplot as plt
 from math import atan2, pi, sqrt, atan2, sin, cos, radians, ceil
-from scipy.fft import fft
+from scipy.fft import fft, rfft
 from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor
 import math
+from functools import lru_cache
+from contextlib import nullcontext
 from pyproj import Transformer
 from scipy.io import savemat
 
 
+'''
+Windows a signal (samples X channels) without copying it.
+
+Same windows as gtda's SlidingWindow(size=window_size, stride=stride).fit_transform applied to every channel and
+stacked with np.dstack: the windows are aligned to the end of the signal, so the first
+(n_samples-window_size)%stride samples are not used. The result is a read-only numpy.lib.stride_tricks view
+(n_windows X window_size X channels) on the contiguous signal array, so it costs no memory until it is copied.
+
+'''
+
+def sliding_windows(signal, window_size, stride):
+    signal = np.ascontiguousarray(signal)
+    if(signal.shape[0] < window_size):
+        raise ValueError('signal has {} samples, fewer than window_size={}'.format(signal.shape[0],window_size))
+    n_windows = (signal.shape[0]-window_size)//stride + 1
+    start = (signal.shape[0]-window_size)%stride
+    return np.lib.stride_tricks.as_strided(signal[start:], shape=(n_windows,window_size)+signal.shape[1:],
+                                           strides=(stride*signal.strides[0],)+signal.strides, writeable=False)
+
+
+#copies the windows of all trajectories into one preallocated array
+def stack_windows(windows_list, window_size, n_channels):
+    stacked = np.empty((sum(w.shape[0] for w in windows_list), window_size, n_channels))
+    start = 0
+    for w in windows_list:
+        stacked[start:start+w.shape[0]] = w
+        start += w.shape[0]
+    return stacked
+
+#per-window values (physics channel, velocities) of all log files in one float64 array, filled once
+def concat_values(values_list):
+    stacked = np.empty(sum(len(v) for v in values_list))
+    start = 0
+    for v in values_list:
+        stacked[start:start+len(v)] = v
+        start += len(v)
+    return stacked
+
+
+'''
+Physics channel of every window: mean of the one-sided amplitude spectrum of the mean-removed acceleration
+magnitude (acc channels 0:3 of the windows).
+
+All windows of a chunk go through one real FFT along the window axis; with the default float64 the result is
+bit-identical to the former per-window scipy.fft.fft loop. physics_dtype=np.float32 halves the memory and time
+of the FFT at about 1e-7 relative error, and chunk_size bounds the temporary arrays to chunk_size windows.
+
+'''
+
+def physics_channel(windows, physics_dtype=np.float64, chunk_size=8192):
+    n_windows, window_size = windows.shape[0:2]
+    half = math.ceil(window_size/2)
+    loc_mat = np.empty((n_windows))
+    for start in range(0, n_windows, chunk_size):
+        acc = windows[start:start+chunk_size,:,0:3].astype(physics_dtype, copy=False)
+        VecSum = np.sqrt(acc[:,:,0]**2 + acc[:,:,1]**2 + acc[:,:,2]**2)
+        VecSum = VecSum - np.mean(VecSum, axis=1, keepdims=True)
+        FFT_VS = rfft(VecSum, axis=1)[:,0:half]
+        P1 = np.abs(FFT_VS/window_size)
+        P1[:,1:-1-2] = 2*P1[:,1:-1-2]
+        loc_mat[start:start+chunk_size] = np.mean(P1, axis=1)
+    return loc_mat
+
+#displacement of the ground truth over every window (velocity labels of the network)
+def displacement_labels(gt_windows):
+    return gt_windows[:,-1,0]-gt_windows[:,0,0], gt_windows[:,-1,1]-gt_windows[:,0,1]
+
+
+'''
+Runs func(*args) for every entry of args_list and yields the results in the order of args_list.
+
+With n_workers=1 the log files are processed one after the other in this process. Otherwise they are fanned out
+to a pool of n_workers processes (None: one per CPU). The arrays of the first value returned by func (the cleaned
+signals of a log file) come back through shared memory instead of being pickled (Python 3.8+); functions that
+return None, like export_log_file, are only run.
+
+'''
+
+def map_log_files(func, args_list, n_workers=1):
+    if(n_workers == 1):
+        for args in tqdm(args_list):
+            yield func(*args)
+        return
+    from multiprocessing import resource_tracker
+    #workers share the tracker of this process, so segments created there and unlinked here are not reported as leaked
+    resource_tracker.ensure_running()
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        for result in tqdm(executor.map(call_to_shared_memory, [(func, args) for args in args_list]), total=len(args_list)):
+            yield None if result is None else result_from_shared_memory(*result)
+
+def call_to_shared_memory(func_args):
+    from multiprocessing import shared_memory
+    func, args = func_args
+    result = func(*args)
+    if result is None:
+        return None
+    arrays = [np.ascontiguousarray(a) for a in result[0]]
+    shm = shared_memory.SharedMemory(create=True, size=max(1, sum(a.nbytes for a in arrays)))
+    layout = []
+    offset = 0
+    for a in arrays:
+        np.ndarray(a.shape, dtype=a.dtype, buffer=shm.buf, offset=offset)[...] = a
+        layout.append((a.shape, a.dtype.str, offset))
+        offset += a.nbytes
+    shm.close()
+    return shm.name, layout, result[1:]
+
+def result_from_shared_memory(name, layout, rest):
+    from multiprocessing import shared_memory
+    shm = shared_memory.SharedMemory(name=name)
+    arrays = tuple(np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset).copy() for shape, dtype, offset in layout)
+    shm.close()
+    shm.unlink()
+    return (arrays,)+tuple(rest)
+
+
+'''
+On-disk cache of imported splits
+
+An entry holds the outputs of one import call as .npy files (windows stacked over the trajectories) plus a
+meta.json with the list outputs. Its key covers the content (sha1) of every file the import reads, the import
+parameters (window_size, stride, physics_dtype) and CACHE_SCHEMA, so an edited log file or a change of the
+processing (bump CACHE_SCHEMA) never hits an old entry. Hits are opened with np.load(mmap_mode=...), so arrays
+are only read from disk when they are used. File hashes are memoized by size and modification time in
+file_hashes.json, and the least recently used entries are removed once the cache is larger than CACHE_MAX_BYTES.
+
+'''
+
+CACHE_SCHEMA = 'agrobot dataset0 import_agrobot_dataset_p1 v1'
+CACHE_MAX_BYTES = 10*2**30
+CACHE_OUTPUTS = ('X','Y_pos','Physics_Vec','x_vel','y_vel','x0_list','y0_list','size_of_each')
+
+def file_sha1(path, memo):
+    st = os.stat(path)
+    path = os.path.abspath(path)
+    if(path not in memo or memo[path][0:2] != [st.st_size, st.st_mtime_ns]):
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1<<20), b''):
+                h.update(chunk)
+        memo[path] = [st.st_size, st.st_mtime_ns, h.hexdigest()]
+    return memo[path][2]
+
+def cache_key(cache_dir, file_paths, params):
+    os.makedirs(cache_dir, exist_ok=True)
+    memo_file = os.path.join(cache_dir, 'file_hashes.json')
+    memo = {}
+    if os.path.exists(memo_file):
+        with open(memo_file, 'r') as f:
+            memo = json.load(f)
+    old_memo = dict(memo)
+    hashes = [file_sha1(path, memo) for path in file_paths]
+    if(memo != old_memo):
+        tmp = memo_file+'.tmp{}'.format(os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(memo, f)
+        os.replace(tmp, memo_file)
+    return hashlib.sha1(json.dumps([CACHE_SCHEMA, params, hashes]).encode()).hexdigest()
+
+def cache_load(cache_dir, key, as_views=False):
+    entry = os.path.join(cache_dir, key)
+    if not os.path.exists(os.path.join(entry, 'meta.json')):
+        return None
+    with open(os.path.join(entry, 'meta.json'), 'r') as f:
+        meta = json.load(f)
+    os.utime(os.path.join(entry, 'meta.json')) #last use, for the eviction
+    offsets = np.concatenate(([0],np.cumsum(meta['size_of_each']))).astype(int)
+    outputs = []
+    for name in CACHE_OUTPUTS:
+        if name in meta:
+            outputs.append(meta[name])
+            continue
+        #read-only views, or private copy-on-write arrays like a fresh import
+        arr = np.load(os.path.join(entry, name+'.npy'), mmap_mode='r' if as_views else 'c')
+        if(as_views and arr.ndim == 3):
+            arr = [arr[offsets[k]:offsets[k+1]] for k in range(len(offsets)-1)]
+        outputs.append(arr)
+    if as_views:
+        outputs.append(offsets)
+    return tuple(outputs)
+
+def cache_store(cache_dir, key, outputs):
+    entry = os.path.join(cache_dir, key)
+    tmp = entry+'.tmp{}'.format(os.getpid())
+    os.makedirs(tmp, exist_ok=True)
+    meta = {}
+    for name, value in zip(CACHE_OUTPUTS, outputs):
+        if(isinstance(value, list) and not (len(value) > 0 and isinstance(value[0], np.ndarray))):
+            meta[name] = [float(v) if isinstance(v, np.floating) else v for v in value]
+        elif isinstance(value, list):
+            #per-trajectory windows are written one after the other, never stacked in memory
+            out = np.lib.format.open_memmap(os.path.join(tmp, name+'.npy'), mode='w+', dtype=value[0].dtype,
+                                            shape=(sum(v.shape[0] for v in value),)+value[0].shape[1:])
+            start = 0
+            for v in value:
+                out[start:start+v.shape[0]] = v
+                start += v.shape[0]
+            out.flush()
+            del out
+        else:
+            np.save(os.path.join(tmp, name+'.npy'), value)
+    with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    try:
+        os.rename(tmp, entry)
+    except OSError: #stored meanwhile by another process
+        shutil.rmtree(tmp, ignore_errors=True)
+    cache_evict(cache_dir, keep=key)
+
+def cache_evict(cache_dir, max_bytes=CACHE_MAX_BYTES, keep=None):
+    entries = []
+    for name in os.listdir(cache_dir):
+        meta_file = os.path.join(cache_dir, name, 'meta.json')
+        if os.path.exists(meta_file):
+            size = sum(os.path.getsize(os.path.join(cache_dir, name, f)) for f in os.listdir(os.path.join(cache_dir, name)))
+            entries.append((os.path.getmtime(meta_file), size, name))
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if(total <= max_bytes):
+            break
+        if(name != keep):
+            shutil.rmtree(os.path.join(cache_dir, name), ignore_errors=True)
+            total -= size
+
+
+'''
+Parses and cleans one log file and extracts its physics channel and velocity labels (the per-file work of
+the import, run in the worker processes when n_workers != 1).
+
+Output:
+(cur_train, cur_GT): cleaned signals, samples X channels
+loc_mat, (vx, vy): physics channel and velocity labels of the windows
+'''
+
+def process_log_file(dataset_folder, line, window_size, stride, physics_dtype):
+    #Import IMU and Ground Truth
+    cur_file = pd.read_csv(dataset_folder+line)
+    #unit of ground truth: meters
+    cur_GT = cur_file[['X','Z']].to_numpy()
+    #Take care of missing data
+    for i in range(cur_GT.shape[1]):
+        mask = np.isnan(cur_GT[:,i])
+        cur_GT[mask,i] = np.interp(np.flatnonzero(mask), np.flatnonzero(~mask), cur_GT[~mask,i])
+    #unit of IMU and compass data: acc: g, gyro: dps mag: uT
+    cur_train = cur_file[['Ax','Ay','Az','Gx','Gy','Gz','Mx','My','Mz']].to_numpy()
+    cur_train[:,3:6] = cur_train[:,3:6]*0.0174533 #dps to rad/s
+    #take care of missing data
+    ind = np.where(~np.isnan(cur_train))[0]
+    first, last = ind[0], ind[-1]
+    cur_train[:first] = cur_train[first]
+    cur_train[last + 1:] = cur_train[last]
+    #Extract Physics Channel
+    loc_mat = physics_channel(sliding_windows(cur_train, window_size, stride), physics_dtype)
+    #Extract Ground Truth Velocity
+    vx, vy = displacement_labels(sliding_windows(cur_GT, window_size, stride))
+    return (cur_train, cur_GT), loc_mat, (vx, vy)
+
+
+'''
+Trajectories of a split: the window arrays of all trajectories stacked along the first axis plus the cumulative
+window offsets, so that windows offsets[k]:offsets[k+1] belong to trajectory k
+
+get(name, k) is an O(1) view without copy; arrays can also be lists with one array per trajectory (as_views
+imports). Iterating gives one dictionary per trajectory (name, x0, y0 and views of all arrays), and select, split
+and filter pick trajectories by log name or index. The traj_utils functions take a TrajectorySet wherever they
+take size_of_each. key is the cache key of the import (see cache_key) if it used the cache, which predict_split
+in traj_utils can use as dataset key.
+
+usage:
+trajs = import_agrobot_dataset_p1(..., as_trajectory_set=True)
+X_k = trajs.get('X', k)
+val, train = trajs.split(['Log1.csv'])
+Gvx, Gvy = GT_pos_generator(trajs['x_vel'], trajs['y_vel'], trajs, trajs.x0_list, trajs.y0_list, window_size, stride, k)
+
+'''
+
+class TrajectorySet:
+    def __init__(self, arrays, size_of_each, names=None, x0_list=None, y0_list=None, key=None):
+        self.arrays = dict(arrays)
+        self.size_of_each = [int(n) for n in size_of_each]
+        self.offsets = np.concatenate(([0],np.cumsum(self.size_of_each))).astype(int)
+        self.names = list(names) if names is not None else [str(k) for k in range(len(self.size_of_each))]
+        self.x0_list = list(x0_list) if x0_list is not None else [0.0]*len(self.size_of_each)
+        self.y0_list = list(y0_list) if y0_list is not None else [0.0]*len(self.size_of_each)
+        self.key = key
+
+    def __len__(self):
+        return len(self.size_of_each)
+
+    #all windows of an array, stacked
+    def __getitem__(self, name):
+        value = self.arrays[name]
+        if isinstance(value, list):
+            return np.concatenate(value, axis=0)
+        return value
+
+    def get(self, name, k):
+        value = self.arrays[name]
+        if isinstance(value, list):
+            return value[k]
+        return value[self.offsets[k]:self.offsets[k+1]]
+
+    def index(self, key):
+        return self.names.index(key) if isinstance(key, str) else int(key)
+
+    def trajectory(self, k):
+        k = self.index(k)
+        traj = {'name': self.names[k], 'x0': self.x0_list[k], 'y0': self.y0_list[k]}
+        for name in self.arrays:
+            traj[name] = self.get(name, k)
+        return traj
+
+    def __iter__(self):
+        for k in range(len(self)):
+            yield self.trajectory(k)
+
+    def select(self, keys):
+        idx = [self.index(key) for key in keys]
+        arrays = {}
+        for name, value in self.arrays.items():
+            parts = [self.get(name, k) for k in idx]
+            arrays[name] = parts if isinstance(value, list) else np.concatenate(parts, axis=0)
+        return TrajectorySet(arrays, [self.size_of_each[k] for k in idx], [self.names[k] for k in idx],
+                             [self.x0_list[k] for k in idx], [self.y0_list[k] for k in idx])
+
+    #(selected trajectories, all others)
+    def split(self, keys):
+        idx = [self.index(key) for key in keys]
+        return self.select(idx), self.select([k for k in range(len(self)) if k not in idx])
+
+    def filter(self, predicate):
+        return self.select([k for k in range(len(self)) if predicate(self.names[k])])
+
+
+def trajectory_set_from_outputs(outputs, names, key=None):
+    arrays = {name: value for name, value in zip(CACHE_OUTPUTS, outputs)
+              if name not in ('x0_list','y0_list','size_of_each')}
+    outputs = dict(zip(CACHE_OUTPUTS, outputs))
+    return TrajectorySet(arrays, outputs['size_of_each'], names, outputs['x0_list'], outputs['y0_list'], key)
+
+
+#stage of a disabled profiler (see the profiler input of the importer)
+def null_stage(name, n_items=1):
+    return nullcontext()
+
+
 '''
 Input: 
 dataset_folder: where the dataset is located at.
 type_flag: import training or test set. 1 is train, anything else is test.
 window_size, stride: window size and stride.
+as_views: return the windows of every trajectory as read-only views on its signal (see sliding_windows)
+instead of one stacked copy; the windowed outputs are then lists with one array per trajectory.
+cache_dir: folder of the on-disk cache (see cache_load), None to always parse the log files.
+physics_dtype: precision of the physics channel computation (see physics_channel).
+n_workers: number of processes parsing the log files (see map_log_files), 1 to parse them here, None for one per CPU.
+as_trajectory_set: return a TrajectorySet of the outputs (named as in CACHE_OUTPUTS) instead of the tuple.
+profiler: StageProfiler (Neural Kalman IMU GNSS Fusion/profiling.py) timing the cache_load, parse, cache_store
+and stack stages, None to disable.
 
 
 Output:
@@ -24,21 +384,27 @@ Physics_vec: Windowed physics metadata channel
 x_vel, y_vel: windowed x and y velocities (output of NN)
 x0_list, y0_list: initial coordinates for each trajectory (useful for plotting)
 size_of_each: index of new trajectory in windowed files (useful for plotting)
+traj_offsets (only with as_views): cumulative window offsets of the trajectories, trajectory k is
+windows traj_offsets[k]:traj_offsets[k+1] of the stacked arrays
 '''
 
 def import_agrobot_dataset_p1(dataset_folder = './dataset/AgroBot Dataset/dataset0', 
                               type_flag = 1, 
                               window_size = 50, 
-                              stride = 5):
+                              stride = 5,
+                              as_views = False,
+                              cache_dir = None,
+                              physics_dtype = np.float64, n_workers = 1,
+                              as_trajectory_set = False, profiler = None):
     
     x0_list = []
     y0_list = []
     size_of_each = []
-    X = np.empty([0, window_size, 9])
-    Y_pos = np.empty([0,window_size, 2])
-    x_vel = np.empty([0])
-    y_vel = np.empty([0])
-    Physics_Vec = np.empty([0])
+    X = []
+    Y_pos = []
+    x_vel = []
+    y_vel = []
+    Physics_Vec = []
     
     if(type_flag==1):
         type_file = 'train.txt'
@@ -47,67 +413,162 @@ def import_agrobot_dataset_p1(dataset_folder = './dataset/AgroBot Dataset/datase
     with open(dataset_folder+type_file, 'r') as f:
         list_of_files = [line.strip() for line in f]
     print('List of log files being imported: ',list_of_files)
-    for line in tqdm(list_of_files):
-        #Import IMU and Ground Truth
-        cur_file = pd.read_csv(dataset_folder+line)
-        #unit of ground truth: meters
-        cur_GT = cur_file[['X','Z']].to_numpy()
-        #Take care of missing data
-        for i in range(cur_GT.shape[1]):
-            mask = np.isnan(cur_GT[:,i])
-            cur_GT[mask,i] = np.interp(np.flatnonzero(mask), np.flatnonzero(~mask), cur_GT[~mask,i])
-        #unit of IMU and compass data: acc: g, gyro: dps mag: uT
-        cur_train = cur_file[['Ax','Ay','Az','Gx','Gy','Gz','Mx','My','Mz']].to_numpy()
-        cur_train[:,3:6] = cur_train[:,3:6]*0.0174533 #dps to rad/s
-        #take care of missing data
-        ind = np.where(~np.isnan(cur_train))[0]
-        first, last = ind[0], ind[-1]
-        cur_train[:first] = cur_train[first]
-        cur_train[last + 1:] = cur_train[last]
-        windows = SlidingWindow(size=window_size, stride=stride)
-        #Window IMU Readings
-        cur_train_3D = windows.fit_transform(cur_train[:,0])
-        for i in range(1,cur_train.shape[1]):
-            X_windows = windows.fit_transform(cur_train[:,i])
-            cur_train_3D = np.dstack((cur_train_3D,X_windows))
-        #Window Ground Truth
-        cur_GT_3D = windows.fit_transform(cur_GT[:,0])
-        for i in range(1,cur_GT.shape[1]):
-            X_windows = windows.fit_transform(cur_GT[:,i])
-            cur_GT_3D = np.dstack((cur_GT_3D,X_windows))
-        #Extract Physics Channel
-        loc_mat = np.empty((cur_train_3D.shape[0]))
-        for i in range(cur_train_3D.shape[0]):
-            acc_x =  cur_train_3D[i,:,0]
-            acc_y =  cur_train_3D[i,:,1]
-            acc_z =  cur_train_3D[i,:,2]
-            VecSum = np.sqrt(acc_x**2 + acc_y**2 + acc_z**2)
-            VecSum = VecSum - np.mean(VecSum)
-            FFT_VS = fft(VecSum)
-            P2 = np.abs(FFT_VS/acc_x.shape[0])
-            P1 = P2[0:math.ceil(acc_x.shape[0]/2)]
-            P1[1:-1-2] = 2*P1[1:-1-2]
-            loc_mat[i] = np.mean(P1)  
-        #Extract Ground Truth Velocity
-        vx = np.zeros((cur_GT_3D.shape[0]))
-        vy = np.zeros((cur_GT_3D.shape[0]))
-        for i in range(cur_GT_3D.shape[0]): 
-            Xdisp = (cur_GT_3D[i,-1,0]-cur_GT_3D[i,0,0])
-            vx[i] = Xdisp
-            Ydisp = (cur_GT_3D[i,-1,1]-cur_GT_3D[i,0,1])
-            vy[i] = Ydisp
-        #Stack readings
-        X = np.vstack((X, cur_train_3D))
-        Physics_Vec = np.concatenate((Physics_Vec,loc_mat))
-        Y_pos = np.vstack((Y_pos, cur_GT_3D))
-        x0_list.append(cur_GT[0,0])
-        y0_list.append(cur_GT[0,1])
-        size_of_each.append(cur_GT_3D.shape[0])
-        x_vel = np.concatenate((x_vel, vx))
-        y_vel = np.concatenate((y_vel, vy))
+    stage = profiler.stage if profiler is not None else null_stage
+    key = None
+    if cache_dir is not None:
+        key = cache_key(cache_dir, [dataset_folder+line for line in list_of_files],
+                        [window_size, stride, np.dtype(physics_dtype).name])
+        with stage('cache_load'):
+            cached = cache_load(cache_dir, key, as_views)
+        if cached is not None:
+            if as_trajectory_set:
+                return trajectory_set_from_outputs(cached, list_of_files, key)
+            return cached
+    args_list = [(dataset_folder, line, window_size, stride, physics_dtype) for line in list_of_files]
+    with stage('parse', len(args_list)):
+        for (cur_train, cur_GT), loc_mat, (vx, vy) in map_log_files(process_log_file, args_list, n_workers):
+            #Window IMU Readings
+            cur_train_3D = sliding_windows(cur_train, window_size, stride)
+            #Window Ground Truth
+            cur_GT_3D = sliding_windows(cur_GT, window_size, stride)
+            #Collect readings, stacked once at the end
+            X.append(cur_train_3D)
+            Physics_Vec.append(loc_mat)
+            Y_pos.append(cur_GT_3D)
+            x0_list.append(cur_GT[0,0])
+            y0_list.append(cur_GT[0,1])
+            size_of_each.append(cur_GT_3D.shape[0])
+            x_vel.append(vx)
+            y_vel.append(vy)
+        Physics_Vec = concat_values(Physics_Vec)
+        x_vel = concat_values(x_vel)
+        y_vel = concat_values(y_vel)
+    if cache_dir is not None:
+        with stage('cache_store'):
+            cache_store(cache_dir, key, (X,Y_pos, Physics_Vec, x_vel, y_vel, x0_list, y0_list, size_of_each))
+    if as_views:
+        if as_trajectory_set:
+            return trajectory_set_from_outputs((X,Y_pos, Physics_Vec, x_vel, y_vel, x0_list, y0_list, size_of_each), list_of_files, key)
+        traj_offsets = np.concatenate(([0],np.cumsum(size_of_each))).astype(int)
+        return X,Y_pos, Physics_Vec, x_vel, y_vel, x0_list, y0_list, size_of_each, traj_offsets
+    with stage('stack'):
+        X = stack_windows(X, window_size, 9)
+        Y_pos = stack_windows(Y_pos, window_size, 2)
+    if as_trajectory_set:
+        return trajectory_set_from_outputs((X,Y_pos, Physics_Vec, x_vel, y_vel, x0_list, y0_list, size_of_each), list_of_files, key)
     return X,Y_pos, Physics_Vec, x_vel, y_vel, x0_list, y0_list, size_of_each
     
 
+#EPSG:3857 (meters) to EPSG:4326 transformer of the exports, built once per process
+@lru_cache(maxsize=None)
+def mercator_transformer():
+    return Transformer.from_crs("epsg:3857","epsg:4326")
+
+
+'''
+Merges exported logs into one MATLAB structure
+
+The per-sample arrays of all logs are concatenated. imu_index and gps_index hold the first and last row (1-based,
+inclusive) of every log in the IMU rate (accel, gyro, mag, truePos) and GPS rate (lla, gpsvel) arrays, logs holds
+the log file names and refloc one row per log; imuFs, gpsFs, Rpos, Rvel and Rmag are shared by all logs.
+
+'''
+
+LOG_ARRAYS = ('accel','gyro','mag','truePos','lla','gpsvel')
+
+def consolidate_logs(list_of_files, logs):
+    mdic = {name: np.concatenate([arrays[i] for arrays, _ in logs],axis=0) for i, name in enumerate(LOG_ARRAYS)}
+    for index_name, array_name in (('imu_index','accel'),('gps_index','lla')):
+        ends = np.cumsum([arrays[LOG_ARRAYS.index(array_name)].shape[0] for arrays, _ in logs])
+        mdic[index_name] = np.stack((np.concatenate(([1],ends[:-1]+1)), ends),axis=1)
+    mdic['logs'] = np.array(list_of_files, dtype=object)
+    mdic['refloc'] = np.array([scalars['refloc'] for _, scalars in logs])
+    for name in ('imuFs','gpsFs','Rpos','Rvel','Rmag'):
+        mdic[name] = logs[0][1][name]
+    return mdic
+
+
+'''
+Writes the MATLAB file of one log file (the per-file work of the export, run in the worker processes when
+n_workers != 1). rng draws the synthetic GPS noise. The file is compressed; with save=False its arrays
+(LOG_ARRAYS) and the other entries are returned instead, for consolidate_logs.
+'''
+
+def export_log_file(dataset_folder, line, decimation_factor, sampling_rate_imu, pos_noise_var, velocity_noise_var,
+                    magnetometer_noise_var, rng=np.random, save=True):
+    #Import IMU and Ground Truth
+    cur_file = pd.read_csv(dataset_folder+line)
+    #unit of ground truth: meters
+    cur_GT = cur_file[['X','Z']].to_numpy()
+    #Take care of missing data
+    for i in range(cur_GT.shape[1]):
+        mask = np.isnan(cur_GT[:,i])
+        cur_GT[mask,i] = np.interp(np.flatnonzero(mask), np.flatnonzero(~mask), cur_GT[~mask,i])
+    #unit of IMU and compass data: acc: g, gyro: dps mag: uT
+    cur_train = cur_file[['Ax','Ay','Az','Gx','Gy','Gz','Mx','My','Mz']].to_numpy()
+    cur_train[:,3:6] = cur_train[:,3:6]*0.0174533 #dps to rad/s
+    #take care of missing data
+    ind = np.where(~np.isnan(cur_train))[0]
+    first, last = ind[0], ind[-1]
+    cur_train[:first] = cur_train[first]
+    cur_train[last + 1:] = cur_train[last]
+    
+    gt_pos_x = cur_GT[:,0]
+    gt_pos_y = cur_GT[:,1]
+    gt_pos_z = np.hstack(np.zeros((cur_GT.shape[0],1)))
+    #generate synthetic GPS
+    x_pos = cur_GT[:,0]
+    y_pos = cur_GT[:,1]
+    z_pos = np.hstack(np.zeros((len(x_pos),1)))
+    vel_x = np.insert(np.ediff1d(x_pos),0,0.0)
+    vel_y = np.insert(np.ediff1d(y_pos),0,0.0)
+    vel_z = np.insert(np.ediff1d(z_pos),0,0.0)
+    if(decimation_factor!=0):
+        x_pos = x_pos[0::decimation_factor]
+        y_pos = y_pos[0::decimation_factor]
+        z_pos = z_pos[0::decimation_factor]
+        vel_x = vel_x[0::decimation_factor]
+        vel_y = vel_y[0::decimation_factor] 
+        vel_z = vel_z[0::decimation_factor]
+    if(pos_noise_var != 0 and velocity_noise_var!=0):
+        x_pos = x_pos + rng.normal(0,sqrt(pos_noise_var),len(x_pos))
+        y_pos = y_pos + rng.normal(0,sqrt(pos_noise_var),len(y_pos))
+        z_pos = z_pos + rng.normal(0,sqrt(pos_noise_var),len(z_pos))
+        vel_x = vel_x + rng.normal(0,sqrt(velocity_noise_var),len(vel_x))
+        vel_y = vel_y + rng.normal(0,sqrt(velocity_noise_var),len(vel_y))
+        vel_z = vel_z + rng.normal(0,sqrt(velocity_noise_var),len(vel_z))
+    accel = cur_train[:,0:3]*9.80665
+    gyro = cur_train[:,3:6]
+    mag = cur_train[:,3:6]
+    truePos = np.concatenate((gt_pos_x.reshape(gt_pos_x.shape[0],1),
+                              gt_pos_y.reshape(gt_pos_y.shape[0],1),
+                              gt_pos_z.reshape(gt_pos_z.shape[0],1)),axis=1)
+    gpsvel = np.concatenate((vel_x.reshape(vel_x.shape[0],1),
+                              vel_y.reshape(vel_y.shape[0],1),
+                              vel_z.reshape(vel_z.shape[0],1)),axis=1)
+            
+    lon_mat, lat_mat = mercator_transformer().transform(x_pos, y_pos)
+    lon_mat = np.asarray(lon_mat)
+    lat_mat = np.asarray(lat_mat)
+    refloc = [lat_mat[0],lon_mat[0],0] #pseudo-location
+    lla = np.concatenate((lat_mat.reshape(lat_mat.shape[0],1),
+                              lon_mat.reshape(lon_mat.shape[0],1),
+                              z_pos.reshape(z_pos.shape[0],1)),axis=1)
+    
+    Rpos = pos_noise_var
+    Rvel = velocity_noise_var
+    Rmag = magnetometer_noise_var
+    gpsFs = sampling_rate_imu/decimation_factor
+    imuFs = sampling_rate_imu
+    
+    mdic = {"accel": accel, "gyro": gyro, "mag": mag, "lla": lla, 
+            "gpsvel": gpsvel, "truePos": truePos, "imuFs": imuFs, "gpsFs": gpsFs, 
+           "Rpos": Rpos, "Rvel": Rvel, "Rmag": Rmag, "refloc": refloc}
+    if not save:
+        return tuple(mdic[name] for name in LOG_ARRAYS), {name: mdic[name] for name in mdic if name not in LOG_ARRAYS}
+    savemat(dataset_folder+"dset0_"+line[0:-4]+".mat", mdic, do_compression=True)
+
+
 '''
 Input: 
 dataset_folder: where the dataset is located at.
@@ -116,18 +577,23 @@ decimation_factor: GPS decimation factor (e.g., if IMU is sampled at 100 Hz, a d
 sampling_rate_imu: sampling rate of imu
 pos_noise_var, velocity_noise_var:  GPS position and velocity noise variance, in m^2 and (m/s)^2
 magnetometer_noise_var: noise variance of magnetometer, in (uT)^2
+n_workers: number of processes writing the files (see map_log_files), 1 to write them here, None for one per CPU
+consolidated: write all logs to one dset0_<train|test>_all.mat with an index of the logs (see consolidate_logs)
+instead of one file per log
 
 
 Output:
-MATLAB file containing IMU data, ground truth position, GPS data (lat, lon, alt), measurement errors, etc. for use
-with MATLAB's EKF IMU-GPS demo
+MATLAB file (compressed) containing IMU data, ground truth position, GPS data (lat, lon, alt), measurement errors,
+etc. for use with MATLAB's EKF IMU-GPS demo
 '''
 
 def export_agrobot_dataset_p1_to_matlab(dataset_folder = './dataset/AgroBot Dataset/dataset0/', 
                                         type_flag = 1, decimation_factor = 100, sampling_rate_imu=100.0, 
                                         pos_noise_var = 1.5**2,
                                        velocity_noise_var = 0.0025,
-                                       magnetometer_noise_var = 0.36):
+                                       magnetometer_noise_var = 0.36,
+                                       n_workers = 1,
+                                       consolidated = False):
     if(type_flag==1):
         type_file = 'train.txt'
     else:
@@ -135,83 +601,15 @@ def export_agrobot_dataset_p1_to_matlab(dataset_folder = './dataset/AgroBot Data
     with open(dataset_folder+type_file, 'r') as f:
         list_of_files = [line.strip() for line in f]
     print('List of log files being imported: ',list_of_files)
-    for line in tqdm(list_of_files):
-        #Import IMU and Ground Truth
-        cur_file = pd.read_csv(dataset_folder+line)
-        #unit of ground truth: meters
-        cur_GT = cur_file[['X','Z']].to_numpy()
-        #Take care of missing data
-        for i in range(cur_GT.shape[1]):
-            mask = np.isnan(cur_GT[:,i])
-            cur_GT[mask,i] = np.interp(np.flatnonzero(mask), np.flatnonzero(~mask), cur_GT[~mask,i])
-        #unit of IMU and compass data: acc: g, gyro: dps mag: uT
-        cur_train = cur_file[['Ax','Ay','Az','Gx','Gy','Gz','Mx','My','Mz']].to_numpy()
-        cur_train[:,3:6] = cur_train[:,3:6]*0.0174533 #dps to rad/s
-        #take care of missing data
-        ind = np.where(~np.isnan(cur_train))[0]
-        first, last = ind[0], ind[-1]
-        cur_train[:first] = cur_train[first]
-        cur_train[last + 1:] = cur_train[last]
-        
-        gt_pos_x = cur_GT[:,0]
-        gt_pos_y = cur_GT[:,1]
-        gt_pos_z = np.hstack(np.zeros((cur_GT.shape[0],1)))
-        #generate synthetic GPS
-        x_pos = cur_GT[:,0]
-        y_pos = cur_GT[:,1]
-        z_pos = np.hstack(np.zeros((len(x_pos),1)))
-        vel_x = np.insert(np.ediff1d(x_pos),0,0.0)
-        vel_y = np.insert(np.ediff1d(y_pos),0,0.0)
-        vel_z = np.insert(np.ediff1d(z_pos),0,0.0)
-        if(decimation_factor!=0):
-            x_pos = x_pos[0::decimation_factor]
-            y_pos = y_pos[0::decimation_factor]
-            z_pos = z_pos[0::decimation_factor]
-            vel_x = vel_x[0::decimation_factor]
-            vel_y = vel_y[0::decimation_factor] 
-            vel_z = vel_z[0::decimation_factor]
-        if(pos_noise_var != 0 and velocity_noise_var!=0):
-            x_pos = x_pos + np.random.normal(0,sqrt(pos_noise_var),len(x_pos))
-            y_pos = y_pos + np.random.normal(0,sqrt(pos_noise_var),len(y_pos))
-            z_pos = z_pos + np.random.normal(0,sqrt(pos_noise_var),len(z_pos))
-            vel_x = vel_x + np.random.normal(0,sqrt(velocity_noise_var),len(vel_x))
-            vel_y = vel_y + np.random.normal(0,sqrt(velocity_noise_var),len(vel_y))
-            vel_z = vel_z + np.random.normal(0,sqrt(velocity_noise_var),len(vel_z))
-        accel = cur_train[:,0:3]*9.80665
-        gyro = cur_train[:,3:6]
-        mag = cur_train[:,3:6]
-        truePos = np.concatenate((gt_pos_x.reshape(gt_pos_x.shape[0],1),
-                                  gt_pos_y.reshape(gt_pos_y.shape[0],1),
-                                  gt_pos_z.reshape(gt_pos_z.shape[0],1)),axis=1)
-        gpsvel = np.concatenate((vel_x.reshape(vel_x.shape[0],1),
-                                  vel_y.reshape(vel_y.shape[0],1),
-                                  vel_z.reshape(vel_z.shape[0],1)),axis=1)
-                
-        lon_mat=[]
-        lat_mat = []
-        transformer = Transformer.from_crs("epsg:3857","epsg:4326")
-        for j in range(len(x_pos)):
-            lon,lat = transformer.transform(x_pos[j],y_pos[j])
-            lon_mat.append(lon)
-            lat_mat.append(lat)
-        lon_mat = np.array(lon_mat)
-        lat_mat = np.array(lat_mat)
-        refloc = [lat_mat[0],lon_mat[0],0] #pseudo-location
-        lla = np.concatenate((lat_mat.reshape(lat_mat.shape[0],1),
-                                  lon_mat.reshape(lon_mat.shape[0],1),
-                                  z_pos.reshape(z_pos.shape[0],1)),axis=1)
-        
-        Rpos = pos_noise_var
-        Rvel = velocity_noise_var
-        Rmag = magnetometer_noise_var
-        gpsFs = sampling_rate_imu/decimation_factor
-        imuFs = sampling_rate_imu
-        
-        mdic = {"accel": accel, "gyro": gyro, "mag": mag, "lla": lla, 
-                "gpsvel": gpsvel, "truePos": truePos, "imuFs": imuFs, "gpsFs": gpsFs, 
-               "Rpos": Rpos, "Rvel": Rvel, "Rmag": Rmag, "refloc": refloc}
-        savemat(dataset_folder+"dset0_"+line[0:-4]+".mat", mdic)
-        
-        
-        
-        
\ No newline at end of file
+    if(n_workers == 1):
+        rngs = [np.random]*len(list_of_files)
+    else:
+        #independent noise for every file, forked workers would all start from the same np.random state;
+        #the seed is drawn from np.random so that np.random.seed makes the export reproducible for any n_workers
+        seeds = np.random.SeedSequence(np.random.randint(2**32,dtype=np.uint32)).spawn(len(list_of_files))
+        rngs = [np.random.default_rng(seed) for seed in seeds]
+    args_list = [(dataset_folder, line, decimation_factor, sampling_rate_imu, pos_noise_var, velocity_noise_var,
+                  magnetometer_noise_var, rng, not consolidated) for line, rng in zip(list_of_files, rngs)]
+    logs = list(map_log_files(export_log_file, args_list, n_workers))
+    if consolidated:
+        savemat(dataset_folder+"dset0_"+type_file[0:-4]+"_all.mat", consolidate_logs(list_of_files, logs), do_compression=True)
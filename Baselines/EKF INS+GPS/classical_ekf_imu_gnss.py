@@ -0,0 +1,389 @@
+import numpy as np
+from math import sqrt, radians
+
+
+'''
+NumPy port of classical_ekf_imu_gnss.m (MATLAB insfilterMARG: 9DoF IMU + GNSS extended Kalman filter)
+
+The filter has the 22 states of insfilterMARG: orientation quaternion (body to NED), NED position, NED velocity,
+delta angle bias, delta velocity bias, geomagnetic field vector (NED) and magnetometer bias. As in the MATLAB script,
+every IMU sample is a predict (gyro and accel as delta angle and delta velocity over 1/imuFs) followed by a
+magnetometer fusion, and once every imuFs samples the next GPS fix (position and velocity) is fused. GPS positions
+are converted from lla to NED around refloc (WGS84, as lla2ned), all at once before the filter runs.
+
+Several logs are filtered at once: the states are stacked (X: N X 22, P: N X 22 X 22) and stepped together, so the
+per-sample Python overhead is shared by all logs of a split. Logs shorter than the longest one are padded and their
+padded samples are dropped from the output.
+
+The process noise follows the MATLAB script parameters (noise variances per second, scaled by dt^2 for the delta
+angle and delta velocity states). P is kept symmetric after every update. insfilterMARG is closed source, so use compare_with_matlab to check the positions
+against the p of classical_ekf_imu_gnss.m on the same export before relying on exact numbers.
+
+inputs (MARGFilter):
+imuFs: IMU sampling rate (Hz)
+n_filters: number of logs filtered at once
+noise parameters: as the insfilterMARG properties set in classical_ekf_imu_gnss.m
+state_covariance: initial P (22 X 22, or a scalar times ones(22) as in the script)
+geomagnetic_field: initial geomagnetic field vector state (NED, uT)
+
+usage:
+p = classical_ekf_imu_gnss(accel, gyro, mag, lla, gpsvel, imuFs, refloc, Rpos, Rvel, Rmag)
+p_list = classical_ekf_imu_gnss_batch(logs_from_export(mdic))
+ate, rte = classical_ekf_metrics(p, truePos)
+
+'''
+
+GRAVITY = 9.81
+WGS84_A = 6378137.0
+WGS84_F = 1/298.257223563
+GYROSCOPE_ARW = (3.09, 2.7, 5.4) #deg/sqrt(hr)
+GYROSCOPE_BI = (88.91, 78.07, 211.4) #deg/hr
+
+#GyroscopeBiasNoise of classical_ekf_imu_gnss.m
+def gyroscope_bias_noise_script(imuFs, arw=GYROSCOPE_ARW, bi=GYROSCOPE_BI):
+    return np.array([((radians(a)/60.0)*sqrt(1/imuFs))**2 + (radians(b)/3600.0)**2 for a, b in zip(arw, bi)])
+
+
+#rotation matrices (body to NED) of N quaternions, N X 3 X 3
+def quat_to_rotmat(q):
+    q0, q1, q2, q3 = q[:,0], q[:,1], q[:,2], q[:,3]
+    R = np.empty((q.shape[0],3,3))
+    R[:,0,0] = q0*q0 + q1*q1 - q2*q2 - q3*q3
+    R[:,0,1] = 2*(q1*q2 - q0*q3)
+    R[:,0,2] = 2*(q1*q3 + q0*q2)
+    R[:,1,0] = 2*(q1*q2 + q0*q3)
+    R[:,1,1] = q0*q0 - q1*q1 + q2*q2 - q3*q3
+    R[:,1,2] = 2*(q2*q3 - q0*q1)
+    R[:,2,0] = 2*(q1*q3 - q0*q2)
+    R[:,2,1] = 2*(q2*q3 + q0*q1)
+    R[:,2,2] = q0*q0 - q1*q1 - q2*q2 + q3*q3
+    return R
+
+def skew(u):
+    S = np.zeros(u.shape[:-1]+(3,3))
+    S[...,0,1] = -u[...,2]
+    S[...,0,2] = u[...,1]
+    S[...,1,0] = u[...,2]
+    S[...,1,2] = -u[...,0]
+    S[...,2,0] = -u[...,1]
+    S[...,2,1] = u[...,0]
+    return S
+
+#derivative of R(q)@u (transpose=False) or R(q).T@u (transpose=True) with respect to q, N X 3 X 4
+def rotation_jacobian(q, u, transpose=False):
+    w = q[:,0:1]
+    v = q[:,1:4]
+    if transpose:
+        v = -v
+    J = np.empty((q.shape[0],3,4))
+    J[:,:,0] = 2*(w*u + np.cross(v,u))
+    J[:,:,1:4] = 2*(np.sum(v*u,axis=1)[:,None,None]*np.identity(3) + v[:,:,None]*u[:,None,:]
+                    - u[:,:,None]*v[:,None,:] - w[:,:,None]*skew(u))
+    if transpose:
+        J[:,:,1:4] = -J[:,:,1:4]
+    return J
+
+#matrix of q -> q (x) p (quaternion product), N X 4 X 4
+def quat_product_matrix(p):
+    M = np.empty((p.shape[0],4,4))
+    M[:,0,0] = p[:,0]
+    M[:,0,1:4] = -p[:,1:4]
+    M[:,1:4,0] = p[:,1:4]
+    M[:,1:4,1:4] = p[:,0,None,None]*np.identity(3) - skew(p[:,1:4])
+    return M
+
+#derivative of q (x) [1, a] with respect to a, N X 4 X 3
+def quat_product_jacobian(q):
+    Xi = np.empty((q.shape[0],4,3))
+    Xi[:,0,:] = -q[:,1:4]
+    Xi[:,1:4,:] = q[:,0,None,None]*np.identity(3) + skew(q[:,1:4])
+    return Xi
+
+#matrix M of a bilinear func: func(a, b).ravel() = outer(a, b).ravel()@M
+def bilinear_map(func, n_a, n_b):
+    a = np.repeat(np.identity(n_a), n_b, axis=0)
+    b = np.tile(np.identity(n_b), (n_a,1))
+    return func(a, b).reshape(n_a*n_b,-1)
+
+#the quaternion algebra of a filter step as constant matrices, so a step is a few matrix products for all filters
+ROT_MAP = bilinear_map(lambda a, b: (quat_to_rotmat(a+b)-quat_to_rotmat(a-b))/4, 4, 4)
+ROT_JACOBIAN_MAP = bilinear_map(rotation_jacobian, 4, 3)
+ROT_T_JACOBIAN_MAP = bilinear_map(lambda q, u: rotation_jacobian(q, u, transpose=True), 4, 3)
+QUAT_PRODUCT_MAP = quat_product_matrix(np.identity(4)).reshape(4,16)
+QUAT_PRODUCT_JACOBIAN_MAP = quat_product_jacobian(np.identity(4)).reshape(4,12)
+I3 = np.identity(3)
+I4 = np.identity(4)
+I6 = np.identity(6)
+
+#unit quaternions with a non-negative real part (in place)
+def repair_quaternion(X):
+    q = X[:,0:4]
+    q *= np.copysign(1/np.sqrt(np.sum(q*q,axis=1,keepdims=True)), q[:,0:1])
+    return X
+
+
+'''
+geodetic (lat, lon in degrees, altitude in m) to NED around a reference location, as MATLAB lla2ned (ellipsoid)
+
+inputs:
+lla: n X 3
+refloc: reference lla (3)
+
+outputs:
+n X 3 NED positions (in m)
+
+'''
+
+def lla2ned(lla, refloc):
+    def ecef(lat, lon, alt):
+        e2 = WGS84_F*(2-WGS84_F)
+        n = WGS84_A/np.sqrt(1-e2*np.sin(lat)**2)
+        return np.stack(((n+alt)*np.cos(lat)*np.cos(lon), (n+alt)*np.cos(lat)*np.sin(lon),
+                         (n*(1-e2)+alt)*np.sin(lat)),axis=-1)
+    lla = np.atleast_2d(np.asarray(lla,dtype=float))
+    lat0, lon0 = np.radians(refloc[0]), np.radians(refloc[1])
+    d = ecef(np.radians(lla[:,0]), np.radians(lla[:,1]), lla[:,2]) - ecef(lat0, lon0, float(refloc[2]))
+    R = np.array(((-np.sin(lat0)*np.cos(lon0), -np.sin(lat0)*np.sin(lon0), np.cos(lat0)),
+                  (-np.sin(lon0), np.cos(lon0), 0.0),
+                  (-np.cos(lat0)*np.cos(lon0), -np.cos(lat0)*np.sin(lon0), -np.sin(lat0))))
+    return d@R.T
+
+
+class MARGFilter:
+    def __init__(self, imuFs, n_filters=1,
+                 accelerometer_noise=0.00615490459,
+                 gyroscope_noise=0.0000030462,
+                 accelerometer_bias_noise=2e-4,
+                 gyroscope_bias_noise=None,
+                 magnetometer_bias_noise=0.36,
+                 geomagnetic_vector_noise=0.36,
+                 state_covariance=1e-9,
+                 geomagnetic_field=(27.5550, -2.4169, -16.0849)):
+        self.dt = dt = 1.0/imuFs
+        if gyroscope_bias_noise is None:
+            gyroscope_bias_noise = gyroscope_bias_noise_script(imuFs)
+        #G@U@G.T is gyroscope_noise*dt^2/4*(I-q@q.T) on the quaternion (unit q) and accelerometer_noise*dt^2*I on the
+        #velocity, the bias and field noises are additive
+        self.quat_noise = 0.25*gyroscope_noise*dt**2
+        self.Q_diag = np.zeros(22)
+        self.Q_diag[7:10] = accelerometer_noise*dt**2
+        self.Q_diag[10:13] = np.asarray(gyroscope_bias_noise)*dt**2
+        self.Q_diag[13:16] = accelerometer_bias_noise*dt**2
+        self.Q_diag[16:19] = geomagnetic_vector_noise
+        self.Q_diag[19:22] = magnetometer_bias_noise
+        self.gravity_dt = np.array((0.0,0.0,GRAVITY*dt))
+
+        self.X = np.zeros((n_filters,22))
+        self.X[:,0] = 1.0
+        self.X[:,16:19] = geomagnetic_field
+        if np.ndim(state_covariance) == 0:
+            state_covariance = state_covariance*np.ones((22,22))
+        self.P = np.repeat(np.asarray(state_covariance,dtype=float)[None],n_filters,axis=0)
+        #Jacobians, only their non constant blocks are written at every step
+        self.F = np.repeat(np.identity(22)[None],n_filters,axis=0)
+        self.F[:,4:7,7:10] = dt*np.identity(3)
+        self.H_mag = np.zeros((n_filters,3,22))
+        self.H_mag[:,:,19:22] = np.identity(3)
+        self.H_gps = np.zeros((1,6,22))
+        self.H_gps[:,:,4:10] = np.identity(6)
+        self.quat_step = np.zeros((n_filters,4))
+        self.quat_step[:,0] = 1.0
+
+    @property
+    def position(self):
+        return self.X[:,4:7]
+
+    #rotation matrices of the filter quaternions and the q@q.T they are built from
+    def rotation(self):
+        q = self.X[:,0:4]
+        qq = q[:,:,None]*q[:,None,:]
+        return (qq.reshape(-1,16)@ROT_MAP).reshape(-1,3,3), qq
+
+    #dAng, dVel: delta angle and delta velocity of every filter, N X 3
+    def predict(self, dAng, dVel):
+        X, F, dt = self.X, self.F, self.dt
+        n = X.shape[0]
+        q = X[:,0:4].copy()
+        R, qq = self.rotation()
+        self.quat_step[:,1:4] = 0.5*(dAng - X[:,10:13])
+        dv = dVel - X[:,13:16]
+        Om = (self.quat_step@QUAT_PRODUCT_MAP).reshape(n,4,4)
+        F[:,0:4,0:4] = Om
+        F[:,0:4,10:13] = (q@QUAT_PRODUCT_JACOBIAN_MAP).reshape(n,4,3)
+        F[:,0:4,10:13] *= -0.5
+        F[:,7:10,0:4] = ((q[:,:,None]*dv[:,None,:]).reshape(n,12)@ROT_JACOBIAN_MAP).reshape(n,3,4)
+        F[:,7:10,13:16] = -R
+
+        X[:,0:4] = (Om@q[:,:,None])[:,:,0]
+        X[:,4:7] += dt*X[:,7:10]
+        X[:,7:10] += (R@dv[:,:,None])[:,:,0] + self.gravity_dt
+        P = F@self.P@np.swapaxes(F,1,2)
+        P[:,0:4,0:4] += self.quat_noise*(I4-qq)
+        P.reshape(n,-1)[:,::23] += self.Q_diag
+        self.P = P
+        repair_quaternion(X)
+
+    #EKF update of the filters idx (all when None) with the innovations (k X m), Jacobians H (k X m X 22) and
+    #measurement noise R_meas (m X m or k X m X m)
+    def correct(self, innovation, H, R_meas, idx=None):
+        if idx is None:
+            X, P = self.X, self.P
+        else:
+            X, P = self.X[idx], self.P[idx]
+        PHt = P@np.swapaxes(H,1,2)
+        K = PHt@np.linalg.inv(H@PHt + R_meas)
+        X += (K@innovation[:,:,None])[:,:,0]
+        P -= K@np.swapaxes(PHt,1,2)
+        #P is badly conditioned (the position starts at 1e-9), keep it symmetric or the rounding errors blow up
+        P += np.swapaxes(P,1,2)
+        P *= 0.5
+        repair_quaternion(X)
+        if idx is not None:
+            self.X[idx] = X
+            self.P[idx] = P
+
+    #mag: magnetometer reading of every filter (N X 3), Rmag: scalar or one per filter
+    def fusemag(self, mag, Rmag):
+        X, H = self.X, self.H_mag
+        n = X.shape[0]
+        R, _ = self.rotation()
+        Rt = np.swapaxes(R,1,2)
+        m = X[:,16:19]
+        h = (Rt@m[:,:,None])[:,:,0] + X[:,19:22]
+        H[:,:,0:4] = ((X[:,0:4,None]*m[:,None,:]).reshape(n,12)@ROT_T_JACOBIAN_MAP).reshape(n,3,4)
+        H[:,:,16:19] = Rt
+        self.correct(mag-h, H, np.multiply.outer(np.atleast_1d(Rmag), I3))
+
+    #pos, vel: NED GPS position and velocity of the filters idx (all when None), Rpos, Rvel: scalars or one per filter
+    def fusegps(self, pos, Rpos, vel, Rvel, idx=None):
+        X = self.X if idx is None else self.X[idx]
+        r = np.stack(np.broadcast_arrays(Rpos, Rpos, Rpos, Rvel, Rvel, Rvel),axis=-1)
+        self.correct(np.concatenate((pos,vel),axis=1) - X[:,4:10], self.H_gps, r[...,None]*I6, idx)
+
+
+'''
+classical EKF of several logs at once, in the layout of the MATLAB export
+
+inputs:
+logs: list of dictionaries with the arrays of export_log_file (accel, gyro, mag, lla, gpsvel, imuFs, refloc, Rpos,
+Rvel, Rmag); see logs_from_export for the consolidated .mat files
+filter_args: extra MARGFilter arguments (noise parameters)
+
+outputs:
+list of n X 3 NED positions, one per log (p of classical_ekf_imu_gnss.m)
+
+'''
+
+def classical_ekf_imu_gnss_batch(logs, **filter_args):
+    scalar = lambda log, name: float(np.squeeze(log[name]))
+    imuFs = scalar(logs[0], 'imuFs')
+    gps_period = int(round(imuFs))
+    n_logs = len(logs)
+    lengths = np.array([np.asarray(log['accel']).shape[0] for log in logs])
+    n_steps = int(np.max(lengths))
+    #delta angles and velocities of every sample, padded to the longest log
+    dAng = np.zeros((n_steps,n_logs,3))
+    dVel = np.zeros((n_steps,n_logs,3))
+    mag = np.zeros((n_steps,n_logs,3))
+    for k, log in enumerate(logs):
+        dAng[0:lengths[k],k] = np.asarray(log['gyro'],dtype=float)/imuFs
+        dVel[0:lengths[k],k] = np.asarray(log['accel'],dtype=float)/imuFs
+        mag[0:lengths[k],k] = log['mag']
+    Rmag = np.array([scalar(log, 'Rmag') for log in logs])
+
+    #as in the script, GPS fix j (0-based) is fused after sample (j+1)*imuFs-1 while j < size(gpsvel,1)-1
+    fixes = []
+    for k, log in enumerate(logs):
+        n_fix = max(min(len(np.atleast_2d(log['gpsvel']))-1, lengths[k]//gps_period), 0)
+        pos = lla2ned(np.atleast_2d(log['lla'])[0:n_fix], np.ravel(log['refloc']))
+        vel = np.atleast_2d(np.asarray(log['gpsvel'],dtype=float))[0:n_fix]
+        fixes.append((np.arange(1,n_fix+1)*gps_period-1, np.full(n_fix,k), pos, vel,
+                      np.full(n_fix,scalar(log, 'Rpos')), np.full(n_fix,scalar(log, 'Rvel'))))
+    step, idx, pos, vel, Rpos, Rvel = [np.concatenate(column) for column in zip(*fixes)]
+    order = np.argsort(step, kind='stable')
+    gps_steps, first = np.unique(step[order], return_index=True)
+    gps_updates = {}
+    for s, group in zip(gps_steps, np.split(order, first[1:])):
+        gps_updates[s] = (idx[group], pos[group], Rpos[group], vel[group], Rvel[group])
+
+    f = MARGFilter(imuFs, n_logs, **filter_args)
+    p = np.empty((n_steps,n_logs,3))
+    for i in range(n_steps):
+        f.predict(dAng[i], dVel[i])
+        f.fusemag(mag[i], Rmag)
+        if i in gps_updates:
+            idx, pos, Rpos, vel, Rvel = gps_updates[i]
+            f.fusegps(pos, Rpos, vel, Rvel, idx)
+        p[i] = f.position
+    return [p[0:lengths[k],k] for k in range(n_logs)]
+
+#one log, as classical_ekf_imu_gnss.m
+def classical_ekf_imu_gnss(accel, gyro, mag, lla, gpsvel, imuFs, refloc, Rpos, Rvel, Rmag, **filter_args):
+    log = {'accel': accel, 'gyro': gyro, 'mag': mag, 'lla': lla, 'gpsvel': gpsvel, 'imuFs': imuFs, 'refloc': refloc,
+           'Rpos': Rpos, 'Rvel': Rvel, 'Rmag': Rmag}
+    return classical_ekf_imu_gnss_batch([log], **filter_args)[0]
+
+
+'''
+logs of a MATLAB export: a consolidated dictionary or .mat file (consolidate_logs, imu_index and gps_index are 1-based
+inclusive rows), a single-log one, or the (arrays, scalars) pairs of export_log_file(..., save=False)
+
+'''
+
+LOG_ARRAYS = ('accel','gyro','mag','truePos','lla','gpsvel')
+
+def logs_from_export(mdic):
+    if isinstance(mdic, str):
+        from scipy.io import loadmat
+        mdic = loadmat(mdic)
+    if isinstance(mdic, (list, tuple)):
+        logs = []
+        for arrays, scalars in mdic:
+            log = dict(zip(LOG_ARRAYS, arrays))
+            log.update(scalars)
+            logs.append(log)
+        return logs
+    if 'imu_index' not in mdic:
+        return [dict(mdic)]
+    logs = []
+    refloc = np.atleast_2d(mdic['refloc'])
+    for k, ((i0, i1), (g0, g1)) in enumerate(zip(np.atleast_2d(mdic['imu_index']), np.atleast_2d(mdic['gps_index']))):
+        log = {name: mdic[name][int(i0)-1:int(i1)] for name in ('accel','gyro','mag','truePos')}
+        log.update({name: mdic[name][int(g0)-1:int(g1)] for name in ('lla','gpsvel')})
+        log.update({name: mdic[name] for name in ('imuFs','Rpos','Rvel','Rmag')})
+        log['refloc'] = refloc[k]
+        logs.append(log)
+    return logs
+
+
+'''
+ATE and RTE of classical_ekf_imu_gnss.m
+
+The horizontal position error is averaged over the log (ATE). RTE averages the errors of samples j..j+6000 of every
+one-minute block (j = 1, 6001, ... up to the last full block, 1-based as in the script) divided by the number of
+samples of the whole log, like the script; it is nan for logs shorter than one minute.
+
+'''
+
+def classical_ekf_metrics(p, truePos, block=6000):
+    p = np.asarray(p)
+    truePos = np.asarray(truePos)
+    n = truePos.shape[0]
+    distance = np.sqrt((p[:,0]-truePos[:,0])**2 + (p[:,1]-truePos[:,1])**2)
+    ate = np.sum(distance)/n
+    starts = np.arange(0, n-n%block, block)
+    if len(starts) == 0:
+        return ate, np.nan
+    csum = np.concatenate(([0.0],np.cumsum(distance)))
+    stops = np.minimum(starts+block+1, n)
+    rte = np.mean((csum[stops]-csum[starts])/n)
+    return ate, rte
+
+
+#largest difference between positions and the p saved from classical_ekf_imu_gnss.m (array or .mat file with p)
+def compare_with_matlab(p, matlab_p, key='p'):
+    if isinstance(matlab_p, str):
+        from scipy.io import loadmat
+        matlab_p = loadmat(matlab_p)[key]
+    matlab_p = np.asarray(matlab_p)
+    return float(np.max(np.abs(np.asarray(p)[:,0:matlab_p.shape[1]]-matlab_p)))
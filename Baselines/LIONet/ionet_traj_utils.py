@@ -1,12 +1,202 @@
 from math import atan2, pi, sqrt, atan2, sin, cos, radians, ceil
 import math
+import os
+import json
+import hashlib
 import numpy as np
 
+
+'''
+window range of a trajectory in the stacked (windowed) arrays
+
+inputs:
+size_of_each: number of windows of each trajectory, or a TrajectorySet (see data_utils), whose precomputed
+offsets are then used
+file_idx: index of the trajectory
+
+outputs:
+start, stop: trajectory file_idx is windows start:stop
+
+'''
+
+def traj_offsets(size_of_each):
+    if hasattr(size_of_each, 'offsets'):
+        return size_of_each.offsets
+    return np.concatenate(([0],np.cumsum(size_of_each))).astype(int)
+
+def traj_bounds(size_of_each, file_idx):
+    offsets = traj_offsets(size_of_each)
+    return int(offsets[file_idx]), int(offsets[file_idx+1])
+
+
+'''
+dead reckoning of a batch of trajectories with cumulative sums
+
+The steps of all trajectories are laid out as in the stacked windowed arrays (trajectory k is
+offsets[k]:offsets[k+1]), they are padded to the longest trajectory and summed along time, starting from x0/y0.
+The sum is sequential like the Lx = Lx + step loop of the position generators.
+
+inputs:
+step_x, step_y: x and y displacement of every window (in m)
+size_of_each: number of windows of each trajectory, or a TrajectorySet
+x0_list, y0_list: initial coordinates for each trajectory
+
+outputs:
+pos_x, pos_y: x and y position after every window (in m), same layout as step_x and step_y
+
+'''
+
+def integrate_steps(step_x, step_y, size_of_each, x0_list, y0_list):
+    offsets = traj_offsets(size_of_each)
+    lengths = np.diff(offsets)
+    padded = np.zeros((2,len(lengths),np.max(lengths,initial=0)+1))
+    padded[0,:,0] = x0_list[0:len(lengths)]
+    padded[1,:,0] = y0_list[0:len(lengths)]
+    valid = np.arange(padded.shape[2]-1) < lengths.reshape(-1,1)
+    padded[0,:,1:][valid] = step_x[offsets[0]:offsets[-1]]
+    padded[1,:,1:][valid] = step_y[offsets[0]:offsets[-1]]
+    np.cumsum(padded,axis=2,out=padded)
+    return padded[0,:,1:][valid], padded[1,:,1:][valid]
+
+#displacement (in m per window_size-stride samples) and heading (in rad) to positions
+def integrate_displacement_heading(disp, head, size_of_each, x0_list, y0_list, window_size, stride):
+    step = np.asarray(disp)/(((window_size-stride)/stride))
+    return integrate_steps(step*np.cos(head), step*np.sin(head), size_of_each, x0_list, y0_list)
+
+#one value per window from a keras output (n X ... array), the mean over the other axes
+def window_means(y_pred):
+    y_pred = np.asarray(y_pred)
+    return np.mean(y_pred.reshape(y_pred.shape[0],-1),axis=1)
+
+
+'''
+one-shot prediction of a whole split, cached on disk
+
+The concatenated network input of all trajectories is predicted with a single predict call and a large batch,
+instead of one call per trajectory; split_by_trajectory then gives the outputs of each trajectory. With
+cache_dir and model_file, the outputs are saved as cache_dir/<key>.npz, the key being the SHA-1 of the model file,
+the dataset key and a sample of the input windows, so evaluating the same model on the same split again only loads
+them.
+
+inputs:
+net_inp_mat: the processed and windowed NN input of the whole split (a list of arrays for multi-input models)
+my_model: the neural network in keras, or anything with predict(x, batch_size=...)
+model_file: saved model (e.g. Agrobot_First_TCN.hdf5), hashed for the cache key; no caching when None
+cache_dir: prediction cache folder, None to disable the cache
+dataset_key: key of the dataset (e.g. TrajectorySet.key); the key then only hashes the dtype and at most 256 evenly
+strided windows of each input, which still tells a changed preprocessing of the same import apart; None to hash all of
+net_inp_mat
+batch_size: prediction batch size, None for prediction_batch_size(net_inp_mat)
+
+outputs:
+y_pred: list of the model outputs for all windows
+
+'''
+
+#largest batch whose input fits in target_bytes (float32)
+def prediction_batch_size(net_inp_mat, target_bytes=2**26, min_batch=256):
+    inputs = net_inp_mat if isinstance(net_inp_mat, (list, tuple)) else [net_inp_mat]
+    window_bytes = sum(4*int(np.prod(np.shape(x)[1:])) for x in inputs)
+    return int(max(min_batch, min(len(inputs[0]), target_bytes//max(window_bytes,1))))
+
+def prediction_cache_key(net_inp_mat, my_model, model_file, dataset_key):
+    inputs = net_inp_mat if isinstance(net_inp_mat, (list, tuple)) else [net_inp_mat]
+    h = hashlib.sha1()
+    with open(model_file, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            h.update(block)
+    h.update(type(my_model).__name__.encode())
+    h.update(json.dumps([np.shape(x) for x in inputs]).encode())
+    for x in inputs:
+        x = np.asarray(x)
+        h.update(x.dtype.str.encode())
+        if dataset_key is not None:
+            x = x[::max(1, int(ceil(len(x)/256)))]
+        h.update(np.ascontiguousarray(x))
+    if dataset_key is not None:
+        h.update(str(dataset_key).encode())
+    return h.hexdigest()
+
+def predict_split(net_inp_mat, my_model, model_file=None, cache_dir=None, dataset_key=None, batch_size=None):
+    path = None
+    if cache_dir is not None and model_file is not None:
+        path = os.path.join(cache_dir, prediction_cache_key(net_inp_mat, my_model, model_file, dataset_key)+'.npz')
+        if os.path.exists(path):
+            with np.load(path) as cached:
+                return [cached['y_pred_{}'.format(i)] for i in range(len(cached.files))]
+    if batch_size is None:
+        batch_size = prediction_batch_size(net_inp_mat)
+    y_pred = my_model.predict(net_inp_mat, batch_size=batch_size)
+    if not isinstance(y_pred, (list, tuple)):
+        y_pred = [y_pred]
+    y_pred = [np.asarray(y) for y in y_pred]
+    if path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = path+'.{}.tmp'.format(os.getpid())
+        with open(tmp, 'wb') as f:
+            np.savez(f, **{'y_pred_{}'.format(i): y for i, y in enumerate(y_pred)})
+        os.replace(tmp, path)
+    return y_pred
+
+#views of a stacked array (windows of all trajectories), one per trajectory
+def split_by_trajectory(values, size_of_each):
+    offsets = traj_offsets(size_of_each)
+    return [values[offsets[k]:offsets[k+1]] for k in range(len(offsets)-1)]
+
+
 def abs_heading(cur_x, cur_y, prev_x, prev_y):
         dely = (cur_y - prev_y)
         delx = (cur_x - prev_x)
         delh= atan2(delx,dely)*57.2958
         return delh
+
+
+'''
+displacement and relative heading labels of every window at once, as the label cells of the baseline notebooks
+
+The heading of a window is the direction of its ground truth displacement, abs_heading of its last and first
+position (atan2(dx,dy) in degrees), moved to [0,360) by adding 180 below 180. The label is the change from the
+previous window (from 0 for the first one), taken the other way round the circle when it is beyond +-100 degrees.
+Windows are in the stacked order of the notebook loop, so the previous window of the first window of a trajectory is
+the last window of the trajectory before it. A label only depends on the headings of its window and of the previous
+one, so all of them are computed with array operations instead of one abs_heading call per window. The labels are
+those of the loop; np.arctan2 may differ from math.atan2 in the last bit on builds with SIMD trigonometry.
+
+inputs:
+Y_pos: windowed ground truth positions (n X window_size X 2), or one array per trajectory (as_views imports)
+x_vel, y_vel: windowed x and y velocities, None for the heading labels only
+
+outputs:
+disp: displacement of every window, sqrt(x_vel^2 + y_vel^2) (None without velocities)
+heading: relative heading of every window (in degrees, the models are trained on heading*0.0174533)
+
+usage:
+disp_train, heading_train = displacement_heading_labels(Y_Pos_train, x_vel_train, y_vel_train)
+
+'''
+
+def window_headings(Y_pos):
+    if isinstance(Y_pos, (list, tuple)):
+        first = np.concatenate([np.asarray(w)[:,0,:] for w in Y_pos],axis=0)
+        last = np.concatenate([np.asarray(w)[:,-1,:] for w in Y_pos],axis=0)
+    else:
+        Y_pos = np.asarray(Y_pos)
+        first = Y_pos[:,0,:]
+        last = Y_pos[:,-1,:]
+    theta = np.arctan2(last[:,0]-first[:,0], last[:,1]-first[:,1])*57.2958
+    return np.where(theta<180, theta+180, theta)
+
+def displacement_heading_labels(Y_pos, x_vel=None, y_vel=None):
+    theta = window_headings(Y_pos)
+    prev = np.zeros_like(theta)
+    prev[1:] = theta[:-1]
+    heading = theta - prev
+    wrap = (heading>100) | (heading<-100)
+    heading[wrap] = np.where(theta[wrap]<prev[wrap], (theta[wrap]+360)-prev[wrap], theta[wrap]-(prev[wrap]+360))
+    disp = None
+    if x_vel is not None:
+        disp = np.sqrt((np.asarray(x_vel)**2) + (np.asarray(y_vel)**2))
+    return disp, heading
    
 '''
 generate trajectory from neural network predicted heading and displacement for specific file
@@ -19,6 +209,7 @@ x0_list, y0_list: initial coordinates for each trajectory
 window_size and stride: input window size and stride for training set
 file_idx: index of the file to be considered
 my_model: the neural network in keras, loaded using model.load(MODEL_NAME.h5)
+as_array: return NumPy arrays instead of lists
 
 outputs:
 Pvx, Pvy: predicted x and y position (in m)
@@ -26,33 +217,47 @@ Pvx, Pvy: predicted x and y position (in m)
 '''
     
 def ionet_pos_generator(net_inp_mat, size_of_each, 
-                   x0_list, y0_list, window_size, stride,file_idx,my_model):
+                   x0_list, y0_list, window_size, stride,file_idx,my_model, as_array=False):
     
-    if (file_idx == 0):
-        cur_inp = net_inp_mat[0:size_of_each[0],:,:]
-    elif (file_idx == 1):
-        cur_inp = net_inp_mat[np.sum(size_of_each[0]):np.sum(size_of_each[0:file_idx+1]),:,:]
-
-    else:
-        cur_inp = net_inp_mat[np.sum(size_of_each[0:file_idx]):np.sum(size_of_each[0:file_idx+1]),:,:]    
+    start, stop = traj_bounds(size_of_each, file_idx)
+    cur_inp = net_inp_mat[start:stop,:,:]
     
     y_pred = my_model.predict(cur_inp)
     
-    pointx = []
-    pointy = []
-    Lx =  x0_list[file_idx]
-    Ly = y0_list[file_idx]
-    for i in range(len(cur_inp)):
-        Lx = Lx + (np.mean(y_pred[0][i])/(((window_size-stride)/stride)))*cos(np.mean(y_pred[1][i]))
-        Ly = Ly + (np.mean(y_pred[0][i])/(((window_size-stride)/stride)))*sin(np.mean(y_pred[1][i]))
-        pointx.append(Lx)
-        pointy.append(Ly)
-    Pvx = pointx
-    Pvy = pointy   
+    Pvx, Pvy = integrate_displacement_heading(window_means(y_pred[0]), window_means(y_pred[1]), [stop-start],
+                                              x0_list[file_idx:file_idx+1], y0_list[file_idx:file_idx+1], window_size, stride)
+    if not as_array:
+        Pvx, Pvy = Pvx.tolist(), Pvy.tolist()
     
     return Pvx, Pvy
 
 
+'''
+predicted trajectories of all files of a split with one prediction of the whole net_inp_mat (see predict_split)
+
+inputs:
+net_inp_mat, size_of_each, x0_list, y0_list, window_size, stride, my_model: as ionet_pos_generator
+model_file, cache_dir, dataset_key, batch_size: prediction cache and batch size (see predict_split)
+as_array: return NumPy arrays instead of lists
+
+outputs:
+Pvx_list, Pvy_list: predicted x and y position (in m) of each trajectory
+
+'''
+
+def ionet_pos_generator_all(net_inp_mat, size_of_each, x0_list, y0_list, window_size, stride, my_model,
+                            model_file=None, cache_dir=None, dataset_key=None, batch_size=None, as_array=False):
+    y_pred = predict_split(net_inp_mat, my_model, model_file, cache_dir, dataset_key, batch_size)
+    Pvx, Pvy = integrate_displacement_heading(window_means(y_pred[0]), window_means(y_pred[1]), size_of_each,
+                                              x0_list, y0_list, window_size, stride)
+    Pvx_list = split_by_trajectory(Pvx, size_of_each)
+    Pvy_list = split_by_trajectory(Pvy, size_of_each)
+    if not as_array:
+        Pvx_list = [p.tolist() for p in Pvx_list]
+        Pvy_list = [p.tolist() for p in Pvy_list]
+    return Pvx_list, Pvy_list
+
+
 '''
 generate trajectory from ground truth displacement and heading for specific file
 
@@ -62,6 +267,7 @@ size_of_each: index of new trajectory in windowed files
 x0_list, y0_list: initial coordinates for each trajectory 
 window_size and stride: input window size and stride for training set
 file_idx: index of the file to be considered
+as_array: return NumPy arrays instead of lists
 
 outputs:
 Gvx, Gvy: x and y position (in m)
@@ -69,30 +275,16 @@ Gvx, Gvy: x and y position (in m)
 '''
 
 def ionet_GT_pos_generator(disp, head, size_of_each, 
-                   x0_list, y0_list, window_size, stride,file_idx):  
-    if (file_idx == 0):
-        disp_sel = disp[0:size_of_each[0]]
-        head_sel = head[0:size_of_each[0]]
-    elif (file_idx == 1):
-        disp_sel = disp[np.sum(size_of_each[0]):np.sum(size_of_each[0:file_idx+1])]
-        head_sel = head[np.sum(size_of_each[0]):np.sum(size_of_each[0:file_idx+1])]
-
-    else:
-        disp_sel = disp[np.sum(size_of_each[0:file_idx]):np.sum(size_of_each[0:file_idx+1])]
-        head_sel = head[np.sum(size_of_each[0:file_idx]):np.sum(size_of_each[0:file_idx+1])]
+                   x0_list, y0_list, window_size, stride,file_idx, as_array=False):  
+    start, stop = traj_bounds(size_of_each, file_idx)
+    disp_sel = disp[start:stop]
+    head_sel = head[start:stop]
 
     head_sel = head_sel*0.0174533
-    pointx = []
-    pointy = []
-    Lx =  x0_list[file_idx]
-    Ly = y0_list[file_idx]
-    for i in range(len(disp_sel)):
-        Lx = Lx + (disp_sel[i]/(((window_size-stride)/stride)))*cos(head_sel[i])
-        Ly = Ly + (disp_sel[i]/(((window_size-stride)/stride)))*sin(head_sel[i])  
-        pointx.append(Lx)
-        pointy.append(Ly)   
-    Gvx = pointx
-    Gvy = pointy
+    Gvx, Gvy = integrate_displacement_heading(disp_sel, head_sel, [stop-start],
+                                              x0_list[file_idx:file_idx+1], y0_list[file_idx:file_idx+1], window_size, stride)
+    if not as_array:
+        Gvx, Gvy = Gvx.tolist(), Gvy.tolist()
     
     return Gvx, Gvy
 
@@ -118,29 +310,21 @@ def Cal_TE(Gvx, Gvy, Pvx, Pvy, sampling_rate=100,window_size=200,stride=10,lengt
     if length==None:
         length = len(Gvx)
         
-    distance = []
+    dx = np.asarray(Gvx[0:length],dtype=float)-np.asarray(Pvx[0:length],dtype=float)
+    dy = np.asarray(Gvy[0:length],dtype=float)-np.asarray(Pvy[0:length],dtype=float)
+    distance = np.sqrt(dx*dx + dy*dy)
     
-    for i in range(length):
-        d = ((Gvx[i]-Pvx[i])*(Gvx[i]-Pvx[i])) + ((Gvy[i]-Pvy[i])*(Gvy[i]-Pvy[i]))
-        d = math.sqrt(d)
-        distance.append(d)
-    
-    mean_distance = sum(distance)/len(distance)
-    ate = mean_distance
-    at_all = distance
+    ate = float(np.mean(distance))
+    at_all = distance.tolist()
     
     n_windows_one_min= int(((sampling_rate*60)-window_size)/stride)
-    distance = []
     if(n_windows_one_min < length):
-        for i in range(n_windows_one_min):
-            d = ((Gvx[i]-Pvx[i])*(Gvx[i]-Pvx[i])) + ((Gvy[i]-Pvy[i])*(Gvy[i]-Pvy[i]))
-            d = math.sqrt(d)
-            distance.append(d)
-        rte = sum(distance)/len(distance)
+        rt_all = at_all[0:n_windows_one_min]
+        rte = float(np.mean(distance[0:n_windows_one_min]))
     else:
+        rt_all = []
         rte=ate*(n_windows_one_min/length)
     
-    rt_all = distance
     return ate, rte, at_all, rt_all
 
 
@@ -158,13 +342,9 @@ def Cal_len_meters(Gvx, Gvy, length=None):
     if length==None:
         length = len(Gvx)
         
-    distance = []
-    
-    for i in range(1, length):
-        d = ((Gvx[i]-Gvx[i-1])*(Gvx[i]-Gvx[i-1])) + ((Gvy[i]-Gvy[i-1])*(Gvy[i]-Gvy[i-1]))
-        d = math.sqrt(d)
-        distance.append(d)
+    dx = np.diff(np.asarray(Gvx[0:length],dtype=float))
+    dy = np.diff(np.asarray(Gvy[0:length],dtype=float))
     
-    sum_distance = sum(distance)
+    sum_distance = float(np.sum(np.sqrt(dx*dx + dy*dy)))
     
     return sum_distance  
\ No newline at end of file
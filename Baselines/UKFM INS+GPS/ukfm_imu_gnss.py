@@ -0,0 +1,352 @@
+import numpy as np
+from math import sqrt, radians
+
+
+'''
+NumPy port of main_imugnss.m (UKF on parallelizable manifolds, UKF-M, for IMU + GNSS position fusion)
+
+The state is (Rot, v, p, b_gyro, b_acc), 15 dimensional in the tangent space. Every filter step follows
+ukf_propagation.m, ukf_jacobian_update.m and kf_update.m, but the sigma points are not looped over: all sigma points
+of all trajectories (the mean, the 2 X 15 state sigma points and the 2 X 6 noise sigma points) go through
+imu_gnss_kitti_f and the retraction in one vectorized call, so a step costs a few batched NumPy operations however
+many trajectories are filtered together. Trajectories of different lengths are padded, and every trajectory keeps
+its own GNSS schedule (one_hot_ys) and measurement counter, as in the script.
+
+retraction 'so3' is the one of the script (imu_gnss_kitti_phi: SO(3) exponential for the orientation, vector
+addition for the rest), 'se23' the SE_2(3) one of imu_gnss_kitti_right_phi (se_k_3_exp/se_k_3_log on the
+orientation, velocity and position).
+
+inputs (ukfm_imu_gnss_batch):
+trajs: list of dictionaries with gyro and acc (N X 3), ys (n_meas X 3 GNSS positions), one_hot_ys (N) and t (N),
+see ukfm_inputs / ukfm_inputs_from_mat
+n0: first filtered sample (1-based, as in the script)
+imu_noise_std: gyro, accelerometer, gyro bias and accelerometer bias noise standard deviations
+gps_noise_std: GNSS position noise standard deviation (m)
+alpha: sigma point parameters
+retraction: 'so3' or 'se23'
+
+outputs:
+list of N X 3 positions, one per trajectory (samples before n0 keep the initial position)
+
+usage:
+trajs = [ukfm_inputs(accel, gyro, truePos, imuFs, rng=rng) for accel, gyro, truePos in logs]
+positions = ukfm_imu_gnss_batch(trajs)
+ate, rte = ukfm_metrics(positions[0], truePos)
+
+'''
+
+TOL = 1e-9
+GRAVITY = np.array((0.0, 0.0, 9.82))
+GYROSCOPE_ARW = (3.09, 2.7, 5.4) #deg/sqrt(hr)
+GYROSCOPE_BI = (88.91, 78.07, 211.4) #deg/hr
+
+#imu_noise_std of main_imugnss.m
+def imu_noise_std_script(imuFs=100):
+    gyroscope_bias_noise = [((radians(a)/60.0)*sqrt(1/imuFs))**2 + (radians(b)/3600.0)**2
+                            for a, b in zip(GYROSCOPE_ARW, GYROSCOPE_BI)]
+    return (sqrt(0.0000030462), sqrt(0.0011858), sqrt(np.mean(gyroscope_bias_noise)), sqrt(2e-4))
+
+
+'''
+geometry: batched versions of the geometry folder, every argument has any number of leading dimensions
+
+'''
+
+I3 = np.identity(3)
+#so3_wedge(phi) = phi@WEDGE_MAP, reshaped to 3 X 3
+WEDGE_MAP = np.array(((0,0,0,0,0,-1,0,1,0),(0,0,1,0,0,0,-1,0,0),(0,-1,0,1,0,0,0,0,0)),dtype=float)
+
+def so3_wedge(phi):
+    return (phi@WEDGE_MAP).reshape(phi.shape[:-1]+(3,3))
+
+def so3_vee(Phi):
+    return np.stack((Phi[...,2,1], Phi[...,0,2], Phi[...,1,0]),axis=-1)
+
+#angle, unit axis (phi where the angle is below TOL, for the Taylor expansions) and small angle mask
+def axis_angle(phi):
+    angle = np.linalg.norm(phi,axis=-1)
+    small = angle < TOL
+    axis = phi/np.where(small, 1.0, angle)[...,None]
+    return angle, axis, small
+
+#Rodrigues formula, I + sin(angle)/angle*W + (1-cos(angle))/angle^2*W@W, and I + W near 0
+def so3_exp(phi):
+    angle = np.sqrt(np.sum(phi*phi,axis=-1))
+    small = angle < TOL
+    angle = np.where(small, 1.0, angle)
+    a = np.where(small, 1.0, np.sin(angle)/angle)[...,None,None]
+    b = np.where(small, 0.0, (1-np.cos(angle))/angle**2)[...,None,None]
+    W = so3_wedge(phi)
+    return I3 + a*W + b*(W@W)
+
+def so3_log(Rot):
+    cos_angle = np.clip(0.5*np.trace(Rot,axis1=-2,axis2=-1) - 0.5, -1, 1)
+    angle = np.arccos(cos_angle)
+    small = angle < TOL
+    scale = np.where(small, 1.0, 0.5*angle/np.where(small, 1.0, np.sin(angle)))[...,None,None]
+    return so3_vee(np.where(small[...,None,None], Rot-I3, scale*(Rot-np.swapaxes(Rot,-1,-2))))
+
+def so3_left_jacobian(phi):
+    angle, axis, small = axis_angle(phi)
+    angle = np.where(small, 1.0, angle)
+    s = (np.sin(angle)/angle)[...,None,None]
+    c = ((1-np.cos(angle))/angle)[...,None,None]
+    J = s*I3 + (1-s)*(axis[...,:,None]*axis[...,None,:]) + c*so3_wedge(axis)
+    return np.where(small[...,None,None], I3 - 0.5*so3_wedge(phi), J)
+
+def so3_inv_left_jacobian(phi):
+    angle, axis, small = axis_angle(phi)
+    half_angle = 0.5*np.where(small, 1.0, angle)
+    hcot = (half_angle/np.tan(half_angle))[...,None,None]
+    J = hcot*I3 + (1-hcot)*(axis[...,:,None]*axis[...,None,:]) - half_angle[...,None,None]*so3_wedge(axis)
+    return np.where(small[...,None,None], I3 - 0.5*so3_wedge(phi), J)
+
+#xi = [phi; xi_1; ...; xi_k] -> (3+k) X (3+k) element of SE_k(3)
+def se_k_3_exp(xi):
+    k = xi.shape[-1]//3 - 1
+    chi = np.zeros(xi.shape[:-1]+(3+k,3+k))
+    chi[...,0:3,0:3] = so3_exp(xi[...,0:3])
+    chi[...,0:3,3:] = so3_left_jacobian(xi[...,0:3])@xi[...,3:].reshape(xi.shape[:-1]+(k,3)).swapaxes(-1,-2)
+    chi[...,3:,3:] = np.identity(k)
+    return chi
+
+def se_k_3_log(chi):
+    phi = so3_log(chi[...,0:3,0:3])
+    Xi = so3_inv_left_jacobian(phi)@chi[...,0:3,3:]
+    return np.concatenate((phi, Xi.swapaxes(-1,-2).reshape(phi.shape[:-1]+(-1,))),axis=-1)
+
+def se_k_3_inv(chi):
+    chi_inv = np.zeros_like(chi)
+    Rt = chi[...,0:3,0:3].swapaxes(-1,-2)
+    chi_inv[...,0:3,0:3] = Rt
+    chi_inv[...,0:3,3:] = -Rt@chi[...,0:3,3:]
+    chi_inv[...,3:,3:] = np.identity(chi.shape[-1]-3)
+    return chi_inv
+
+
+'''
+model: the state is Rot (... X 3 X 3) and x = [v, p, b_gyro, b_acc] (... X 12)
+
+'''
+
+#imu_gnss_kitti_f, w: gyro and accelerometer noise (... X 6)
+def imu_gnss_f(Rot, x, gyro, acc, w, dt):
+    dt = np.asarray(dt)[...,None]
+    gyro = gyro - x[...,6:9] + w[...,0:3]
+    acc = (Rot@(acc - x[...,9:12] + w[...,3:6])[...,None])[...,0] - GRAVITY
+    x_new = x.copy()
+    x_new[...,0:3] = x[...,0:3] + acc*dt
+    x_new[...,3:6] = x[...,3:6] + x[...,0:3]*dt + 0.5*acc*dt**2
+    return Rot@so3_exp(gyro*dt), x_new
+
+#imu_gnss_kitti_phi and imu_gnss_kitti_phi_inv
+def so3_phi(Rot, x, xi):
+    return so3_exp(xi[...,0:3])@Rot, x + xi[...,3:15]
+
+def so3_phi_inv(Rot, x, Rot_hat, x_hat):
+    return np.concatenate((so3_log(Rot_hat@Rot.swapaxes(-1,-2)), x_hat-x),axis=-1)
+
+#imu_gnss_kitti_right_phi and imu_gnss_kitti_right_phi_inv, on SE_2(3)
+def se23_phi(Rot, x, xi):
+    chi = se_k_3_exp(xi[...,0:9])
+    dR = chi[...,0:3,0:3]
+    x_new = x + xi[...,3:15]
+    x_new[...,0:6] = (dR@x[...,0:6].reshape(x.shape[:-1]+(2,3)).swapaxes(-1,-2)
+                      + chi[...,0:3,3:5]).swapaxes(-1,-2).reshape(x_new.shape[:-1]+(6,))
+    return dR@Rot, x_new
+
+def se23_phi_inv(Rot, x, Rot_hat, x_hat):
+    chi = np.zeros(x_hat.shape[:-1]+(5,5))
+    dR = Rot_hat@Rot.swapaxes(-1,-2)
+    chi[...,0:3,0:3] = dR
+    chi[...,0:3,3:5] = (x_hat[...,0:6].reshape(x_hat.shape[:-1]+(2,3)).swapaxes(-1,-2)
+                        - dR@x[...,0:6].reshape(x.shape[:-1]+(2,3)).swapaxes(-1,-2))
+    chi[...,3:5,3:5] = np.identity(2)
+    return np.concatenate((se_k_3_log(chi), x_hat[...,6:12]-x[...,6:12]),axis=-1)
+
+RETRACTIONS = {'so3': (so3_phi, so3_phi_inv), 'se23': (se23_phi, se23_phi_inv)}
+
+
+#ukf_set_weight.m
+def ukf_set_weight(d, q, alpha):
+    def weights(n, a, a_c):
+        lam = (a**2 - 1)*n
+        return {'sqrt_lambda': sqrt(n + lam), 'wj': 1/(2*(n + lam)), 'wm0': lam/(lam + n),
+                'wc0': lam/(lam + n) + 3 - a_c**2}
+    return {'d': weights(d, alpha[0], alpha[0]), 'q': weights(q, alpha[0], alpha[1]),
+            'u': weights(d, alpha[2], alpha[2])}
+
+#weighted covariance of centred tangent vectors xis (... X n X d) and their mean
+def sigma_covariance(xis, w):
+    xi_mean = w['wj']*np.sum(xis,axis=-2)
+    xis = xis - xi_mean[...,None,:]
+    return w['wj']*(xis.swapaxes(-1,-2)@xis) + w['wc0']*(xi_mean[...,:,None]*xi_mean[...,None,:])
+
+
+'''
+one propagation (ukf_propagation.m) and one GNSS update (ukf_jacobian_update.m + kf_update.m) of M filters
+
+inputs:
+Rot, x, P: states and covariances of the filters (M X 3 X 3, M X 12, M X 15 X 15)
+gyro, acc, dt: IMU sample and time step of every filter (M X 3, M X 3, M)
+cholQ: 6 X 6 Cholesky factor of the gyro and accelerometer noise
+y: GNSS positions (M X 3), R: 3 X 3 GNSS noise covariance
+weights: ukf_set_weight, retraction: pair of functions of RETRACTIONS
+
+'''
+
+def ukf_propagation(Rot, x, P, gyro, acc, dt, cholQ, weights, retraction):
+    phi, phi_inv = retraction
+    w_d, w_q = weights['d'], weights['q']
+    M, d = P.shape[0], P.shape[-1]
+    q = cholQ.shape[0]
+    #sigma points in the tangent space: the mean, +-columns of chol(P) and the noise sigma points
+    xis = np.zeros((M,1+2*d+2*q,d))
+    L = np.linalg.cholesky(P + TOL*np.identity(d))
+    xis[:,1:1+d] = w_d['sqrt_lambda']*L.swapaxes(-1,-2)
+    xis[:,1+d:1+2*d] = -xis[:,1:1+d]
+    noise = np.zeros((1+2*d+2*q,q))
+    noise[1+2*d:1+2*d+q] = w_q['sqrt_lambda']*cholQ.T
+    noise[1+2*d+q:] = -noise[1+2*d:1+2*d+q]
+
+    Rot_s, x_s = phi(Rot[:,None], x[:,None], xis)
+    Rot_s, x_s = imu_gnss_f(Rot_s, x_s, gyro[:,None], acc[:,None], noise, dt[:,None])
+    Rot_new, x_new = Rot_s[:,0], x_s[:,0]
+    xis_new = phi_inv(Rot_new[:,None], x_new[:,None], Rot_s[:,1:], x_s[:,1:])
+    P_new = sigma_covariance(xis_new[:,0:2*d], w_d) + sigma_covariance(xis_new[:,2*d:], w_q)
+    return Rot_new, x_new, P_new
+
+def ukf_gnss_update(Rot, x, P, y, R, weights, retraction, idxs=slice(3,6), p_idxs=slice(6,9)):
+    phi, _ = retraction
+    w_u = weights['u']
+    d = P.shape[-1]
+    #ukf_jacobian_update with h = position and the up_phi retraction (position + xi)
+    P_red = P[:,p_idxs,p_idxs] + TOL*I3
+    xis = w_u['sqrt_lambda']*np.linalg.cholesky(P_red).swapaxes(-1,-2)
+    xis = np.concatenate((xis, -xis),axis=1)
+    p = x[:,idxs]
+    ys = p[:,None,:] + xis
+    y_bar = w_u['wm0']*p + w_u['wj']*np.sum(ys,axis=1)
+    Y = w_u['wj']*(ys - y_bar[:,None,:]).swapaxes(-1,-2)@xis
+    H = np.zeros((P.shape[0],3,d))
+    H[:,:,p_idxs] = np.linalg.solve(P_red, Y.swapaxes(-1,-2)).swapaxes(-1,-2)
+    r = y - y_bar
+    #kf_update
+    PHt = P@H.swapaxes(-1,-2)
+    K = PHt@np.linalg.inv(H@PHt + R)
+    Rot, x = phi(Rot, x, (K@r[:,:,None])[:,:,0])
+    IKH = np.identity(d) - K@H
+    P = IKH@P@IKH.swapaxes(-1,-2) + K@R@K.swapaxes(-1,-2)
+    return Rot, x, P
+
+
+'''
+inputs of main_imugnss.m from the arrays of the MATLAB export, as parser_for_ukfm.m: the GNSS positions are the
+ground truth plus gaussian noise (gps_noise_std) at every sample, and one_hot_ys marks every sample (gps_period=0)
+or one sample in imuFs*gps_period+1
+
+'''
+
+def ukfm_inputs(accel, gyro, truePos, imuFs, gps_period=0, gps_noise_std=1.5, rng=np.random):
+    n = accel.shape[0]
+    one_hot_ys = np.zeros(n)
+    if gps_period == 0:
+        one_hot_ys[:] = 1
+    else:
+        one_hot_ys[np.arange(1,n+1) % int(imuFs*gps_period+1) == 0] = 1
+        one_hot_ys[0] = 1
+    return {'gyro': np.asarray(gyro,dtype=float), 'acc': np.asarray(accel,dtype=float),
+            'ys': truePos + rng.normal(0, gps_noise_std, truePos.shape), 'one_hot_ys': one_hot_ys,
+            't': np.linspace(0, n/imuFs, n), 'truePos': truePos}
+
+#inputs saved by parser_for_ukfm.m
+def ukfm_inputs_from_mat(file_name):
+    from scipy.io import loadmat
+    mat = loadmat(file_name, simplify_cells=True)
+    omegas = mat['omegas']
+    return {'gyro': np.array([omega['gyro'] for omega in omegas]), 'acc': np.array([omega['acc'] for omega in omegas]),
+            'ys': np.asarray(mat['ys']).T, 'one_hot_ys': np.ravel(mat['one_hot_ys']), 't': np.ravel(mat['t']),
+            'truePos': mat['truePos']}
+
+
+def ukfm_imu_gnss_batch(trajs, n0=100, imu_noise_std=None, gps_noise_std=0.0005, alpha=(1e-2, 1e-2, 1e-2),
+                        retraction='so3'):
+    retraction = RETRACTIONS[retraction]
+    if imu_noise_std is None:
+        imu_noise_std = imu_noise_std_script()
+    M = len(trajs)
+    lengths = np.array([len(traj['t']) for traj in trajs])
+    N = int(np.max(lengths))
+    ukf_Q = np.diag(np.repeat(np.square(imu_noise_std), 3))
+    cholQ = np.linalg.cholesky(ukf_Q).T[0:6,0:6]
+    bias_Q = np.diag(ukf_Q)[6:12]
+    bias_idxs = np.arange(9,15)
+    R = gps_noise_std**2*np.identity(3)
+    #reduced weights of the script (15 states, 3 noise dimensions)
+    red_weights = ukf_set_weight(15, 3, alpha)
+    weights = ukf_set_weight(3, 3, alpha)
+
+    #inputs of every step, padded to the longest trajectory: IMU sample n-1 and dt = t(n)-t(n-1) lead to sample n
+    gyro = np.zeros((N,M,3))
+    acc = np.zeros((N,M,3))
+    dt = np.zeros((N,M))
+    update = np.zeros((N,M),dtype=bool)
+    ys = np.zeros((N,M,3))
+    x0 = np.zeros((M,12))
+    for m, traj in enumerate(trajs):
+        n = lengths[m]
+        gyro[1:n,m] = traj['gyro'][0:n-1]
+        acc[1:n,m] = traj['acc'][0:n-1]
+        dt[1:n,m] = np.diff(traj['t'])
+        traj_ys = np.atleast_2d(traj['ys'])
+        x0[m,3:6] = traj_ys[1] #first GPS measurement, ys(:, 2) in the script
+        #the k-th update (k = 2, 3, ... in the script) uses the k-th measurement
+        steps = np.flatnonzero(np.asarray(traj['one_hot_ys'])[n0-1:n]) + n0-1
+        steps = steps[0:max(len(traj_ys)-1,0)]
+        update[steps,m] = True
+        ys[steps,m] = traj_ys[1:len(steps)+1]
+
+    Rot = np.repeat(I3[None],M,axis=0)
+    x = x0
+    P = np.repeat(np.diag([0.01]*3 + [1.0]*6 + [0.001]*6)[None],M,axis=0)
+    positions = np.repeat(x0[None,:,3:6],N,axis=0)
+    for n in range(n0-1, N):
+        Rot, x, P = ukf_propagation(Rot, x, P, gyro[n], acc[n], dt[n], cholQ, red_weights, retraction)
+        P[:,bias_idxs,bias_idxs] += bias_Q*(dt[n]**2)[:,None]
+        if update[n].any():
+            idx = np.flatnonzero(update[n])
+            if len(idx) == M:
+                Rot, x, P = ukf_gnss_update(Rot, x, P, ys[n], R, weights, retraction)
+            else:
+                Rot[idx], x[idx], P[idx] = ukf_gnss_update(Rot[idx], x[idx], P[idx], ys[n,idx], R, weights,
+                                                           retraction)
+        positions[n] = x[:,3:6]
+    return [positions[0:lengths[m],m] for m in range(M)]
+
+#one trajectory
+def ukfm_imu_gnss(gyro, acc, ys, one_hot_ys, t, **ukf_args):
+    return ukfm_imu_gnss_batch([{'gyro': gyro, 'acc': acc, 'ys': ys, 'one_hot_ys': one_hot_ys, 't': t}],
+                               **ukf_args)[0]
+
+
+'''
+ATE and RTE of main_imugnss.m
+
+The script keeps the estimates of sample 1 and of samples n0..N (N-n0+2 rows) and compares them with the first
+N-n0+2 rows of truePos. The horizontal position error is averaged (ATE); RTE averages the errors of rows j..j+6000
+of every one-minute block divided by the number of rows, nan when there is no full block.
+
+'''
+
+def ukfm_metrics(positions, truePos, n0=100, block=6000):
+    ps = np.concatenate((positions[0:1], positions[n0-1:]),axis=0)
+    truePos = np.asarray(truePos)[0:ps.shape[0]]
+    n = truePos.shape[0]
+    distance = np.sqrt((ps[:,0]-truePos[:,0])**2 + (ps[:,1]-truePos[:,1])**2)
+    ate = np.sum(distance)/n
+    starts = np.arange(0, n-n%block, block)
+    if len(starts) == 0:
+        return ate, np.nan
+    csum = np.concatenate(([0.0],np.cumsum(distance)))
+    stops = np.minimum(starts+block+1, n)
+    return ate, np.mean((csum[stops]-csum[starts])/n)
@@ -0,0 +1,474 @@
+import os
+#CPU only, set before anything imports tensorflow
+os.environ.setdefault('CUDA_VISIBLE_DEVICES', '-1')
+import sys
+import json
+import time
+import platform
+import argparse
+import shutil
+import tempfile
+import importlib
+import numpy as np
+import pandas as pd
+from traj_utils import Cal_TE, Cal_len_meters, GT_pos_generator, integrate_velocities
+from traj_metrics import trajectory_metrics
+from neural_ekf import neural_ekf_gnss_imu, OnlineNeuralEKF
+from kalman_kernel import benchmark_kalman_kernel
+from profiling import StageProfiler
+from evaluate_grid import IMPORTERS
+
+
+'''
+reproducible CPU benchmarks of the data pipeline, the network, the filter and the metrics
+
+The checked-in data is too small to show how the code scales, so the benchmarks run on synthetic logs of any length
+(write_synthetic_dataset) in the column schema of each phase. Every benchmark is timed repeats times and keeps the best
+and the median time; with items (windows, samples, filter steps) it also gives the time per item. Results are written
+to a JSON file, and compared with a saved baseline (compare_results) so that regressions show up as a ratio above
+1+tolerance. Timings are only comparable on the same machine, so the baseline is saved locally (--save-baseline).
+
+benchmarks:
+import: cold import_agrobot_dataset_p* (parsing, windowing and physics channel of every log), storing in and loading
+from the on-disk cache
+windowing: sliding_windows and stack_windows of the synthetic IMU signal
+physics: physics_channel of the synthetic IMU windows
+inference: numpy_tcn.StreamingTCN (or keras) predict and predict_with_gradients
+ekf: neural_ekf_gnss_imu per-window latency (with its profiler stages), OnlineNeuralEKF per-step latency and the
+Kalman kernel step cost
+metrics: GT_pos_generator/integrate_velocities, Cal_TE, Cal_len_meters and trajectory_metrics
+
+usage:
+python benchmarks.py --hours 1 --save-baseline benchmark_baseline.json
+python benchmarks.py --hours 1 --baseline benchmark_baseline.json --out benchmark_results.json
+python benchmarks.py --only ekf metrics --phases 0 --hours 0.25
+
+'''
+
+#columns read by the importers (ground truth, 9DoF IMU, GPS) and the IMU units of each phase
+SCHEMAS = {0: {'gt': ['X','Z'],
+               'imu': ['Ax','Ay','Az','Gx','Gy','Gz','Mx','My','Mz'],
+               'gps': [],
+               'acc_unit': 1.0, #g per g
+               'gyro_unit': 57.2957795}, #dps per rad/s
+           1: {'gt': ['OptiTrackX','OptiTrackZ'],
+               'imu': ['field.linear_acceleration.x_RAW','field.linear_acceleration.y_RAW','field.linear_acceleration.z_RAW',
+                       'field.angular_velocity.x','field.angular_velocity.y','field.angular_velocity.z',
+                       'field.magnetic_field.x','field.magnetic_field.y','field.magnetic_field.z'],
+               'gps': ['field.longitude_GPS','field.latitude_GPS'],
+               'acc_unit': 9.80665, #m/s^2
+               'gyro_unit': 1.0}, #rad/s
+           2: {'gt': ['X','Y'],
+               'imu': ['field_linear_acceleration_x_RAW','field_linear_acceleration_y_RAW','field_linear_acceleration_z_RAW',
+                       'field_angular_velocity_x','field_angular_velocity_y','field_angular_velocity_z',
+                       'field_magnetic_field_x','field_magnetic_field_y','field_magnetic_field_z'],
+               'gps': [],
+               'acc_unit': 9.80665,
+               'gyro_unit': 1.0}}
+
+EARTH_RADIUS = 6378137.0
+
+
+'''
+synthetic log of a ground robot in the column schema of one phase
+
+The robot drives with a piecewise constant speed (0 to 1.5 m/s) and turn rate, held for 2 to 20 s. The accelerometer
+measures the forward, centripetal and gravity accelerations, the gyroscope the turn rate and the magnetometer a
+40 uT horizontal field rotated by the heading, all with white noise and in the units of the phase. GPS (phase 1)
+has one fix per second with 1.5 m of noise and is empty in between, like the aligned logs, and a small fraction of
+the ground truth is missing, so the importers interpolate both.
+
+inputs:
+phase: 0, 1 or 2 (dataset0, dataset1, dataset2)
+duration_s: length of the log in seconds
+sampling_rate: IMU and ground truth sampling rate
+seed: seed of the log, the same seed gives the same file
+gt_dropout: fraction of missing ground truth samples
+scale_factor: the ground truth is written multiplied by it (dataset2, see groundTruthScaleFactors.txt)
+
+outputs:
+DataFrame with the ground truth, IMU and GPS columns of the phase
+
+'''
+
+def synthetic_log(phase, duration_s=3600, sampling_rate=100, seed=0, gt_dropout=0.01, scale_factor=1):
+    rng = np.random.default_rng(seed)
+    schema = SCHEMAS[phase]
+    n = int(duration_s*sampling_rate)
+    dt = 1.0/sampling_rate
+
+    #piecewise constant speed and turn rate
+    n_segments = int(duration_s/2)+1
+    hold = rng.integers(2*sampling_rate, 20*sampling_rate, size=n_segments)
+    segment = np.repeat(np.arange(n_segments), hold)[0:n]
+    speed = np.convolve(rng.uniform(0.0, 1.5, size=n_segments)[segment], np.ones(sampling_rate)/sampling_rate, 'same')
+    yaw_rate = rng.normal(0.0, 0.15, size=n_segments)[segment]
+    heading = np.cumsum(yaw_rate)*dt
+    pos = np.cumsum(np.stack((speed*np.cos(heading), speed*np.sin(heading)),axis=1),axis=0)*dt
+
+    acc = np.empty((n,3))
+    acc[:,0] = np.gradient(speed, dt)
+    acc[:,1] = speed*yaw_rate
+    acc[:,2] = 9.80665
+    gyr = np.zeros((n,3))
+    gyr[:,2] = yaw_rate
+    mag = np.stack((40.0*np.cos(heading), -40.0*np.sin(heading), np.full(n,-30.0)),axis=1)
+    imu = np.concatenate((acc/9.80665*schema['acc_unit'], gyr*schema['gyro_unit'], mag),axis=1)
+    imu = imu + rng.normal(size=imu.shape)*np.array([0.02*schema['acc_unit']]*3 + [0.01*schema['gyro_unit']]*3 + [0.5]*3)
+
+    gt = pos*scale_factor
+    gt[1:][rng.random(n-1) < gt_dropout] = np.nan
+    log = {}
+    for name, column in zip(schema['gt'], gt.T):
+        log[name] = column
+    for name, column in zip(schema['imu'], imu.T):
+        log[name] = column
+    if schema['gps']:
+        lat0, long0 = 34.0689, -118.4452
+        gps = np.full((n,2), np.nan)
+        fixes = np.arange(0, n, sampling_rate)
+        noisy = pos[fixes] + rng.normal(0.0, 1.5, size=(len(fixes),2))
+        gps[fixes,0] = long0 + np.degrees(noisy[:,0]/(EARTH_RADIUS*np.cos(np.radians(lat0))))
+        gps[fixes,1] = lat0 + np.degrees(noisy[:,1]/EARTH_RADIUS)
+        #the last sample is kept so the interpolation of the importer covers the whole log
+        gps[-1] = gps[fixes[-1]]
+        for name, column in zip(schema['gps'], gps.T):
+            log[name] = column
+    return pd.DataFrame(log)
+
+
+'''
+writes a synthetic dataset folder (logs, train.txt, test.txt and groundTruthScaleFactors.txt) for one phase
+
+Existing files with the same settings are kept, so repeated runs reuse the data. The last n_test logs are the test
+split.
+
+outputs:
+dataset folder (with the trailing separator the importers expect)
+
+'''
+
+def write_synthetic_dataset(folder, phase, n_logs=2, duration_s=3600, n_test=1, sampling_rate=100, seed=0):
+    folder = os.path.join(folder, 'synthetic{}_{}x{}s_seed{}'.format(phase, n_logs, int(duration_s), seed))+os.sep
+    os.makedirs(folder, exist_ok=True)
+    names = ['log{}_synthetic.csv'.format(k+1) for k in range(n_logs)]
+    scale_factors = [100+10*k for k in range(n_logs)] if phase == 2 else [1]*n_logs
+    for k, name in enumerate(names):
+        if not os.path.exists(folder+name):
+            log = synthetic_log(phase, duration_s, sampling_rate, seed*1000+k, scale_factor=scale_factors[k])
+            log.to_csv(folder+name+'.tmp', index=False)
+            os.replace(folder+name+'.tmp', folder+name)
+    n_train = max(n_logs-n_test, 1)
+    with open(folder+'train.txt', 'w') as f:
+        f.write('\n'.join(names[0:n_train]))
+    with open(folder+'test.txt', 'w') as f:
+        f.write('\n'.join(names[n_train:] or names[-1:]))
+    with open(folder+'groundTruthScaleFactors.txt', 'w') as f:
+        f.write('\n'.join('{}, {}'.format(name, s) for name, s in zip(names, scale_factors)))
+    return folder
+
+
+#wall time of repeats calls, with the result of the last call; warmup adds an untimed first call
+def time_call(func, repeats=3, warmup=False):
+    if warmup:
+        func()
+    seconds = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = func()
+        seconds.append(time.perf_counter()-start)
+    return seconds, result
+
+def timing_entry(seconds, items=None, **extra):
+    entry = {'seconds': float(np.min(seconds)), 'median_seconds': float(np.median(seconds)), 'repeats': len(seconds)}
+    if items:
+        entry['items'] = int(items)
+        entry['us_per_item'] = entry['seconds']/items*1e6
+    entry.update(extra)
+    return entry
+
+def data_utils_module(dataset_root, phase):
+    folder = os.path.join(dataset_root, 'dataset{}'.format(phase))
+    if folder not in sys.path:
+        sys.path.insert(0, folder)
+    return importlib.import_module('data_utils_{}'.format(phase))
+
+
+def bench_import(data_utils, phase, folder, window_size, stride, repeats, work_dir):
+    importer = getattr(data_utils, IMPORTERS[phase])
+    results = {}
+    profiler = StageProfiler()
+    seconds, trajs = time_call(lambda: importer(dataset_folder=folder, type_flag=1, window_size=window_size,
+                                                stride=stride, as_trajectory_set=True, profiler=profiler), repeats)
+    n_windows = int(np.sum(trajs.size_of_each))
+    stages = profiler.stats()['stages']
+    results['parse'] = timing_entry(seconds, n_windows,
+                                    stages={name: entry['seconds']/repeats for name, entry in stages.items()})
+    cache_dir = tempfile.mkdtemp(dir=work_dir)
+    start = time.perf_counter()
+    importer(dataset_folder=folder, type_flag=1, window_size=window_size, stride=stride, cache_dir=cache_dir)
+    results['cache_store'] = timing_entry([time.perf_counter()-start], n_windows)
+    seconds, _ = time_call(lambda: importer(dataset_folder=folder, type_flag=1, window_size=window_size, stride=stride,
+                                            cache_dir=cache_dir), repeats)
+    results['cache_load'] = timing_entry(seconds, n_windows)
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    return results, trajs
+
+def bench_windowing(data_utils, signal, window_size, stride, repeats):
+    seconds, windows = time_call(lambda: data_utils.sliding_windows(signal, window_size, stride), repeats, True)
+    results = {'sliding_windows': timing_entry(seconds, windows.shape[0])}
+    seconds, _ = time_call(lambda: data_utils.stack_windows([windows], window_size, signal.shape[1]), repeats, True)
+    results['stack_windows'] = timing_entry(seconds, windows.shape[0])
+    return results, windows
+
+def bench_physics(data_utils, windows, repeats):
+    results = {}
+    for dtype in (np.float64, np.float32):
+        seconds, _ = time_call(lambda: data_utils.physics_channel(windows, dtype), repeats, True)
+        results['physics_channel_{}'.format(np.dtype(dtype).name)] = timing_entry(seconds, windows.shape[0])
+    return results
+
+def bench_inference(my_model, net_inp_mat, repeats):
+    results = {}
+    seconds, _ = time_call(lambda: my_model.predict(net_inp_mat), repeats, True)
+    results['predict'] = timing_entry(seconds, net_inp_mat.shape[0])
+    if hasattr(my_model, 'predict_with_gradients'):
+        seconds, _ = time_call(lambda: my_model.predict_with_gradients(net_inp_mat), repeats, True)
+        results['predict_with_gradients'] = timing_entry(seconds, net_inp_mat.shape[0])
+    return results
+
+#filter of one trajectory, imu_windows are its raw 9DoF windows (for the live filter)
+def bench_ekf(my_model, net_inp_mat, x_vel, y_vel, x0, y0, imu_windows, window_size, stride, gps_decimation_factor,
+              repeats):
+    results = {}
+    n = net_inp_mat.shape[0]
+    profiler = StageProfiler()
+    np.random.seed(0)
+    seconds, _ = time_call(lambda: neural_ekf_gnss_imu(net_inp_mat, x_vel, y_vel, [n], [x0], [y0], 0, window_size,
+                                                       stride, gps_decimation_factor, my_model, profiler=profiler),
+                           repeats)
+    stats = profiler.stats()
+    results['neural_ekf_gnss_imu'] = timing_entry(seconds, n,
+                                                  stages={name: entry['seconds_per_item']*1e6
+                                                          for name, entry in stats['stages'].items()},
+                                                  gps_updates_per_window=stats.get('gps_updates_per_window'))
+
+    #live filter on the same samples, one step every stride samples
+    n_steps = min(n, 500)
+    samples = np.concatenate((imu_windows[0,0:window_size-stride,:], imu_windows[0:n_steps,0:stride,:].reshape(-1,9)))
+    def online():
+        ekf = OnlineNeuralEKF(my_model, x0, y0, window_size, stride, profiler)
+        for sample in samples:
+            ekf.push_imu(sample)
+    profiler = StageProfiler()
+    seconds, _ = time_call(online, repeats)
+    latency = profiler.stats()['stages']['total']['latency_percentiles']
+    results['online_step'] = timing_entry(seconds, profiler.counters['windows']//repeats,
+                                          latency_us={str(q): value*1e6 for q, value in latency.items()})
+    n_kernel = 10000
+    kernel = benchmark_kalman_kernel(n_kernel, gps_decimation_factor)
+    results['kalman_kernel'] = {'seconds': kernel['NeuralKalmanKernel.run (us/step)']*n_kernel/1e6,
+                                'items': n_kernel,
+                                'us_per_item': kernel['NeuralKalmanKernel.run (us/step)'],
+                                'step_us_per_item': kernel['NeuralKalmanKernel.predict/update (us/step)']}
+    return results
+
+def bench_metrics(trajs, window_size, stride, repeats):
+    results = {}
+    seconds, (Gvx, Gvy) = time_call(lambda: integrate_velocities(trajs['x_vel'], trajs['y_vel'], trajs,
+                                                                 trajs.x0_list, trajs.y0_list, window_size, stride),
+                                    repeats, True)
+    n_windows = len(Gvx)
+    results['integrate_velocities'] = timing_entry(seconds, n_windows)
+    seconds, _ = time_call(lambda: [GT_pos_generator(trajs['x_vel'], trajs['y_vel'], trajs, trajs.x0_list,
+                                                     trajs.y0_list, window_size, stride, k) for k in range(len(trajs))],
+                           repeats, True)
+    results['GT_pos_generator'] = timing_entry(seconds, n_windows)
+    rng = np.random.default_rng(0)
+    Pvx = Gvx + np.cumsum(rng.normal(size=n_windows))*0.01
+    Pvy = Gvy + np.cumsum(rng.normal(size=n_windows))*0.01
+    seconds, _ = time_call(lambda: Cal_TE(Gvx, Gvy, Pvx, Pvy, 100, window_size, stride), repeats, True)
+    results['Cal_TE'] = timing_entry(seconds, n_windows)
+    seconds, _ = time_call(lambda: Cal_len_meters(Gvx, Gvy), repeats, True)
+    results['Cal_len_meters'] = timing_entry(seconds, n_windows)
+    seconds, _ = time_call(lambda: trajectory_metrics(Gvx, Gvy, Pvx, Pvy, trajs, 100, window_size, stride,
+                                                      segment_step=1), repeats, True)
+    results['trajectory_metrics'] = timing_entry(seconds, n_windows)
+    return results
+
+
+BENCHMARKS = ('import', 'windowing', 'physics', 'inference', 'ekf', 'metrics')
+
+'''
+all benchmarks of one phase
+
+outputs:
+dictionary {'<phase>/<benchmark>/<name>': timing entry}
+
+'''
+
+def run_phase(phase, config, my_model):
+    data_utils = data_utils_module(config['dataset_root'], phase)
+    folder = write_synthetic_dataset(config['work_dir'], phase, config['logs'], config['hours']*3600/config['logs'],
+                                     n_test=1, seed=config['seed'])
+    window_size, stride, repeats = config['window_size'], config['stride'], config['repeats']
+    only = config['only']
+    results = {}
+    def add(name, entries):
+        for key, entry in entries.items():
+            results['p{}/{}/{}'.format(phase, name, key)] = entry
+
+    #the import also gives the windows used by the other benchmarks
+    entries, trajs = bench_import(data_utils, phase, folder, window_size, stride, repeats if 'import' in only else 1,
+                                  config['work_dir'])
+    if 'import' in only:
+        add('import', entries)
+    if 'windowing' in only or 'physics' in only:
+        log = pd.read_csv(folder+'log1_synthetic.csv', usecols=SCHEMAS[phase]['imu'])
+        signal = log[SCHEMAS[phase]['imu']].to_numpy()
+        entries, windows = bench_windowing(data_utils, signal, window_size, stride, repeats)
+        if 'windowing' in only:
+            add('windowing', entries)
+        if 'physics' in only:
+            add('physics', bench_physics(data_utils, windows, repeats))
+    X = trajs['X']
+    P = np.repeat(trajs['Physics_Vec'],window_size).reshape((X.shape[0],window_size,1))
+    net_inp_mat = np.concatenate((X,P),axis=2)
+    if 'inference' in only:
+        add('inference', bench_inference(my_model, net_inp_mat[0:config['inference_windows']], repeats))
+    if 'ekf' in only:
+        #the filter benchmark runs on the first log, shortened to the inference budget
+        n = min(trajs.size_of_each[0], config['inference_windows'])
+        add('ekf', bench_ekf(my_model, net_inp_mat[0:n], trajs['x_vel'][0:n], trajs['y_vel'][0:n], trajs.x0_list[0],
+                             trajs.y0_list[0], X[0:n], window_size, stride, config['decimation'], repeats))
+    if 'metrics' in only:
+        add('metrics', bench_metrics(trajs, window_size, stride, repeats))
+    return results
+
+
+'''
+compares results with a baseline (both as written by main)
+
+Only the benchmarks present in both are compared, on their best time. A ratio above 1+tolerance is a regression,
+below 1/(1+tolerance) an improvement; benchmarks faster than min_seconds in both runs are too noisy to be flagged.
+
+outputs:
+list of (name, baseline seconds, seconds, ratio, status)
+
+'''
+
+def compare_results(results, baseline, tolerance=0.25, min_seconds=1e-3):
+    rows = []
+    for name, entry in results['benchmarks'].items():
+        if name not in baseline['benchmarks']:
+            continue
+        before = baseline['benchmarks'][name]['seconds']
+        ratio = entry['seconds']/before if before > 0 else np.inf
+        if max(before, entry['seconds']) < min_seconds:
+            status = 'ok'
+        elif ratio > 1+tolerance:
+            status = 'REGRESSION'
+        elif ratio < 1/(1+tolerance):
+            status = 'faster'
+        else:
+            status = 'ok'
+        rows.append((name, before, entry['seconds'], ratio, status))
+    return rows
+
+def format_results(results):
+    lines = ['{:<48}{:>12}{:>14}'.format('benchmark', 'seconds', 'us/item')]
+    for name, entry in results['benchmarks'].items():
+        lines.append('{:<48}{:>12.4f}{:>14}'.format(name, entry['seconds'],
+                     '{:.2f}'.format(entry['us_per_item']) if 'us_per_item' in entry else ''))
+    return '\n'.join(lines)
+
+def format_comparison(rows):
+    lines = ['{:<48}{:>12}{:>12}{:>9}  {}'.format('benchmark', 'baseline s', 'seconds', 'ratio', 'status')]
+    for name, before, after, ratio, status in rows:
+        lines.append('{:<48}{:>12.4f}{:>12.4f}{:>9.2f}  {}'.format(name, before, after, ratio, status))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='CPU benchmarks on synthetic Agrobot logs')
+    parser.add_argument('--phases', nargs='+', type=int, default=[0, 1, 2], help='dataset phases (0, 1, 2)')
+    parser.add_argument('--hours', type=float, default=1.0, help='length of the synthetic data of each phase')
+    parser.add_argument('--logs', type=int, default=3, help='synthetic logs per phase, the last one is the test split')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--window-size', type=int, default=100)
+    parser.add_argument('--stride', type=int, default=20)
+    parser.add_argument('--decimation', type=int, default=5, help='GPS decimation factor of the filter benchmarks')
+    parser.add_argument('--inference-windows', type=int, default=2000,
+                        help='windows pushed through the network by the inference and filter benchmarks')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--only', nargs='+', choices=BENCHMARKS, default=list(BENCHMARKS))
+    parser.add_argument('--model', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'PreTrained Models',
+                                                        'Agrobot_First_TCN.hdf5'))
+    parser.add_argument('--backend', choices=['numpy', 'keras'], default='numpy',
+                        help='numpy_tcn.StreamingTCN (no tensorflow needed) or keras')
+    parser.add_argument('--dataset-root', default=os.path.join('..', 'Agrobot Dataset'),
+                        help='folder with dataset0, dataset1 and dataset2 (for the data_utils modules)')
+    parser.add_argument('--work-dir', default=os.path.join(tempfile.gettempdir(), 'agrobot_benchmarks'),
+                        help='synthetic logs and caches, kept between runs')
+    parser.add_argument('--out', default='benchmark_results.json')
+    parser.add_argument('--baseline', default=None, help='results of an earlier run to compare with')
+    parser.add_argument('--save-baseline', default=None, help='also write the results to this baseline file')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='relative slowdown reported as a regression')
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.work_dir, exist_ok=True)
+    config = {'dataset_root': os.path.abspath(args.dataset_root),
+              'work_dir': args.work_dir,
+              'hours': args.hours,
+              'logs': args.logs,
+              'seed': args.seed,
+              'window_size': args.window_size,
+              'stride': args.stride,
+              'decimation': args.decimation,
+              'inference_windows': args.inference_windows,
+              'repeats': args.repeats,
+              'only': args.only}
+    if args.backend == 'numpy':
+        from numpy_tcn import StreamingTCN
+        my_model = StreamingTCN.from_hdf5(args.model)
+    else:
+        from tensorflow.keras.models import load_model
+        from tcn import TCN
+        my_model = load_model(args.model, custom_objects={'TCN':TCN})
+
+    benchmarks = {}
+    for phase in args.phases:
+        benchmarks.update(run_phase(phase, config, my_model))
+    results = {'meta': {'python': platform.python_version(),
+                        'numpy': np.__version__,
+                        'pandas': pd.__version__,
+                        'machine': platform.machine(),
+                        'processor': platform.processor(),
+                        'cpu_count': os.cpu_count(),
+                        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                        'model': os.path.basename(args.model),
+                        'backend': args.backend,
+                        'config': {key: value for key, value in config.items() if key not in ('dataset_root', 'work_dir')},
+                        'phases': args.phases},
+               'benchmarks': benchmarks}
+    for out in (args.out, args.save_baseline):
+        if out is not None:
+            with open(out, 'w') as f:
+                json.dump(results, f, indent=1)
+    print(format_results(results))
+
+    regressions = []
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        settings = {key: value for key, value in baseline['meta'].get('config', {}).items() if key != 'only'}
+        if settings != {key: value for key, value in config.items() if key in results['meta']['config'] and key != 'only'}:
+            print('warning: the baseline was run with other settings', settings)
+        rows = compare_results(results, baseline, args.tolerance)
+        print(format_comparison(rows))
+        regressions = [row for row in rows if row[4] == 'REGRESSION']
+        print('{} regressions out of {} benchmarks'.format(len(regressions), len(rows)))
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
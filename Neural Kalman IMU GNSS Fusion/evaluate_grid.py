@@ -0,0 +1,216 @@
+import os
+import sys
+import time
+import glob
+import argparse
+import importlib
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from traj_utils import GT_pos_generator, gen_GPS_values, GPS_values_from_GPS_xy, traj_bounds
+from traj_metrics import trajectory_metrics
+from neural_ekf import batch_model_jacobian, neural_ekf_from_terms, GPS_POSITION_NOISE_VARIANCE, GPS_VELOCITY_NOISE_VARIANCE
+
+
+'''
+headless neural-Kalman evaluation over a grid of pretrained models, dataset phases and GPS settings
+
+Every (model, phase, trajectory) is one task of a process pool. A task computes the network terms of the
+trajectory once (batch_model_jacobian) and runs the filter for every GPS decimation factor, noise level and
+Monte-Carlo run, so the expensive part does not depend on the size of the GPS grid. The datasets are loaded once
+before the pool starts (forked workers inherit them) and each worker keeps the models it has loaded (load_phase,
+load_model); tasks are ordered by phase and model so a worker mostly reuses them. The synthetic GPS noise of a run
+only depends on the seed, phase, trajectory, decimation factor and run, so all models see the same GPS. One row per run is written to the results table (.csv or .json), and the median/mean ATE and
+RTE of every setting are printed, as in neural_kalman.ipynb.
+
+usage:
+python evaluate_grid.py --phases 0 1 2 --decimation 5 300 --pos-noise-var 2.25 9 --runs 10 --workers 32
+python evaluate_grid.py --models "PreTrained Models/Agrobot_First_TCN.hdf5" --phases 0 --split train --real-gps
+python evaluate_grid.py --phases 0 1 --data-folders /data/synthetic0_2x3600s_seed0 /data/synthetic1_2x3600s_seed0
+
+'''
+
+IMPORTERS = {0: 'import_agrobot_dataset_p1', 1: 'import_agrobot_dataset_p2', 2: 'import_agrobot_dataset_p3'}
+#the data_utils_<phase> importers live in the dataset folders of the repository, wherever the data is
+DATA_UTILS_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Agrobot Dataset')
+
+#trajectories and network input (IMU windows plus the physics channel) of one phase and split, once per process
+@lru_cache(maxsize=None)
+def load_phase(data_folder, phase, type_flag, window_size, stride, cache_dir):
+    module_folder = os.path.abspath(os.path.join(DATA_UTILS_ROOT, 'dataset{}'.format(phase)))
+    if module_folder not in sys.path:
+        sys.path.insert(0, module_folder)
+    data_utils = importlib.import_module('data_utils_{}'.format(phase))
+    trajs = getattr(data_utils, IMPORTERS[phase])(dataset_folder=os.path.join(data_folder, ''), type_flag=type_flag,
+                                                   window_size=window_size, stride=stride, cache_dir=cache_dir,
+                                                   as_trajectory_set=True)
+    X = trajs['X']
+    P = np.repeat(trajs['Physics_Vec'],window_size).reshape((X.shape[0],window_size,1))
+    net_inp_mat = np.concatenate((X,P),axis=2)
+    return trajs, net_inp_mat
+
+@lru_cache(maxsize=None)
+def load_model(model_file, backend):
+    if backend == 'numpy':
+        from numpy_tcn import StreamingTCN
+        return StreamingTCN.from_hdf5(model_file)
+    from tensorflow.keras.models import load_model as keras_load_model
+    from tcn import TCN
+    return keras_load_model(model_file, custom_objects={'TCN':TCN})
+
+
+'''
+all filter runs of one trajectory
+
+inputs:
+task: (model_file, phase, file_idx)
+config: dictionary of the grid settings (see main)
+
+outputs:
+list of result rows (dictionaries)
+
+'''
+
+def evaluate_trajectory(task, config):
+    model_file, phase, file_idx = task
+    window_size, stride = config['window_size'], config['stride']
+    trajs, net_inp_mat = load_phase(config['data_folders'][phase], phase, config['type_flag'], window_size, stride,
+                                    config['cache_dir'])
+    my_model = load_model(model_file, config['backend'])
+    dt = stride/(window_size-stride)
+    start_time = time.perf_counter()
+    start, stop = traj_bounds(trajs, file_idx)
+    T_all, G_all = batch_model_jacobian(net_inp_mat[start:stop,:,:], my_model, dt)
+    jacobian_time = time.perf_counter()-start_time
+    act_x, act_y = GT_pos_generator(trajs['x_vel'], trajs['y_vel'], trajs, trajs.x0_list, trajs.y0_list,
+                                    window_size, stride, file_idx, as_array=True)
+    settings = [(noise, run) for noise in config['noise'] for run in range(config['runs'])]
+    if config['real_gps'] and 'GPS_xy' in trajs.arrays:
+        settings.append(('real', 0))
+    rows = []
+    for decimation_factor in config['decimation']:
+        for noise, run in settings:
+            start_time = time.perf_counter()
+            if noise == 'real':
+                gps = GPS_values_from_GPS_xy(trajs['GPS_xy'], trajs, trajs.x0_list, trajs.y0_list, file_idx,
+                                             decimation_factor)
+                pos_noise_var, velocity_noise_var = np.nan, np.nan
+            else:
+                pos_noise_var, velocity_noise_var = noise
+                rng = np.random.default_rng([config['seed'], phase, file_idx, decimation_factor, run])
+                gps = gen_GPS_values(trajs['x_vel'], trajs['y_vel'], trajs, trajs.x0_list, trajs.y0_list,
+                                     window_size, stride, file_idx, decimation_factor, pos_noise_var,
+                                     velocity_noise_var, rng, as_array=True)
+            pos = neural_ekf_from_terms(T_all, G_all, trajs.x0_list[file_idx], trajs.y0_list[file_idx], *gps, dt,
+                                        decimation_factor)
+            metrics = trajectory_metrics([act_x], [act_y], [pos[:,0]], [pos[:,1]], None, 100, window_size, stride)
+            rows.append({'model': os.path.basename(model_file),
+                         'phase': phase,
+                         'split': 'train' if config['type_flag'] == 1 else 'test',
+                         'file_idx': file_idx,
+                         'log': trajs.names[file_idx],
+                         'gps': 'real' if noise == 'real' else 'synthetic',
+                         'decimation_factor': decimation_factor,
+                         'pos_noise_var': pos_noise_var,
+                         'velocity_noise_var': velocity_noise_var,
+                         'run': run,
+                         'n_windows': stop-start,
+                         'length': metrics['length'][0],
+                         'ate': metrics['ate'][0],
+                         'rte': metrics['rte_first'][0],
+                         'rte_all_segments': metrics['rte'][0],
+                         'jacobian_seconds': jacobian_time,
+                         'filter_seconds': time.perf_counter()-start_time})
+    return rows
+
+def evaluate_task(args):
+    return evaluate_trajectory(*args)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='neural-Kalman evaluation over models x phases x GPS settings')
+    parser.add_argument('--models', nargs='+', default=None,
+                        help='model files (default: every Agrobot_*_TCN*.hdf5 in PreTrained Models)')
+    parser.add_argument('--phases', nargs='+', type=int, default=[0, 1, 2], help='dataset phases (0, 1, 2)')
+    parser.add_argument('--split', choices=['train', 'test'], default='test')
+    parser.add_argument('--data-root', '--dataset-root', default=DATA_UTILS_ROOT,
+                        help='folder with one dataset<phase> data folder per phase (default: the Agrobot Dataset of the repository)')
+    parser.add_argument('--data-folders', nargs='+', default=None,
+                        help='data folder of each phase of --phases, instead of <data-root>/dataset<phase> '
+                             '(e.g. the folders of benchmarks.write_synthetic_dataset)')
+    parser.add_argument('--cache-dir', default=None, help='on-disk cache of the dataset importers')
+    parser.add_argument('--window-size', type=int, default=100)
+    parser.add_argument('--stride', type=int, default=20)
+    parser.add_argument('--decimation', nargs='+', type=int, default=[5, 300], help='GPS decimation factors')
+    parser.add_argument('--pos-noise-var', nargs='+', type=float, default=[GPS_POSITION_NOISE_VARIANCE],
+                        help='synthetic GPS position noise variances (m^2)')
+    parser.add_argument('--velocity-noise-var', nargs='+', type=float, default=[GPS_VELOCITY_NOISE_VARIANCE],
+                        help='synthetic GPS velocity noise variances ((m/s)^2), one per position noise variance or a single one')
+    parser.add_argument('--runs', type=int, default=1, help='Monte-Carlo runs of the synthetic GPS noise')
+    parser.add_argument('--real-gps', action='store_true', help='also run with the recorded GPS (dataset1)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--backend', choices=['numpy', 'keras'], default='numpy',
+                        help='numpy_tcn.StreamingTCN (no tensorflow needed) or keras')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--out', default='grid_results.csv', help='results table, .csv or .json')
+    args = parser.parse_args(argv)
+
+    models = args.models or sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                          'PreTrained Models', 'Agrobot_*_TCN*.hdf5')))
+    velocity_noise_var = args.velocity_noise_var
+    if len(velocity_noise_var) == 1:
+        velocity_noise_var = velocity_noise_var*len(args.pos_noise_var)
+    if len(velocity_noise_var) != len(args.pos_noise_var):
+        parser.error('--velocity-noise-var needs one value or one per --pos-noise-var')
+    if args.data_folders is None:
+        data_folders = [os.path.join(args.data_root, 'dataset{}'.format(phase)) for phase in args.phases]
+    elif len(args.data_folders) == len(args.phases):
+        data_folders = args.data_folders
+    else:
+        parser.error('--data-folders needs one folder per --phases entry')
+    config = {'data_folders': {phase: os.path.abspath(folder) for phase, folder in zip(args.phases, data_folders)},
+              'cache_dir': args.cache_dir,
+              'type_flag': 1 if args.split == 'train' else 2,
+              'window_size': args.window_size,
+              'stride': args.stride,
+              'decimation': args.decimation,
+              'noise': list(zip(args.pos_noise_var, velocity_noise_var)),
+              'runs': args.runs,
+              'real_gps': args.real_gps,
+              'seed': args.seed,
+              'backend': args.backend}
+
+    tasks = []
+    for phase in args.phases:
+        trajs, _ = load_phase(config['data_folders'][phase], phase, config['type_flag'], args.window_size, args.stride,
+                              args.cache_dir)
+        tasks += [((os.path.abspath(model_file), phase, file_idx), config)
+                  for model_file in models for file_idx in range(len(trajs))]
+
+    start_time = time.perf_counter()
+    rows = []
+    if args.workers == 1:
+        for task in tasks:
+            rows += evaluate_task(task)
+    else:
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            chunksize = max(1, len(tasks)//(4*args.workers))
+            for task_rows in executor.map(evaluate_task, tasks, chunksize=chunksize):
+                rows += task_rows
+    results = pd.DataFrame(rows)
+    if args.out.endswith('.json'):
+        results.to_json(args.out, orient='records', indent=1)
+    else:
+        results.to_csv(args.out, index=False)
+
+    keys = ['model', 'phase', 'gps', 'decimation_factor', 'pos_noise_var', 'velocity_noise_var']
+    summary = results.groupby(keys, dropna=False)[['ate', 'rte']].agg(['median', 'mean', 'std'])
+    with pd.option_context('display.max_rows', None, 'display.width', 200):
+        print(summary)
+    print('{} runs of {} tasks in {:.1f} s, results in {}'.format(len(results), len(tasks),
+                                                                 time.perf_counter()-start_time, args.out))
+    return results
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+import time
+import numpy as np
+from scipy.linalg import lapack
+from profiling import profiler_hooks
+
+
+'''
+Kalman kernel for the 4 state (x, y, vx, vy) / 10 input (acc, gyr, mag, physics) neural-Kalman model
+
+The model of neural_ekf_gnss_imu has a fixed structure, so the generic matrix products are replaced by their
+closed form:
+predict: X = A@X + B@T only keeps the position and adds dt*T, and A@P@A.T only keeps the 2 X 2 position block
+update: H is the identity, so the gain is K = P@inv(P+R), which is computed with a Cholesky solve (LAPACK dposv)
+instead of an explicit inverse, and P is updated in Joseph form, (I-K)@P@(I-K).T + K@R@K.T, to stay symmetric
+positive definite.
+Everything that only depends on dt (Q, R) is built once, predict and update work in place on preallocated buffers.
+When the network terms of a whole trajectory are known up front (batch_model_jacobian), run() also computes
+G@Q@G.T for all windows at once and integrates the predictions between two GPS updates with cumulative sums,
+so only the update steps are done one by one.
+
+inputs:
+dt: time step of the filter (stride/(window_size-stride))
+Q: diagonal process noise matrix, 10 X 10 or 12 X 12 with the ensemble spread (process_noise_cov in neural_ekf.py)
+R: 4 X 4 diagonal GPS measurement noise matrix
+
+usage:
+kernel = NeuralKalmanKernel(dt, process_noise_cov(dt), R)
+X, P = kernel.predict(X, P, G, T)
+X, P = kernel.update(X, P, z)
+pos = kernel.run(X, P, T_all, G_all, Z, update_steps)
+
+'''
+
+class NeuralKalmanKernel:
+    def __init__(self, dt, Q, R):
+        self.dt = dt
+        self.q = np.ascontiguousarray(np.diag(Q),dtype=float)
+        self.r = np.ascontiguousarray(np.diag(R),dtype=float)
+        self.I = np.identity(4)
+        self.GQ = np.empty((4,len(self.q)))
+        self.GQG = np.empty((4,4))
+        #LAPACK buffers are column major so dposv works in place
+        self.S = np.empty((4,4),order='F')
+        self.KT = np.empty((4,4),order='F')
+        self.S_diag = np.einsum('ii->i', self.S) #writeable view on the diagonal
+        self.IK = np.empty((4,4))
+        self.tmp = np.empty((4,4))
+        self.tmp2 = np.empty((4,4))
+        self.innov = np.empty((4,1))
+        self.dx = np.empty((4,1))
+
+    def predict(self, X, P, G, T):
+        X[0,0] += self.dt*T[0,0]
+        X[1,0] += self.dt*T[1,0]
+        X[2,0] = T[0,0]
+        X[3,0] = T[1,0]
+        np.multiply(G, self.q, out=self.GQ)
+        np.matmul(self.GQ, G.T, out=self.GQG)
+        P[2:4,:] = 0.0
+        P[0:2,2:4] = 0.0
+        np.add(P, self.GQG, out=P)
+        return X, P
+
+    def update(self, X, P, z):
+        self.S[:,:] = P
+        np.add(self.S_diag, self.r, out=self.S_diag)
+        self.KT[:,:] = P
+        _, KT, info = lapack.dposv(self.S, self.KT, overwrite_a=1, overwrite_b=1)
+        if info != 0:
+            raise np.linalg.LinAlgError('P+R is not positive definite')
+        K = KT.T #P and S are symmetric, so inv(S)@P is K.T
+        np.subtract(z, X, out=self.innov)
+        np.matmul(K, self.innov, out=self.dx)
+        np.add(X, self.dx, out=X)
+        np.subtract(self.I, K, out=self.IK)
+        np.matmul(self.IK, P, out=self.tmp)
+        np.matmul(self.tmp, self.IK.T, out=P)
+        np.multiply(K, self.r, out=self.tmp)
+        np.matmul(self.tmp, K.T, out=self.tmp2)
+        np.add(P, self.tmp2, out=P)
+        return X, P
+
+    '''
+    filter a whole trajectory
+
+    inputs:
+    X, P: initial state (4 X 1) and covariance (4 X 4)
+    T_all, G_all: network terms of every window, n X 2 X 1 and n X 4 X len(Q) (from batch_model_jacobian)
+    Z: GPS measurements used by the updates, one 4 X 1 vector per entry of update_steps
+    update_steps: increasing window indices after whose prediction a GPS update is done
+    profiler: profiling.StageProfiler timing the predict and update stages, None to disable
+
+    outputs:
+    pos: fused x and y position after every window, n X 2
+    '''
+    def run(self, X, P, T_all, G_all, Z, update_steps, profiler=None):
+        stage, count = profiler_hooks(profiler)
+        n_steps = T_all.shape[0]
+        with stage('predict', n_steps):
+            X = np.array(X,dtype=float)
+            P = np.array(P,dtype=float)
+            GQG = (G_all*self.q)@np.swapaxes(G_all,-1,-2)
+            #prefix sums of the position increments and of the position block of G@Q@G.T
+            disp_sum = np.zeros((n_steps+1,2))
+            disp_sum[1:] = np.cumsum(self.dt*T_all[:,:,0],axis=0)
+            Pp_sum = np.zeros((n_steps+1,2,2))
+            Pp_sum[1:] = np.cumsum(GQG[:,0:2,0:2],axis=0)
+            pos = np.empty((n_steps,2))
+        start = 0
+        for z, stop in zip(Z, update_steps):
+            pos[start:stop+1] = X[0:2,0] + disp_sum[start+1:stop+2] - disp_sum[start]
+            #predicted state and covariance after window stop
+            X[0:2,0] = pos[stop]
+            X[2:4,0] = T_all[stop,:,0]
+            Pp = P[0:2,0:2] + Pp_sum[stop+1] - Pp_sum[start]
+            P[:,:] = GQG[stop]
+            P[0:2,0:2] = Pp
+            with stage('update'):
+                X, P = self.update(X, P, z)
+            pos[stop] = X[0:2,0]
+            start = stop+1
+        pos[start:] = X[0:2,0] + disp_sum[start+1:] - disp_sum[start]
+        count('windows', n_steps)
+        count('gps_updates', min(len(Z), len(update_steps)))
+        return pos
+
+    #same for stacks of filters: X is N X 4 X 1, P is N X 4 X 4, G is N X 4 X len(Q), T and z are N X . X 1
+    def predict_batch(self, X, P, G, T):
+        X = X.copy()
+        X[:,0:2,:] += self.dt*T
+        X[:,2:4,:] = T
+        P_new = np.zeros_like(P)
+        P_new[:,0:2,0:2] = P[:,0:2,0:2]
+        P_new += (G*self.q)@np.swapaxes(G,-1,-2)
+        return X, P_new
+
+    def update_batch(self, X, P, z):
+        S = P + np.diag(self.r)
+        K = np.swapaxes(np.linalg.solve(S, P),-1,-2)
+        X = X + K@(z-X)
+        IK = self.I - K
+        P = IK@P@np.swapaxes(IK,-1,-2) + (K*self.r)@np.swapaxes(K,-1,-2)
+        return X, P
+
+
+'''
+per-step cost of the Kalman kernel next to kalman_predict/kalman_update of neural_ekf.py
+
+inputs:
+n_steps: how many filter steps to time
+gps_decimation_factor: one update every gps_decimation_factor predictions
+
+outputs:
+dictionary with the mean cost of one step (predict and, when due, update) in microseconds, for the step by step
+kernel and for run(), and the largest position difference to kalman_predict/kalman_update
+
+'''
+
+def benchmark_kalman_kernel(n_steps=20000, gps_decimation_factor=1):
+    from neural_ekf import kalman_predict, kalman_update, process_noise_cov, GPS_POSITION_NOISE_VARIANCE, GPS_VELOCITY_NOISE_VARIANCE
+    rng = np.random.default_rng(0)
+    window_size, stride = 100, 20
+    dt = stride/(window_size-stride)
+    G_all = np.abs(rng.normal(size=(n_steps,4,10)))
+    G_all = G_all/np.sum(G_all,axis=2,keepdims=True)
+    G_all[:,0:2,:] = dt*G_all[:,2:4,:]
+    T_all = rng.normal(size=(n_steps,2,1))
+    z_all = rng.normal(size=(n_steps,4,1))
+    Q = process_noise_cov(dt)
+    R = np.diag((GPS_POSITION_NOISE_VARIANCE,GPS_POSITION_NOISE_VARIANCE,
+                 GPS_VELOCITY_NOISE_VARIANCE,GPS_VELOCITY_NOISE_VARIANCE))
+    A = np.array(((1.0,0.0,0.0,0.0),(0.0,1.0,0.0,0.0),(0.0,0.0,0.0,0.0),(0.0,0.0,0.0,0.0)))
+    B = np.array(((dt, 0.0),(0.0,dt),(1.0,0),(0.0,1.0)))
+    H = np.identity(4)
+
+    update_steps = np.arange(0,n_steps,gps_decimation_factor)
+
+    X = np.zeros((4,1))
+    P = np.zeros((4,4))
+    pos_ref = np.empty((n_steps,2))
+    start = time.perf_counter()
+    for i in range(n_steps):
+        X, P = kalman_predict(X, P, Q, A, B, G_all[i], T_all[i])
+        if(i%gps_decimation_factor == 0):
+            X, P = kalman_update(X, P, z_all[i], R, H)
+        pos_ref[i] = X[0:2,0]
+    reference = (time.perf_counter()-start)/n_steps*1e6
+
+    kernel = NeuralKalmanKernel(dt, Q, R)
+    X = np.zeros((4,1))
+    P = np.zeros((4,4))
+    pos_step = np.empty((n_steps,2))
+    start = time.perf_counter()
+    for i in range(n_steps):
+        X, P = kernel.predict(X, P, G_all[i], T_all[i])
+        if(i%gps_decimation_factor == 0):
+            X, P = kernel.update(X, P, z_all[i])
+        pos_step[i] = X[0:2,0]
+    step = (time.perf_counter()-start)/n_steps*1e6
+
+    start = time.perf_counter()
+    pos_run = kernel.run(np.zeros((4,1)), np.zeros((4,4)), T_all, G_all, z_all[update_steps], update_steps)
+    run = (time.perf_counter()-start)/n_steps*1e6
+
+    return {'kalman_predict/kalman_update (us/step)': reference,
+            'NeuralKalmanKernel.predict/update (us/step)': step,
+            'NeuralKalmanKernel.run (us/step)': run,
+            'max position difference': float(max(np.max(np.abs(pos_step-pos_ref)),np.max(np.abs(pos_run-pos_ref))))}
+
+if __name__ == '__main__':
+    for gps_decimation_factor in (1, 5, 300):
+        print('gps_decimation_factor', gps_decimation_factor, benchmark_kalman_kernel(gps_decimation_factor=gps_decimation_factor))
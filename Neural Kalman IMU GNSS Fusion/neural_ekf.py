@@ -4,7 +4,8 @@ import numpy as np
 from scipy import interpolate
 from traj_utils import *
 from tqdm import tqdm
-import tensorflow as tf
+from kalman_kernel import NeuralKalmanKernel
+from profiling import profiler_hooks
 
 
 ACCELEROMETER_NOISE_VARIANCE = 0.00615490459 # 0.00615490459 #(m/s^2)^2, 0.0011858
@@ -27,6 +28,142 @@ def kalman_update(X,P,z,R,H):
     P = P-K@H@P
     return X, P
 
+'''
+process noise covariance of the 10 network input channels (acc, gyr, mag and physics)
+
+inputs:
+dt: time step of the filter (stride/(window_size-stride))
+n_inputs: number of columns of G; the columns after the 10 channels are the ensemble spread of batch_model_jacobian
+(ensemble_spread=True), which already holds the standard deviation, so they get a unit variance
+
+outputs:
+Q: n_inputs X n_inputs diagonal process noise matrix
+
+'''
+
+def process_noise_cov(dt, n_inputs=10):
+    q = np.array((ACCELEROMETER_NOISE_VARIANCE,
+                 ACCELEROMETER_NOISE_VARIANCE,
+                 ACCELEROMETER_NOISE_VARIANCE,
+                 ((np.deg2rad(GYROSCOPE_ARW[0])/60.0)*sqrt(dt))**2+(np.deg2rad(GYROSCOPE_BI[0])/3600.0)**2+GYROSCOPE_NOISE_VARIANCE,
+                 ((np.deg2rad(GYROSCOPE_ARW[1])/60.0)*sqrt(dt))**2+(np.deg2rad(GYROSCOPE_BI[1])/3600.0)**2+GYROSCOPE_NOISE_VARIANCE,
+                 ((np.deg2rad(GYROSCOPE_ARW[2])/60.0)*sqrt(dt))**2+(np.deg2rad(GYROSCOPE_BI[2])/3600.0)**2+GYROSCOPE_NOISE_VARIANCE,
+                 MAGNETOMETER_NOISE_VARIANCE,
+                 MAGNETOMETER_NOISE_VARIANCE,
+                 MAGNETOMETER_NOISE_VARIANCE,
+                 3*ACCELEROMETER_NOISE_VARIANCE
+                ))
+    Q = np.diag(np.concatenate((q, np.ones(n_inputs-len(q)))))
+    return Q
+
+'''
+batched neural network velocity predictions and input sensitivities for all windows of a trajectory
+
+inputs:
+cur_inp: Windowed input for one trajectory, equals a n X window_size X n_channels matrix
+my_model: the neural network in keras, loaded using model.load(MODEL_NAME.h5), a numpy_tcn.StreamingTCN or a
+numpy_tcn.EnsembleTCN (mean velocity of the ensemble)
+dt: time step of the filter (stride/(window_size-stride))
+batch_size: how many windows to push through the network per call 
+profiler: profiling.StageProfiler timing the cast, forward, gradient (model for numpy_tcn) and noise_input stages
+ensemble_spread: add the standard deviation of the EnsembleTCN members as two extra inputs of G, so that with unit
+variance (process_noise_cov(dt, n_channels+2)) the filter adds the ensemble variance of vx and vy to the process noise
+
+outputs:
+T: predicted velocities for each window, n X 2 X 1
+G: noise input matrix for each window, n X 4 X n_channels (normalized absolute gradient of vx and vy w.r.t. each input channel),
+n X 4 X (n_channels+2) with ensemble_spread
+
+'''
+
+def batch_model_jacobian(cur_inp, my_model, dt, batch_size=1024, profiler=None, ensemble_spread=False):
+    stage, count = profiler_hooks(profiler)
+    n_windows = cur_inp.shape[0]
+    n_channels = cur_inp.shape[2]
+    T = np.zeros((n_windows,2,1))
+    G = np.zeros((n_windows,4,n_channels+2*ensemble_spread))
+    for start in range(0,n_windows,batch_size):
+        stop = min(start+batch_size,n_windows)
+        if ensemble_spread:
+            with stage('model', stop-start):
+                pred, my_grad1, my_grad2, spread = my_model.predict_with_gradients(cur_inp[start:stop,:,:],
+                                                                                   return_spread=True)
+            #B@diag(spread**2)@B.T, the ensemble variance of vx and vy moved to the position by the prediction
+            G[start:stop,0,n_channels] = dt*spread[0][:,0]
+            G[start:stop,1,n_channels+1] = dt*spread[1][:,0]
+            G[start:stop,2,n_channels] = spread[0][:,0]
+            G[start:stop,3,n_channels+1] = spread[1][:,0]
+        elif hasattr(my_model, 'predict_with_gradients'):
+            with stage('model', stop-start):
+                pred, my_grad1, my_grad2 = my_model.predict_with_gradients(cur_inp[start:stop,:,:])
+        else:
+            import tensorflow as tf
+            with stage('cast', stop-start):
+                image = tf.convert_to_tensor(cur_inp[start:stop,:,:], dtype=tf.float32)
+            with stage('forward', stop-start):
+                with tf.GradientTape(persistent=True) as t:
+                    t.watch(image)
+                    pred = my_model(image)
+                    #windows are independent, so the gradient of the sum is the per-window gradient
+                    vx_sum = tf.reduce_sum(pred[0])
+                    vy_sum = tf.reduce_sum(pred[1])
+            with stage('gradient', stop-start):
+                my_grad1 = t.gradient(vx_sum, image).numpy()
+                my_grad2 = t.gradient(vy_sum, image).numpy()
+            del t
+        with stage('noise_input', stop-start):
+            my_grad1 = np.abs(my_grad1).sum(axis=1)
+            my_grad2 = np.abs(my_grad2).sum(axis=1)
+            my_grad1 = my_grad1/np.sum(my_grad1,axis=1,keepdims=True)
+            my_grad2 = my_grad2/np.sum(my_grad2,axis=1,keepdims=True)
+            
+            T[start:stop,0,0] = np.array(pred[0]).flatten()
+            T[start:stop,1,0] = np.array(pred[1]).flatten()
+            G[start:stop,0,0:n_channels] = dt*my_grad1
+            G[start:stop,1,0:n_channels] = dt*my_grad2
+            G[start:stop,2,0:n_channels] = my_grad1
+            G[start:stop,3,0:n_channels] = my_grad2
+    return T, G
+
+'''
+neural-Kalman filter of one trajectory from its precomputed network terms
+
+The network terms (batch_model_jacobian) only depend on the model and the trajectory, so they can be computed once
+and reused for every GPS setting (decimation, noise, Monte-Carlo runs).
+
+inputs:
+T_all, G_all: network terms of every window of the trajectory (from batch_model_jacobian, with or without
+ensemble_spread)
+x0, y0: initial coordinates of the trajectory
+GPS_x, GPS_y, GPS_vel_x, GPS_vel_y: GPS values of the trajectory (e.g. from gen_GPS_values)
+dt: time step of the filter (stride/(window_size-stride))
+gps_decimation_factor: one GPS update every gps_decimation_factor windows
+profiler: profiling.StageProfiler timing the setup (R, Q and kernel), predict and update stages
+
+outputs:
+pos: fused x and y position after every window, n X 2
+
+'''
+
+def neural_ekf_from_terms(T_all, G_all, x0, y0, GPS_x, GPS_y, GPS_vel_x, GPS_vel_y, dt, gps_decimation_factor,
+                          profiler=None):
+    stage, count = profiler_hooks(profiler)
+    with stage('setup'):
+        X = np.array([x0,y0,0.0,0.0]).reshape(4,1)
+        R = np.identity(4) 
+        R[0,0] = GPS_POSITION_NOISE_VARIANCE
+        R[1,1] = GPS_POSITION_NOISE_VARIANCE
+        R[2,2] = GPS_VELOCITY_NOISE_VARIANCE
+        R[3,3] = GPS_VELOCITY_NOISE_VARIANCE
+        
+        P = 1e-5*np.zeros((4,4))
+        kernel = NeuralKalmanKernel(dt, process_noise_cov(dt, G_all.shape[2]), R)
+        #GPS update after window i if i%gps_decimation_factor == 0, using fixes 1, 2, ... until they run out
+        update_steps = np.arange(0,T_all.shape[0],gps_decimation_factor)[0:max(len(GPS_x)-1,0)]
+        Z = np.stack((GPS_x,GPS_y,GPS_vel_x,GPS_vel_y),axis=1)[1:len(update_steps)+1].reshape(-1,4,1)
+    return kernel.run(X, P, T_all, G_all, Z, update_steps, profiler)
+
+
 '''
 inputs:
 net_inp_mat: Windowed training data for imu, equals a q X window_size X n_channels matrix (q is 10 when acc,gyr,mag and physics used)
@@ -36,7 +173,12 @@ x0_list, y0_list: initial coordinates for each trajectory
 window_size and stride: input window size and stride for training set
 file_idx: index of the trajectory to be considered
 decimation factor: by what factor to downsample GPS compared to  IMU stride? (e.g. if stride is 20 for 100 Hz sampling rate and window size of 100, the network runs at 4 Hz. A decimation factor of 4 would equate to 1s GPS interval
-my_model: the neural network in keras, loaded using model.load(MODEL_NAME.h5)
+my_model: the neural network in keras, loaded using model.load(MODEL_NAME.h5), a numpy_tcn.StreamingTCN or a
+numpy_tcn.EnsembleTCN (all variants of a phase in one pass, the filter uses their mean velocity)
+gnss: per-trajectory GPS values from GNSSProvider.synthetic or GNSSProvider.real (synthetic GPS from np.random if None)
+profiler: profiling.StageProfiler recording the time of every stage (gps, network, filter) and the GPS updates;
+its total stage gives the per-window latency. None to disable
+ensemble_spread: add the ensemble variance of the velocity to the process noise (EnsembleTCN only, see batch_model_jacobian)
 
 outputs:
 fused_pos_x, fused_pos_y: GPS+IMU position
@@ -47,85 +189,235 @@ GPS_x, GPS_y: GPS position (for debugging)
 def neural_ekf_gnss_imu(net_inp_mat, GT_vel_x,GT_vel_y, size_of_each,
                 x0_list, y0_list,file_idx,window_size,stride,
                 gps_decimation_factor,
-                my_model):
+                my_model, gnss=None, profiler=None, ensemble_spread=False):
     
-    fused_pos_x = []
-    fused_pos_y = []
+    stage, count = profiler_hooks(profiler)
+    dt = stride/(window_size-stride)
+    start, stop = traj_bounds(size_of_each, file_idx)
+    with stage('total', stop-start):
+        ########################################
+        #using emulated GPS here, you can input original GPS data if available
+        with stage('gps'):
+            if gnss is None:
+                GPS_x, GPS_y, GPS_vel_x, GPS_vel_y = gen_GPS_values(GT_vel_x,GT_vel_y,
+                                      size_of_each,x0_list,y0_list,window_size,stride,file_idx,gps_decimation_factor,
+                                      GPS_POSITION_NOISE_VARIANCE, GPS_VELOCITY_NOISE_VARIANCE)
+            else:
+                GPS_x, GPS_y, GPS_vel_x, GPS_vel_y = gnss[file_idx]
+        ########################################
+        cur_inp = net_inp_mat[start:stop,:,:]
+        T_all, G_all = batch_model_jacobian(cur_inp, my_model, dt, profiler=profiler, ensemble_spread=ensemble_spread)
+        pos = neural_ekf_from_terms(T_all, G_all, x0_list[file_idx], y0_list[file_idx],
+                                    GPS_x, GPS_y, GPS_vel_x, GPS_vel_y, dt, gps_decimation_factor, profiler)
+    fused_pos_x = pos[:,0].tolist()
+    fused_pos_y = pos[:,1].tolist()
     
+    return fused_pos_x, fused_pos_y, GPS_x, GPS_y
+
+
+'''
+neural-Kalman filter for many trajectories at once
+
+The filters of all selected trajectories are stacked (X: N X 4 X 1, P: N X 4 X 4) and stepped together
+(NeuralKalmanKernel.predict_batch/update_batch), so the
+cost of a whole split is about the cost of its longest trajectory. Trajectories that have ended are masked out.
+The same trajectory can be listed more than once to run Monte-Carlo realizations of the synthetic GPS noise.
+
+inputs:
+net_inp_mat, GT_vel_x, GT_vel_y, size_of_each, x0_list, y0_list, window_size, stride, gps_decimation_factor, my_model,
+ensemble_spread: same as neural_ekf_gnss_imu
+file_idx_list: indices of the trajectories to be considered (all trajectories if None)
+gnss: per-trajectory GPS values from GNSSProvider.synthetic or GNSSProvider.real (synthetic GPS from np.random if None)
+profiler: profiling.StageProfiler timing the network, gps, predict and update stages, None to disable
+
+outputs:
+fused_pos_x, fused_pos_y: list of GPS+IMU positions, one array per entry of file_idx_list
+GPS_x, GPS_y: list of GPS positions (for debugging)
+
+'''
+
+def neural_ekf_gnss_imu_batch(net_inp_mat, GT_vel_x,GT_vel_y, size_of_each,
+                x0_list, y0_list,window_size,stride,
+                gps_decimation_factor,
+                my_model, file_idx_list=None, gnss=None, profiler=None, ensemble_spread=False):
+    stage, count = profiler_hooks(profiler)
+    if file_idx_list is None:
+        file_idx_list = list(range(len(size_of_each)))
+    n_traj = len(file_idx_list)
     dt = stride/(window_size-stride)
+    offsets = traj_offsets(size_of_each)
+    lengths = np.diff(offsets)[file_idx_list]
+    n_steps = np.max(lengths)
+    
+    #network terms for every window of every distinct trajectory
+    T_all = np.zeros((n_traj,n_steps,2,1))
+    G_all = np.zeros((n_traj,n_steps,4,net_inp_mat.shape[2]+2*ensemble_spread))
+    for k in np.unique(file_idx_list):
+        T_k, G_k = batch_model_jacobian(net_inp_mat[offsets[k]:offsets[k+1],:,:], my_model, dt, profiler=profiler,
+                                        ensemble_spread=ensemble_spread)
+        for n in np.flatnonzero(np.array(file_idx_list) == k):
+            T_all[n,0:lengths[n]] = T_k
+            G_all[n,0:lengths[n]] = G_k
+    
     ########################################
     #using emulated GPS here, you can input original GPS data if available
-    Gvx_gps, Gvy_gps, Gvx_vel, Gvy_vel, _ = gen_GPS_values_all_traj(GT_vel_x,GT_vel_y,
-                          size_of_each,x0_list,y0_list,window_size,stride,gps_decimation_factor,
-                          GPS_POSITION_NOISE_VARIANCE, GPS_VELOCITY_NOISE_VARIANCE)
-    
-    GPS_x = Gvx_gps[file_idx]
-    GPS_y = Gvy_gps[file_idx]
-    GPS_vel_x = Gvx_vel[file_idx]
-    GPS_vel_y = Gvy_vel[file_idx]
+    GPS_x, GPS_y, GPS_vel_x, GPS_vel_y = [], [], [], []
+    with stage('gps', n_traj):
+        for k in file_idx_list:
+            if gnss is None:
+                Gx, Gy, Gvx, Gvy = gen_GPS_values(GT_vel_x,GT_vel_y,size_of_each,x0_list,y0_list,window_size,stride,k,
+                                                  gps_decimation_factor,GPS_POSITION_NOISE_VARIANCE, GPS_VELOCITY_NOISE_VARIANCE)
+            else:
+                Gx, Gy, Gvx, Gvy = gnss[k]
+            GPS_x.append(Gx)
+            GPS_y.append(Gy)
+            GPS_vel_x.append(Gvx)
+            GPS_vel_y.append(Gvy)
+        n_gps = np.array([len(Gx) for Gx in GPS_x])
+        Z = np.zeros((n_traj,np.max(n_gps),4,1))
+        for n in range(n_traj):
+            Z[n,0:n_gps[n],:,0] = np.stack((GPS_x[n],GPS_y[n],GPS_vel_x[n],GPS_vel_y[n]),axis=1)
     ########################################
-    if (file_idx == 0):
-        cur_inp = net_inp_mat[0:size_of_each[0],:,:]
-    elif (file_idx == 1):
-        cur_inp = net_inp_mat[np.sum(size_of_each[0]):np.sum(size_of_each[0:file_idx+1]),:,:]
-
-    else:
-        cur_inp = net_inp_mat[np.sum(size_of_each[0:file_idx]):np.sum(size_of_each[0:file_idx+1]),:,:]
+    
+    X = np.zeros((n_traj,4,1))
+    X[:,0,0] = [x0_list[k] for k in file_idx_list]
+    X[:,1,0] = [y0_list[k] for k in file_idx_list]
+    R = np.diag((GPS_POSITION_NOISE_VARIANCE,GPS_POSITION_NOISE_VARIANCE,
+                 GPS_VELOCITY_NOISE_VARIANCE,GPS_VELOCITY_NOISE_VARIANCE))
+    P = 1e-5*np.zeros((n_traj,4,4))
+    kernel = NeuralKalmanKernel(dt, process_noise_cov(dt, G_all.shape[3]), R)
+    
+    fused_x = np.zeros((n_traj,n_steps))
+    fused_y = np.zeros((n_traj,n_steps))
+    for i in tqdm(range(n_steps)):
+        active = (i < lengths).reshape(-1,1,1)
+        with stage('predict', int(np.sum(active))):
+            X_new, P_new = kernel.predict_batch(X, P, G_all[:,i],T_all[:,i])
+            X = np.where(active, X_new, X)
+            P = np.where(active, P_new, P)
+        count('windows', int(np.sum(active)))
+        
+        #gps_counter of neural_ekf_gnss_imu equals i//gps_decimation_factor+1 whenever it is checked
+        gps_counter = i//gps_decimation_factor + 1
+        if(i%gps_decimation_factor == 0):
+            update = (active[:,0,0] & (gps_counter < n_gps)).reshape(-1,1,1)
+            if np.any(update):
+                with stage('update', int(np.sum(update))):
+                    z = Z[:,min(gps_counter,Z.shape[1]-1)]
+                    X_new, P_new = kernel.update_batch(X,P,z)
+                    X = np.where(update, X_new, X)
+                    P = np.where(update, P_new, P)
+                count('gps_updates', int(np.sum(update)))
         
-    X = np.array([x0_list[file_idx],y0_list[file_idx],0.0,0.0]).reshape(4,1)
-    A = np.array(((1.0,0.0,0.0,0.0),(0.0,1.0,0.0,0.0),(0.0,0.0,0.0,0.0),(0.0,0.0,0.0,0.0)))
-    H = np.identity(4)
-    B = np.array(((dt, 0.0),(0.0,dt),(1.0,0),(0.0,1.0)))
-    R = np.identity(4) 
-    R[0,0] = GPS_POSITION_NOISE_VARIANCE
-    R[1,1] = GPS_POSITION_NOISE_VARIANCE
-    R[2,2] = GPS_VELOCITY_NOISE_VARIANCE
-    R[3,3] = GPS_VELOCITY_NOISE_VARIANCE
+        fused_x[:,i] = X[:,0,0]
+        fused_y[:,i] = X[:,1,0]
     
-    P = 1e-5*np.zeros((4,4))
-    gps_counter = 1
-    for i in tqdm(range(cur_inp.shape[0])):
-        image = tf.cast(cur_inp[i,:,:].reshape(1,cur_inp.shape[1],cur_inp.shape[2]), tf.float32)
-        with tf.GradientTape(persistent=True) as t:
-            t.watch(image)
-            vx_jacob = my_model(image)[0][0]
-            vy_jacob = my_model(image)[1][0]
-            pred = my_model(image)
-            
-        my_grad1 = np.array(t.gradient(vx_jacob, image)).reshape(cur_inp.shape[1],cur_inp.shape[2])
-        my_grad2 = np.array(t.gradient(vy_jacob, image)).reshape(cur_inp.shape[1],cur_inp.shape[2])
-            
-                    
-        T = np.array(pred).flatten().reshape(2,1)
+    fused_pos_x = [fused_x[n,0:lengths[n]] for n in range(n_traj)]
+    fused_pos_y = [fused_y[n,0:lengths[n]] for n in range(n_traj)]
+    return fused_pos_x, fused_pos_y, GPS_x, GPS_y
+
+
+'''
+online neural-Kalman filter for live IMU and GNSS streams
+
+IMU samples are pushed one at a time (same units as the dataset importers: acc in g, gyro in rad/s, mag in uT).
+The last window_size samples are kept in a ring buffer, and the physics channel (mean one-sided spectrum of the 
+mean-removed accelerometer magnitude) is kept up to date with a sliding DFT, resynchronized with an FFT 
+once per ring buffer revolution to bound round-off drift. Every stride samples the network runs on the current
+window, the filter predicts, and the newest pending GNSS fix (if any) is used for the update.
+
+inputs:
+my_model: the neural network in keras, loaded using model.load(MODEL_NAME.h5)
+x0, y0: initial coordinates of the robot
+window_size and stride: input window size and stride the network was trained with
+profiler: profiling.StageProfiler timing every filter step (total, i.e. the per-window latency) and its window_buffer,
+network, predict and update stages, None to disable
+ensemble_spread: add the ensemble variance of the velocity to the process noise (numpy_tcn.EnsembleTCN only)
+
+usage:
+ekf = OnlineNeuralEKF(my_model, x0, y0, window_size=100, stride=20)
+ekf.push_gnss(x, y, vel_x, vel_y) #whenever a fix arrives, in the same frame and units as gen_GPS_values
+pos = ekf.push_imu(sample) #(x,y) every stride samples, None otherwise
+
+'''
+
+class OnlineNeuralEKF:
+    def __init__(self, my_model, x0=0.0, y0=0.0, window_size=100, stride=20, profiler=None, ensemble_spread=False):
+        self.my_model = my_model
+        self.ensemble_spread = ensemble_spread
+        self.profiler = profiler
+        self.stage, self.count = profiler_hooks(profiler)
+        self.window_size = window_size
+        self.stride = stride
+        self.dt = stride/(window_size-stride)
         
-        G = np.zeros((4,10))
-        for j in range(10):
-            G[0,j] = dt*np.sum(np.abs(my_grad1[:,j]))/np.sum(np.abs(my_grad1))
-            G[1,j] = dt*np.sum(np.abs(my_grad2[:,j]))/np.sum(np.abs(my_grad2))
-            G[2,j] = np.sum(np.abs(my_grad1[:,j]))/np.sum(np.abs(my_grad1))
-            G[3,j] = np.sum(np.abs(my_grad2[:,j]))/np.sum(np.abs(my_grad2)) 
-     
+        #ring buffer of raw 9DoF samples and accelerometer magnitudes
+        self.imu_buffer = np.zeros((window_size,9))
+        self.acc_mag_buffer = np.zeros(window_size)
+        self.head = 0
+        self.n_samples = 0
+        self.window = np.zeros((1,window_size,10))
         
-        Q = np.diag((ACCELEROMETER_NOISE_VARIANCE,
-                     ACCELEROMETER_NOISE_VARIANCE,
-                     ACCELEROMETER_NOISE_VARIANCE,
-                     ((np.deg2rad(GYROSCOPE_ARW[0])/60.0)*sqrt(dt))**2+(np.deg2rad(GYROSCOPE_BI[0])/3600.0)**2+GYROSCOPE_NOISE_VARIANCE,     
-                     ((np.deg2rad(GYROSCOPE_ARW[1])/60.0)*sqrt(dt))**2+(np.deg2rad(GYROSCOPE_BI[1])/3600.0)**2+GYROSCOPE_NOISE_VARIANCE,                      
-                     ((np.deg2rad(GYROSCOPE_ARW[2])/60.0)*sqrt(dt))**2+(np.deg2rad(GYROSCOPE_BI[2])/3600.0)**2+GYROSCOPE_NOISE_VARIANCE,                      
-             MAGNETOMETER_NOISE_VARIANCE,
-             MAGNETOMETER_NOISE_VARIANCE,
-             MAGNETOMETER_NOISE_VARIANCE,
-             3*ACCELEROMETER_NOISE_VARIANCE               
-            ))
-
-        X, P = kalman_predict(X, P, Q, A, B, G,T)
+        #sliding DFT of the accelerometer magnitude, one-sided bins only
+        n_bins = ceil(window_size/2)
+        self.twiddle = np.exp(2j*pi*np.arange(n_bins)/window_size)
+        self.spectrum = np.zeros(n_bins, dtype=complex)
+        #P1[1:-1-2] = 2*P1[1:-1-2] in the importers; the DC bin is removed by the mean subtraction
+        self.bin_weights = np.ones(n_bins)
+        self.bin_weights[1:-1-2] = 2.0
+        self.bin_weights[0] = 0.0
+        self.bin_weights = self.bin_weights/(window_size*n_bins)
         
-        if(i%gps_decimation_factor == 0 and gps_counter < len(GPS_x)):
-            z = np.array((GPS_x[gps_counter],GPS_y[gps_counter],GPS_vel_x[gps_counter],GPS_vel_y[gps_counter])).reshape(4,1)
-            X, P = kalman_update(X,P,z,R,H) 
-            gps_counter+=1
+        self.X = np.array([x0,y0,0.0,0.0]).reshape(4,1)
+        self.P = 1e-5*np.zeros((4,4))
+        R = np.diag((GPS_POSITION_NOISE_VARIANCE,GPS_POSITION_NOISE_VARIANCE,
+                     GPS_VELOCITY_NOISE_VARIANCE,GPS_VELOCITY_NOISE_VARIANCE))
+        self.kernel = NeuralKalmanKernel(self.dt, process_noise_cov(self.dt, 10+2*ensemble_spread), R)
+        self.pending_fix = None
+    
+    @property
+    def position(self):
+        return self.X[0,0], self.X[1,0]
+    
+    def physics_channel(self):
+        return np.sum(self.bin_weights*np.abs(self.spectrum))
+    
+    def push_gnss(self, x, y, vel_x, vel_y):
+        #only the newest fix is kept until the next filter step
+        self.pending_fix = np.array((x,y,vel_x,vel_y),dtype=float).reshape(4,1)
+    
+    def push_imu(self, sample):
+        sample = np.asarray(sample,dtype=float)
+        acc_mag = sqrt(sample[0]**2 + sample[1]**2 + sample[2]**2)
+        self.spectrum = (self.spectrum + acc_mag - self.acc_mag_buffer[self.head])*self.twiddle
+        self.imu_buffer[self.head,:] = sample
+        self.acc_mag_buffer[self.head] = acc_mag
+        self.head = (self.head+1)%self.window_size
+        self.n_samples += 1
+        if(self.head == 0):
+            self.spectrum = np.fft.rfft(self.acc_mag_buffer)[0:len(self.spectrum)]
         
-        fused_pos_x.append(X[0,0])
-        fused_pos_y.append(X[1,0])
+        if(self.n_samples < self.window_size or (self.n_samples-self.window_size)%self.stride != 0):
+            return None
+        return self.step()
     
-    return fused_pos_x, fused_pos_y, GPS_x, GPS_y
\ No newline at end of file
+    def step(self):
+        stage = self.stage
+        with stage('total'):
+            with stage('window_buffer'):
+                #oldest sample first
+                n_old = self.window_size-self.head
+                self.window[0,0:n_old,0:9] = self.imu_buffer[self.head:,:]
+                self.window[0,n_old:,0:9] = self.imu_buffer[0:self.head,:]
+                self.window[0,:,9] = self.physics_channel()
+            T, G = batch_model_jacobian(self.window, self.my_model, self.dt, batch_size=1, profiler=self.profiler,
+                                        ensemble_spread=self.ensemble_spread)
+            with stage('predict'):
+                self.X, self.P = self.kernel.predict(self.X, self.P, G[0], T[0])
+            self.count('windows')
+            if(self.pending_fix is not None):
+                with stage('update'):
+                    self.X, self.P = self.kernel.update(self.X, self.P, self.pending_fix)
+                self.pending_fix = None
+                self.count('gps_updates')
+        return self.position
@@ -0,0 +1,407 @@
+import os
+import glob
+import json
+import h5py
+import numpy as np
+
+
+'''
+timesteps each residual block has to evaluate so that the last timestep of the window is exact
+
+A causal TCN with return_sequences=False only reads the last timestep of the summed skip connections,
+so each block only needs its outputs at the positions the following blocks look at (t, t-d, t-2d, ...).
+For window_size=100, kernel_size=5 and dilations up to 128 this is about 1/5 of the full-window work.
+
+inputs:
+window_size: input window size
+dilations: list of dilations of the residual blocks (nb_stacks already unrolled)
+kernel_size: kernel size of the dilated convolutions
+
+outputs:
+plan: one entry per block with the gather indices of both convolutions, the residual and the output positions
+
+'''
+
+def tcn_causal_plan(window_size, dilations, kernel_size):
+    def expand(pos, d):
+        taps = (pos.reshape(-1,1) - d*np.arange(kernel_size).reshape(1,-1)).flatten()
+        return np.unique(taps[taps>=0])
+
+    def gather_idx(out_pos, in_pos, d):
+        #tap j of a causal convolution at t reads t - d*(kernel_size-1-j), zero padded on the left
+        src = out_pos.reshape(-1,1) - d*(kernel_size-1-np.arange(kernel_size)).reshape(1,-1)
+        idx = np.searchsorted(in_pos, src)
+        idx[src<0] = len(in_pos)
+        return idx
+
+    plan = []
+    out_pos = np.array([window_size-1])
+    for d in reversed(dilations):
+        conv0_pos = expand(out_pos, d)
+        in_pos = np.union1d(expand(conv0_pos, d), out_pos)
+        plan.append({'dilation': d,
+                     'in_pos': in_pos,
+                     'conv0_pos': conv0_pos,
+                     'out_pos': out_pos,
+                     'conv0_idx': gather_idx(conv0_pos, in_pos, d),
+                     'conv1_idx': gather_idx(out_pos, conv0_pos, d),
+                     'res_idx': np.searchsorted(in_pos, out_pos)})
+        out_pos = in_pos
+    plan.reverse()
+    return plan
+
+
+def _causal_conv(x, idx, kernel, bias):
+    #x: n X positions X c_in, idx: out positions X kernel_size (last row of padded x is zero)
+    x_pad = np.concatenate((x, np.zeros((x.shape[0],1,x.shape[2]),dtype=x.dtype)),axis=1)
+    return np.tensordot(x_pad[:,idx,:], kernel, axes=([2,3],[0,1])) + bias
+
+
+'''
+numpy inference for the Agrobot TCN models (TCN -> MaxPooling1D -> Dense(pre) -> velx/vely), with input gradients
+
+Only the timesteps that reach the last output of the TCN are computed (see tcn_causal_plan), which gives
+the same result as the full window. Activations are not shared between overlapping windows: keras-tcn zero
+pads every window on the left and the physics channel is constant within a window, so the activations of a
+sample differ from one window to the next. The object can be passed as my_model to neural_ekf_gnss_imu,
+model_pos_generator and the baseline *_pos_generator functions, and does not need tensorflow when built with from_hdf5.
+
+inputs:
+blocks: list of (conv0_kernel, conv0_bias, conv1_kernel, conv1_bias, matching_kernel, matching_bias) per
+residual block; matching_kernel and matching_bias are None for identity shortcuts
+dense: (pre_kernel, pre_bias, velx_kernel, velx_bias, vely_kernel, vely_bias)
+dilations: list of dilations of the residual blocks (nb_stacks already unrolled)
+kernel_size: kernel size of the dilated convolutions
+window_size: input window size
+use_skip_connections: sum the skip outputs of all blocks (as in the Agrobot models)
+
+usage:
+my_model = StreamingTCN.from_keras(load_model('Agrobot_First_TCN.hdf5',custom_objects={'TCN':TCN}))
+my_model = StreamingTCN.from_hdf5('Agrobot_First_TCN.hdf5') #no tensorflow needed, only h5py
+y_pred = my_model.predict(cur_inp) #same layout as keras: [velx (n X 1), vely (n X 1)]
+y_pred, grad_vx, grad_vy = my_model.predict_with_gradients(cur_inp) #gradients are n X window_size X n_channels
+
+'''
+
+class StreamingTCN:
+    def __init__(self, blocks, dense, dilations, kernel_size, window_size, use_skip_connections=True):
+        self.blocks = [tuple(None if w is None else np.asarray(w,dtype=np.float32) for w in b) for b in blocks]
+        self.dense = tuple(np.asarray(w,dtype=np.float32) for w in dense)
+        self.dilations = list(dilations)
+        self.kernel_size = kernel_size
+        self.window_size = window_size
+        self.use_skip_connections = use_skip_connections
+        self.plan = tcn_causal_plan(window_size, self.dilations, kernel_size)
+
+    @classmethod
+    def from_keras(cls, my_model):
+        tcn_layer = my_model.get_layer('tcn')
+        dense_activations = [my_model.get_layer(name).get_config()['activation'] for name in ('pre','velx','vely')]
+        if(tcn_layer.padding != 'causal' or tcn_layer.return_sequences or tcn_layer.use_batch_norm
+           or tcn_layer.use_layer_norm or tcn_layer.use_weight_norm
+           or tcn_layer.get_config()['activation'] != 'relu' or any(a != 'linear' for a in dense_activations)):
+            raise ValueError('Only causal relu TCNs without normalization and return_sequences=False, '
+                             'with linear Dense layers, are supported')
+        blocks = []
+        for block in tcn_layer.residual_blocks:
+            convs = [layer.get_weights() for layer in block.layers if len(layer.get_weights()) == 2]
+            matching = block.shape_match_conv.get_weights()
+            if(len(matching) == 2):
+                blocks.append((convs[0][0],convs[0][1],convs[1][0],convs[1][1],matching[0][0],matching[1]))
+            else:
+                blocks.append((convs[0][0],convs[0][1],convs[1][0],convs[1][1],None,None))
+        dense = (my_model.get_layer('pre').get_weights() + my_model.get_layer('velx').get_weights()
+                 + my_model.get_layer('vely').get_weights())
+        dilations = list(tcn_layer.dilations)*tcn_layer.nb_stacks
+        return cls(blocks, dense, dilations, tcn_layer.kernel_size, my_model.input_shape[1],
+                   tcn_layer.use_skip_connections)
+
+    @classmethod
+    def from_hdf5(cls, model_file):
+        with h5py.File(model_file, 'r') as f:
+            model_config = f.attrs['model_config']
+            if isinstance(model_config, bytes):
+                model_config = model_config.decode('utf-8')
+            layers = json.loads(model_config)['config']['layers']
+            tcn_config = [l['config'] for l in layers if l['class_name'] == 'TCN'][0]
+            window_size = [l['config']['batch_input_shape'][1] for l in layers if l['class_name'] == 'InputLayer'][0]
+            dense_activations = [l['config'].get('activation') for l in layers if l['class_name'] == 'Dense']
+            if(tcn_config['padding'] != 'causal' or tcn_config['return_sequences'] or tcn_config.get('use_batch_norm')
+               or tcn_config.get('use_layer_norm') or tcn_config.get('use_weight_norm')
+               or tcn_config.get('activation') != 'relu' or any(a != 'linear' for a in dense_activations)):
+                raise ValueError('Only causal relu TCNs without normalization and return_sequences=False, '
+                                 'with linear Dense layers, are supported')
+            weights = f['model_weights']
+            dilations = list(tcn_config['dilations'])*tcn_config['nb_stacks']
+            blocks = []
+            for i in range(len(dilations)):
+                block = weights['tcn/tcn/residual_block_{}'.format(i)]
+                if 'matching_conv1D' in block:
+                    matching = (block['matching_conv1D/kernel:0'][0], block['matching_conv1D/bias:0'][()])
+                else:
+                    matching = (None, None)
+                blocks.append((block['conv1D_0/kernel:0'][()], block['conv1D_0/bias:0'][()],
+                               block['conv1D_1/kernel:0'][()], block['conv1D_1/bias:0'][()]) + matching)
+            dense = tuple(weights['{0}/{0}/{1}:0'.format(name,w)][()]
+                          for name in ('pre','velx','vely') for w in ('kernel','bias'))
+        return cls(blocks, dense, dilations, tcn_config['kernel_size'], window_size,
+                   tcn_config['use_skip_connections'])
+
+    def tcn_forward(self, x, cache=None):
+        x = np.asarray(x,dtype=np.float32)[:,self.plan[0]['in_pos'],:]
+        skip_sum = 0.0
+        for (k0,b0,k1,b1,km,bm), step in zip(self.blocks, self.plan):
+            h0 = np.maximum(_causal_conv(x, step['conv0_idx'], k0, b0), 0.0)
+            h1 = np.maximum(_causal_conv(h0, step['conv1_idx'], k1, b1), 0.0)
+            res = x[:,step['res_idx'],:]
+            if km is not None:
+                res = res@km + bm
+            x = np.maximum(res + h1, 0.0)
+            skip_sum = skip_sum + h1[:,-1,:]
+            if cache is not None:
+                cache.append((h0, h1, x))
+        if self.use_skip_connections:
+            return skip_sum
+        return x[:,-1,:]
+
+    def forward(self, x, cache=None):
+        pre_k, pre_b, velx_k, velx_b, vely_k, vely_b = self.dense
+        h = self.tcn_forward(x, cache)
+        if cache is not None:
+            cache.append(h)
+        h = np.maximum(h[:,0::2], h[:,1::2]) #reshape to (-1,nb_filters,1) and MaxPooling1D(2)
+        h = h@pre_k + pre_b
+        return [h@velx_k + velx_b, h@vely_k + vely_b]
+
+    def tcn_backward(self, g_out, cache):
+        #g_out: gradient w.r.t. the TCN output, n_outputs X n X nb_filters
+        n_out, n = g_out.shape[0:2]
+        g_x = np.zeros((n_out,n,len(self.plan[-1]['out_pos']),g_out.shape[2]),dtype=np.float32)
+        if not self.use_skip_connections:
+            g_x[:,:,-1,:] = g_out
+        for (k0,b0,k1,b1,km,bm), step, (h0,h1,x_out) in reversed(list(zip(self.blocks, self.plan, cache))):
+            g_res = g_x*(x_out>0)
+            g_a1 = g_res.copy()
+            if self.use_skip_connections:
+                g_a1[:,:,-1,:] += g_out
+            g_a1 = g_a1*(h1>0)
+            g_h0 = np.zeros((n_out,n,h0.shape[1]+1,h0.shape[2]),dtype=np.float32)
+            for j in range(self.kernel_size):
+                #each tap reads distinct positions, except for the zero padding row which is dropped
+                g_h0[:,:,step['conv1_idx'][:,j],:] += g_a1@k1[j].T
+            g_a0 = g_h0[:,:,:-1,:]*(h0>0)
+            g_x = np.zeros((n_out,n,len(step['in_pos'])+1,k0.shape[1]),dtype=np.float32)
+            for j in range(self.kernel_size):
+                g_x[:,:,step['conv0_idx'][:,j],:] += g_a0@k0[j].T
+            g_x = g_x[:,:,:-1,:]
+            if km is not None:
+                g_res = g_res@km.T
+            g_x[:,:,step['res_idx'],:] += g_res
+        return g_x
+
+    def predict_with_gradients(self, x):
+        x = np.asarray(x)
+        pre_k, pre_b, velx_k, velx_b, vely_k, vely_b = self.dense
+        cache = []
+        pred = self.forward(x, cache)
+        h = cache.pop()
+        #the head after the pooling is linear, so d(velx)/d(pooled) and d(vely)/d(pooled) are constant
+        g_pool = np.stack(((pre_k@velx_k)[:,0], (pre_k@vely_k)[:,0]))
+        first = h[:,0::2] >= h[:,1::2]
+        g_h = np.zeros((2,)+h.shape,dtype=np.float32)
+        g_h[:,:,0::2] = g_pool[:,None,:]*first
+        g_h[:,:,1::2] = g_pool[:,None,:]*(~first)
+        g_in = self.tcn_backward(g_h, cache)
+        grads = np.zeros((2,)+x.shape,dtype=np.float32)
+        grads[:,:,self.plan[0]['in_pos'],:] = g_in
+        return pred, grads[0], grads[1]
+
+    def predict(self, x, batch_size=1024):
+        outputs = [[],[]]
+        for start in range(0,x.shape[0],batch_size):
+            vx, vy = self.forward(x[start:start+batch_size])
+            outputs[0].append(vx)
+            outputs[1].append(vy)
+        return [np.concatenate(outputs[0],axis=0), np.concatenate(outputs[1],axis=0)]
+
+    def __call__(self, x):
+        return self.forward(np.asarray(x))
+
+
+def _ensemble_causal_conv(x, idx, kernel, bias):
+    #x: 1 or n_models X n X positions X c_in (1 for the shared input), kernel: n_models X kernel_size X c_in X c_out
+    m, n, _, c_in = x.shape
+    x_pad = np.concatenate((x, np.zeros((m,n,1,c_in),dtype=x.dtype)),axis=2)
+    taps = x_pad[:,:,idx,:].reshape(m,-1,idx.shape[1]*c_in)
+    out = taps@kernel.reshape(kernel.shape[0],-1,kernel.shape[3]) + bias[:,None,:]
+    return out.reshape(kernel.shape[0],n,idx.shape[0],kernel.shape[3])
+
+
+#y@w for every member, y: 1 or n_models X ... X c_in, w: n_models X c_in X c_out (one matrix product per member)
+def _ensemble_matmul(y, w):
+    out = y.reshape(y.shape[0],-1,y.shape[-1])@w
+    return out.reshape((w.shape[0],)+y.shape[1:-1]+(w.shape[2],))
+
+
+'''
+numpy inference for an ensemble of Agrobot TCN models with the same architecture (e.g. Agrobot_First_TCN, _TCN2 and
+_TCN3 of a phase), returning the mean velocity and the ensemble spread
+
+The weights of the members are stacked along a leading model axis and every layer is one batched matrix product, so
+all members run in a single pass over the shared input: the gather of the input windows, the causal plan and the
+python overhead are paid once instead of once per model. The members have n_models times the activations of one
+model, so the windows go through in chunks of chunk_size, which keeps them in the CPU cache (larger batches are
+memory bound). predict and predict_with_gradients return the ensemble mean (and the gradient of the mean), so the
+object can be passed as my_model wherever a StreamingTCN is accepted; predict_with_spread and
+predict_with_gradients(return_spread=True) also give the standard deviation of the members.
+
+inputs:
+models: list of StreamingTCN with the same dilations, kernel size, window size and layer sizes
+chunk_size: how many windows go through the members at a time (batch_size of predict is capped to it)
+
+usage:
+my_model = EnsembleTCN.from_phase('PreTrained Models', 'First') #Agrobot_First_TCN*.hdf5
+my_model = EnsembleTCN.from_hdf5(['Agrobot_First_TCN.hdf5','Agrobot_First_TCN2.hdf5','Agrobot_First_TCN3.hdf5'])
+y_pred, y_std = my_model.predict_with_spread(cur_inp) #[velx (n X 1), vely (n X 1)] mean and standard deviation
+y_pred, grad_vx, grad_vy, y_std = my_model.predict_with_gradients(cur_inp, return_spread=True)
+
+'''
+
+class EnsembleTCN:
+    def __init__(self, models, chunk_size=16):
+        models = list(models)
+        first = models[0]
+        for model in models[1:]:
+            if(model.dilations != first.dilations or model.kernel_size != first.kernel_size
+               or model.window_size != first.window_size or model.use_skip_connections != first.use_skip_connections
+               or [[None if w is None else w.shape for w in b] for b in model.blocks]
+               != [[None if w is None else w.shape for w in b] for b in first.blocks]
+               or [w.shape for w in model.dense] != [w.shape for w in first.dense]):
+                raise ValueError('All models of an ensemble need the same architecture')
+        self.n_models = len(models)
+        self.blocks = [tuple(None if b[i] is None else np.stack([model.blocks[k][i] for model in models])
+                             for i in range(6)) for k, b in enumerate(first.blocks)]
+        self.dense = tuple(np.stack([model.dense[i] for model in models]) for i in range(6))
+        self.dilations = first.dilations
+        self.kernel_size = first.kernel_size
+        self.window_size = first.window_size
+        self.use_skip_connections = first.use_skip_connections
+        self.plan = first.plan
+        self.chunk_size = chunk_size
+
+    @classmethod
+    def from_keras(cls, models, chunk_size=16):
+        return cls([StreamingTCN.from_keras(my_model) for my_model in models], chunk_size)
+
+    @classmethod
+    def from_hdf5(cls, model_files, chunk_size=16):
+        return cls([StreamingTCN.from_hdf5(model_file) for model_file in model_files], chunk_size)
+
+    #all Agrobot_<phase>_TCN*.hdf5 variants of a phase ('First', 'Second' or 'Third')
+    @classmethod
+    def from_phase(cls, models_dir, phase, chunk_size=16):
+        model_files = sorted(glob.glob(os.path.join(glob.escape(models_dir), 'Agrobot_{}_TCN*.hdf5'.format(phase))))
+        if not model_files:
+            raise FileNotFoundError('No Agrobot_{}_TCN*.hdf5 in {}'.format(phase, models_dir))
+        return cls.from_hdf5(model_files, chunk_size)
+
+    def tcn_forward(self, x, cache=None):
+        #the input is shared by all members, so it only gets a broadcast model axis
+        x = np.asarray(x,dtype=np.float32)[None,:,self.plan[0]['in_pos'],:]
+        skip_sum = 0.0
+        for (k0,b0,k1,b1,km,bm), step in zip(self.blocks, self.plan):
+            h0 = np.maximum(_ensemble_causal_conv(x, step['conv0_idx'], k0, b0), 0.0)
+            h1 = np.maximum(_ensemble_causal_conv(h0, step['conv1_idx'], k1, b1), 0.0)
+            res = x[:,:,step['res_idx'],:]
+            if km is not None:
+                res = _ensemble_matmul(res, km) + bm[:,None,None,:]
+            x = np.maximum(res + h1, 0.0)
+            skip_sum = skip_sum + h1[:,:,-1,:]
+            if cache is not None:
+                cache.append((h0, h1, x))
+        if self.use_skip_connections:
+            return skip_sum
+        return x[:,:,-1,:]
+
+    #velocities of every member, [velx, vely] of n_models X n X 1
+    def forward(self, x, cache=None):
+        pre_k, pre_b, velx_k, velx_b, vely_k, vely_b = self.dense
+        h = self.tcn_forward(x, cache)
+        if cache is not None:
+            cache.append(h)
+        h = np.maximum(h[:,:,0::2], h[:,:,1::2])
+        h = h@pre_k + pre_b[:,None,:]
+        return [h@velx_k + velx_b[:,None,:], h@vely_k + vely_b[:,None,:]]
+
+    def tcn_backward(self, g_out, cache):
+        #g_out: gradient w.r.t. the TCN output, n_models X n_outputs X n X nb_filters
+        n_models, n_out, n = g_out.shape[0:3]
+        g_x = np.zeros((n_models,n_out,n,len(self.plan[-1]['out_pos']),g_out.shape[3]),dtype=np.float32)
+        if not self.use_skip_connections:
+            g_x[:,:,:,-1,:] = g_out
+        for (k0,b0,k1,b1,km,bm), step, (h0,h1,x_out) in reversed(list(zip(self.blocks, self.plan, cache))):
+            g_res = g_x*(x_out[:,None]>0)
+            g_a1 = g_res.copy()
+            if self.use_skip_connections:
+                g_a1[:,:,:,-1,:] += g_out
+            g_a1 = g_a1*(h1[:,None]>0)
+            g_h0 = np.zeros((n_models,n_out,n,h0.shape[2]+1,h0.shape[3]),dtype=np.float32)
+            for j in range(self.kernel_size):
+                g_h0[:,:,:,step['conv1_idx'][:,j],:] += _ensemble_matmul(g_a1, np.swapaxes(k1[:,j],1,2))
+            g_a0 = g_h0[:,:,:,:-1,:]*(h0[:,None]>0)
+            g_x = np.zeros((n_models,n_out,n,len(step['in_pos'])+1,k0.shape[2]),dtype=np.float32)
+            for j in range(self.kernel_size):
+                g_x[:,:,:,step['conv0_idx'][:,j],:] += _ensemble_matmul(g_a0, np.swapaxes(k0[:,j],1,2))
+            g_x = g_x[:,:,:,:-1,:]
+            if km is not None:
+                g_res = _ensemble_matmul(g_res, np.swapaxes(km,1,2))
+            g_x[:,:,:,step['res_idx'],:] += g_res
+        #the members share the input, so their gradients add up
+        return g_x.sum(axis=0)
+
+    def predict_with_gradients(self, x, return_spread=False):
+        x = np.asarray(x)
+        mean = [np.zeros((x.shape[0],1),dtype=np.float32), np.zeros((x.shape[0],1),dtype=np.float32)]
+        std = [np.zeros((x.shape[0],1),dtype=np.float32), np.zeros((x.shape[0],1),dtype=np.float32)]
+        grads = np.zeros((2,)+x.shape,dtype=np.float32)
+        pre_k, pre_b, velx_k, velx_b, vely_k, vely_b = self.dense
+        #gradient of the ensemble mean, the head of every member is linear after the pooling
+        g_pool = np.stack(((pre_k@velx_k)[:,:,0], (pre_k@vely_k)[:,:,0]),axis=1)/self.n_models
+        for start in range(0,x.shape[0],self.chunk_size):
+            stop = min(start+self.chunk_size,x.shape[0])
+            cache = []
+            pred = self.forward(x[start:stop], cache)
+            h = cache.pop()
+            first = h[:,:,0::2] >= h[:,:,1::2]
+            g_h = np.zeros((self.n_models,2)+h.shape[1:],dtype=np.float32)
+            g_h[:,:,:,0::2] = g_pool[:,:,None,:]*first[:,None]
+            g_h[:,:,:,1::2] = g_pool[:,:,None,:]*(~first[:,None])
+            grads[:,start:stop,self.plan[0]['in_pos'],:] = self.tcn_backward(g_h, cache)
+            for i in range(2):
+                mean[i][start:stop] = pred[i].mean(axis=0)
+                std[i][start:stop] = pred[i].std(axis=0)
+        if return_spread:
+            return mean, grads[0], grads[1], std
+        return mean, grads[0], grads[1]
+
+    #velocities of every member, [velx, vely] of n_models X n X 1
+    def predict_members(self, x, batch_size=1024):
+        outputs = [[],[]]
+        batch_size = min(batch_size, self.chunk_size)
+        for start in range(0,x.shape[0],batch_size):
+            vx, vy = self.forward(x[start:start+batch_size])
+            outputs[0].append(vx)
+            outputs[1].append(vy)
+        return [np.concatenate(outputs[0],axis=1), np.concatenate(outputs[1],axis=1)]
+
+    def predict_with_spread(self, x, batch_size=1024):
+        vx, vy = self.predict_members(x, batch_size)
+        return [vx.mean(axis=0), vy.mean(axis=0)], [vx.std(axis=0), vy.std(axis=0)]
+
+    def predict(self, x, batch_size=1024):
+        vx, vy = self.predict_members(x, batch_size)
+        return [vx.mean(axis=0), vy.mean(axis=0)]
+
+    def __call__(self, x):
+        vx, vy = self.forward(np.asarray(x))
+        return [vx.mean(axis=0), vy.mean(axis=0)]
@@ -0,0 +1,112 @@
+import time
+from contextlib import contextmanager, nullcontext
+import numpy as np
+
+
+'''
+per-stage wall time, call counts and event counters of the fusion loop (and of the dataset importers)
+
+The instrumented functions take profiler=None; when it is None every stage is the shared null context of
+null_stage, so disabled profiling costs one function call per stage (the stages are per batch or per GPS
+update, not per operation). A stage can stand for several items (e.g. all windows of a trajectory predicted in
+one batch): its latency per item is then seconds/n_items, and the latency percentiles weight every call by its
+number of items. The windows and GPS updates are also counted, which gives the GPS update frequency.
+
+inputs:
+callback: called as callback(name, seconds, n_items) after every stage, e.g. to forward the timings to a logger
+keep_samples: keep the duration of every call for the latency percentiles
+
+usage:
+profiler = StageProfiler()
+fused_pos_x, fused_pos_y, GPS_x, GPS_y = neural_ekf_gnss_imu(..., my_model, profiler=profiler)
+print(profiler.summary())
+stats = profiler.stats() #{'stages': {name: {...}}, 'counters': {...}, 'gps_updates_per_window': ...}
+
+'''
+
+class StageProfiler:
+    def __init__(self, callback=None, keep_samples=True):
+        self.callback = callback
+        self.keep_samples = keep_samples
+        self.reset()
+
+    def reset(self):
+        self.seconds = {}
+        self.calls = {}
+        self.items = {}
+        self.samples = {}
+        self.counters = {}
+
+    def record(self, name, seconds, n_items=1):
+        self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+        self.calls[name] = self.calls.get(name, 0) + 1
+        self.items[name] = self.items.get(name, 0) + n_items
+        if self.keep_samples:
+            self.samples.setdefault(name, []).append((seconds, n_items))
+        if self.callback is not None:
+            self.callback(name, seconds, n_items)
+
+    @contextmanager
+    def stage(self, name, n_items=1):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter()-start, n_items)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def stats(self, percentiles=(50, 90, 99)):
+        stages = {}
+        for name in self.seconds:
+            entry = {'seconds': self.seconds[name],
+                     'calls': self.calls[name],
+                     'items': self.items[name],
+                     'seconds_per_item': self.seconds[name]/max(self.items[name],1)}
+            if name in self.samples:
+                seconds, n_items = np.array(self.samples[name]).T
+                n_items = n_items.astype(int)
+                per_item = np.repeat(seconds/np.maximum(n_items,1), np.maximum(n_items,1))
+                entry['latency_percentiles'] = dict(zip(percentiles, np.percentile(per_item, percentiles).tolist()))
+            stages[name] = entry
+        stats = {'stages': stages, 'counters': dict(self.counters)}
+        if self.counters.get('windows'):
+            stats['gps_updates_per_window'] = self.counters.get('gps_updates', 0)/self.counters['windows']
+        return stats
+
+    def summary(self):
+        stats = self.stats()
+        #stages are nested in the total stage when there is one
+        if 'total' in stats['stages']:
+            total = stats['stages']['total']['seconds']
+        else:
+            total = sum(entry['seconds'] for name, entry in stats['stages'].items())
+        lines = ['{:<16}{:>10}{:>10}{:>10}{:>14}{:>14}'.format('stage', 'seconds', 'share', 'calls', 'us/item',
+                                                               'p99 us/item')]
+        for name, entry in sorted(stats['stages'].items(), key=lambda item: -item[1]['seconds']):
+            p99 = entry.get('latency_percentiles', {}).get(99, np.nan)
+            lines.append('{:<16}{:>10.4f}{:>10.1%}{:>10}{:>14.2f}{:>14.2f}'.format(
+                name, entry['seconds'], entry['seconds']/total if total > 0 else 0.0, entry['calls'],
+                entry['seconds_per_item']*1e6, p99*1e6))
+        for name, value in stats['counters'].items():
+            lines.append('{:<16}{:>10}'.format(name, value))
+        if 'gps_updates_per_window' in stats:
+            lines.append('{:<16}{:>10.4f}'.format('gps/window', stats['gps_updates_per_window']))
+        return '\n'.join(lines)
+
+
+NULL_STAGE = nullcontext()
+
+#stage of a disabled profiler
+def null_stage(name, n_items=1):
+    return NULL_STAGE
+
+def null_count(name, n=1):
+    pass
+
+#stage and count functions of a profiler, or the no-op ones when profiler is None
+def profiler_hooks(profiler):
+    if profiler is None:
+        return null_stage, null_count
+    return profiler.stage, profiler.count
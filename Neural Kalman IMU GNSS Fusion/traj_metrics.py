@@ -0,0 +1,157 @@
+import numpy as np
+from traj_utils import traj_offsets
+
+
+'''
+number of windows in one minute, as in Cal_TE
+
+inputs:
+sampling_rate: data sampling rate
+window_size and stride: input window size and stride for training set
+
+'''
+
+def windows_per_minute(sampling_rate=100, window_size=200, stride=10):
+    return int(((sampling_rate*60)-window_size)/stride)
+
+
+'''
+percentiles of every group of a flat array (numpy's default linear interpolation), without a loop over the groups
+
+inputs:
+values: flat array, group k is values[offsets[k]:offsets[k+1]]
+offsets: cumulative group offsets (n_groups+1)
+q: percentiles, in [0,100]
+
+outputs:
+n_groups X len(q) array, nan for empty groups
+
+'''
+
+def grouped_percentiles(values, offsets, q):
+    offsets = np.asarray(offsets)
+    lengths = np.diff(offsets)
+    group = np.repeat(np.arange(len(lengths)), lengths)
+    #sorted by group, then by value
+    sorted_values = values[offsets[0]:offsets[-1]][np.lexsort((values[offsets[0]:offsets[-1]], group))]
+    pos = np.asarray(q,dtype=float).reshape(1,-1)/100*(lengths.reshape(-1,1)-1)
+    lo = np.floor(pos).astype(int)
+    hi = np.ceil(pos).astype(int)
+    out = np.full(pos.shape, np.nan)
+    valid = lengths > 0
+    base = (offsets[:-1]-offsets[0]).reshape(-1,1)
+    v_lo = sorted_values[(base+lo)[valid]]
+    v_hi = sorted_values[(base+hi)[valid]]
+    out[valid] = v_lo + (v_hi-v_lo)*(pos-lo)[valid]
+    return out
+
+
+'''
+flat positions and trajectory offsets from either stacked arrays or one array (or list) per trajectory
+
+'''
+
+def flatten_trajectories(values, size_of_each=None):
+    if size_of_each is None:
+        values = [np.asarray(v,dtype=float).reshape(-1) for v in values]
+        return np.concatenate(values) if values else np.empty(0), np.cumsum([0]+[len(v) for v in values])
+    return np.asarray(values,dtype=float).reshape(-1), traj_offsets(size_of_each)
+
+
+'''
+ATE, RTE and path length of a batch of trajectories (e.g. all files of a split, or many Monte-Carlo runs) in one call
+
+The position error of every window is computed at once. RTE is evaluated on every one-minute segment, not only
+on the first one: the segment starting at window s is compared after moving the prediction onto the ground
+truth where the segment starts (window s-1, or the common initial point for s=0), i.e. with the error at the start
+of the segment removed. For the first segment this is the RTE of Cal_TE. Trajectories shorter than one minute have
+no segment and get Cal_TE's scaled ATE as RTE. Ragged trajectories are handled with the trajectory offsets and
+segments are processed in chunks, so memory does not grow with the number of segments.
+
+inputs:
+Gvx, Gvy: ground truth positions (in m), stacked as the windowed arrays or one array per trajectory
+Pvx, Pvy: predicted positions (in m), same layout
+size_of_each: number of windows of each trajectory, or a TrajectorySet; None when positions are given per trajectory
+sampling_rate: data sampling rate
+window_size and stride: input window size and stride for training set
+segment_step: windows between the starts of two RTE segments (one minute if None, i.e. non-overlapping segments;
+1 for every possible segment)
+percentiles: percentiles of the window errors and of the segment RTEs
+chunk_size: number of segments evaluated at once
+
+outputs:
+dictionary of per-trajectory arrays:
+ate, rte: mean position error and mean RTE over the one-minute segments (in m)
+rte_first: RTE of the first minute, as Cal_TE
+length: ground truth path length (in m), as Cal_len_meters
+ate_percentiles, rte_percentiles: n_traj X len(percentiles) percentiles of the window errors and segment RTEs
+and of the segments:
+segment_rte, segment_length: RTE and ground truth path length of every segment (in m)
+segment_traj, segment_start: trajectory and first window (within the trajectory) of every segment
+
+usage:
+metrics = trajectory_metrics(Gvx, Gvy, Pvx, Pvy, size_of_each, window_size=100, stride=20)
+metrics = trajectory_metrics(Gvx_list, Gvy_list, Pvx_list, Pvy_list, window_size=100, stride=20) #one entry per run
+
+'''
+
+def trajectory_metrics(Gvx, Gvy, Pvx, Pvy, size_of_each=None, sampling_rate=100, window_size=200, stride=10,
+                       segment_step=None, percentiles=(50, 90, 95, 99), chunk_size=4096):
+    Gvx, offsets = flatten_trajectories(Gvx, size_of_each)
+    Gvy = flatten_trajectories(Gvy, size_of_each)[0]
+    Pvx = flatten_trajectories(Pvx, size_of_each)[0]
+    Pvy = flatten_trajectories(Pvy, size_of_each)[0]
+    offsets = np.asarray(offsets).astype(int)
+    lengths = np.diff(offsets)
+    n_traj = len(lengths)
+    traj = np.repeat(np.arange(n_traj), lengths)
+    ex = Pvx[offsets[0]:offsets[-1]]-Gvx[offsets[0]:offsets[-1]]
+    ey = Pvy[offsets[0]:offsets[-1]]-Gvy[offsets[0]:offsets[-1]]
+    distance = np.sqrt(ex*ex + ey*ey)
+    ate = np.bincount(traj, weights=distance, minlength=n_traj)/np.maximum(lengths,1)
+
+    #ground truth step lengths, the first window of each trajectory has none
+    step = np.zeros(len(distance))
+    step[1:] = np.hypot(np.diff(Gvx[offsets[0]:offsets[-1]]), np.diff(Gvy[offsets[0]:offsets[-1]]))
+    step[offsets[:-1][lengths>0]-offsets[0]] = 0.0
+    length = np.bincount(traj, weights=step, minlength=n_traj)
+    step_sum = np.concatenate(([0.0],np.cumsum(step)))
+
+    n_min = windows_per_minute(sampling_rate, window_size, stride)
+    if segment_step is None:
+        segment_step = n_min
+    n_seg = np.where(lengths >= n_min, (lengths-n_min)//segment_step+1, 0) if n_min > 0 else np.zeros(n_traj,dtype=int)
+    segment_traj = np.repeat(np.arange(n_traj), n_seg)
+    segment_start = np.arange(np.sum(n_seg)) - np.repeat(np.cumsum(n_seg)-n_seg, n_seg)
+    segment_start = segment_start*segment_step
+    first = offsets[:-1][segment_traj]-offsets[0] + segment_start
+    segment_rte = np.empty(len(first))
+    for c in range(0, len(first), chunk_size):
+        idx = first[c:c+chunk_size].reshape(-1,1) + np.arange(n_min).reshape(1,-1)
+        ref = first[c:c+chunk_size]-1
+        at_start = segment_start[c:c+chunk_size] == 0
+        ref_x = np.where(at_start, 0.0, ex[ref])
+        ref_y = np.where(at_start, 0.0, ey[ref])
+        dx = ex[idx]-ref_x.reshape(-1,1)
+        dy = ey[idx]-ref_y.reshape(-1,1)
+        segment_rte[c:c+chunk_size] = np.mean(np.sqrt(dx*dx + dy*dy), axis=1)
+    #path length within the segment, from the end of window s to the end of window s+n_min-1
+    segment_length = step_sum[first+n_min] - step_sum[first+1] if n_min > 0 else np.zeros(len(first))
+
+    scaled = ate*(n_min/np.maximum(lengths,1))
+    rte = np.bincount(segment_traj, weights=segment_rte, minlength=n_traj)/np.maximum(n_seg,1)
+    rte = np.where(n_seg > 0, rte, scaled)
+    rte_first = scaled.copy()
+    has_first = n_seg > 0
+    rte_first[has_first] = segment_rte[(np.cumsum(n_seg)-n_seg)[has_first]]
+
+    return {'ate': ate,
+            'rte': rte,
+            'rte_first': rte_first,
+            'length': length,
+            'ate_percentiles': grouped_percentiles(distance, offsets-offsets[0], percentiles),
+            'rte_percentiles': grouped_percentiles(segment_rte, np.cumsum(np.concatenate(([0],n_seg))), percentiles),
+            'segment_rte': segment_rte,
+            'segment_length': segment_length,
+            'segment_traj': segment_traj,
+            'segment_start': segment_start}
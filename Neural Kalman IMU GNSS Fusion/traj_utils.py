@@ -1,9 +1,147 @@
 from math import atan2, pi, sqrt, atan2, sin, cos, radians, ceil
 import math
+import os
+import json
+import hashlib
 import numpy as np
 from scipy import interpolate
 
 
+'''
+window range of a trajectory in the stacked (windowed) arrays
+
+inputs:
+size_of_each: number of windows of each trajectory, or a TrajectorySet (see data_utils), whose precomputed
+offsets are then used
+file_idx: index of the trajectory
+
+outputs:
+start, stop: trajectory file_idx is windows start:stop
+
+'''
+
+def traj_offsets(size_of_each):
+    if hasattr(size_of_each, 'offsets'):
+        return size_of_each.offsets
+    return np.concatenate(([0],np.cumsum(size_of_each))).astype(int)
+
+def traj_bounds(size_of_each, file_idx):
+    offsets = traj_offsets(size_of_each)
+    return int(offsets[file_idx]), int(offsets[file_idx+1])
+
+
+'''
+dead reckoning of a batch of trajectories with cumulative sums
+
+The steps of all trajectories are laid out as in the stacked windowed arrays (trajectory k is
+offsets[k]:offsets[k+1]), they are padded to the longest trajectory and summed along time, starting from x0/y0.
+The sum is sequential like the Lx = Lx + step loop of the position generators, so the positions are the same.
+
+inputs:
+step_x, step_y: x and y displacement of every window (in m)
+size_of_each: number of windows of each trajectory, or a TrajectorySet
+x0_list, y0_list: initial coordinates for each trajectory
+
+outputs:
+pos_x, pos_y: x and y position after every window (in m), same layout as step_x and step_y
+
+'''
+
+def integrate_steps(step_x, step_y, size_of_each, x0_list, y0_list):
+    offsets = traj_offsets(size_of_each)
+    lengths = np.diff(offsets)
+    padded = np.zeros((2,len(lengths),np.max(lengths,initial=0)+1))
+    padded[0,:,0] = x0_list[0:len(lengths)]
+    padded[1,:,0] = y0_list[0:len(lengths)]
+    valid = np.arange(padded.shape[2]-1) < lengths.reshape(-1,1)
+    padded[0,:,1:][valid] = step_x[offsets[0]:offsets[-1]]
+    padded[1,:,1:][valid] = step_y[offsets[0]:offsets[-1]]
+    np.cumsum(padded,axis=2,out=padded)
+    return padded[0,:,1:][valid], padded[1,:,1:][valid]
+
+#velocities to positions, the network runs every stride/(window_size-stride) s
+def integrate_velocities(vel_x, vel_y, size_of_each, x0_list, y0_list, window_size, stride):
+    vel_x = np.asarray(vel_x)
+    vel_y = np.asarray(vel_y)
+    return integrate_steps(vel_x/(((window_size-stride)/stride)), vel_y/(((window_size-stride)/stride)),
+                           size_of_each, x0_list, y0_list)
+
+
+'''
+one-shot prediction of a whole split, cached on disk
+
+The concatenated network input of all trajectories is predicted with a single predict call and a large batch,
+instead of one call per trajectory; split_by_trajectory then gives the outputs of each trajectory. With
+cache_dir and model_file, the outputs are saved as cache_dir/<key>.npz, the key being the SHA-1 of the model file,
+the dataset key and a sample of the input windows, so evaluating the same model on the same split again only loads
+them.
+
+inputs:
+net_inp_mat: the processed and windowed NN input of the whole split (a list of arrays for multi-input models)
+my_model: the neural network in keras, or anything with predict(x, batch_size=...)
+model_file: saved model (e.g. Agrobot_First_TCN.hdf5), hashed for the cache key; no caching when None
+cache_dir: prediction cache folder, None to disable the cache
+dataset_key: key of the dataset (e.g. TrajectorySet.key); the key then only hashes the dtype and at most 256 evenly
+strided windows of each input, which still tells a changed preprocessing of the same import apart; None to hash all of
+net_inp_mat
+batch_size: prediction batch size, None for prediction_batch_size(net_inp_mat)
+
+outputs:
+y_pred: list of the model outputs for all windows
+
+'''
+
+#largest batch whose input fits in target_bytes (float32)
+def prediction_batch_size(net_inp_mat, target_bytes=2**26, min_batch=256):
+    inputs = net_inp_mat if isinstance(net_inp_mat, (list, tuple)) else [net_inp_mat]
+    window_bytes = sum(4*int(np.prod(np.shape(x)[1:])) for x in inputs)
+    return int(max(min_batch, min(len(inputs[0]), target_bytes//max(window_bytes,1))))
+
+def prediction_cache_key(net_inp_mat, my_model, model_file, dataset_key):
+    inputs = net_inp_mat if isinstance(net_inp_mat, (list, tuple)) else [net_inp_mat]
+    h = hashlib.sha1()
+    with open(model_file, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            h.update(block)
+    h.update(type(my_model).__name__.encode())
+    h.update(json.dumps([np.shape(x) for x in inputs]).encode())
+    for x in inputs:
+        x = np.asarray(x)
+        h.update(x.dtype.str.encode())
+        if dataset_key is not None:
+            x = x[::max(1, int(ceil(len(x)/256)))]
+        h.update(np.ascontiguousarray(x))
+    if dataset_key is not None:
+        h.update(str(dataset_key).encode())
+    return h.hexdigest()
+
+def predict_split(net_inp_mat, my_model, model_file=None, cache_dir=None, dataset_key=None, batch_size=None):
+    path = None
+    if cache_dir is not None and model_file is not None:
+        path = os.path.join(cache_dir, prediction_cache_key(net_inp_mat, my_model, model_file, dataset_key)+'.npz')
+        if os.path.exists(path):
+            with np.load(path) as cached:
+                return [cached['y_pred_{}'.format(i)] for i in range(len(cached.files))]
+    if batch_size is None:
+        batch_size = prediction_batch_size(net_inp_mat)
+    y_pred = my_model.predict(net_inp_mat, batch_size=batch_size)
+    if not isinstance(y_pred, (list, tuple)):
+        y_pred = [y_pred]
+    y_pred = [np.asarray(y) for y in y_pred]
+    if path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = path+'.{}.tmp'.format(os.getpid())
+        with open(tmp, 'wb') as f:
+            np.savez(f, **{'y_pred_{}'.format(i): y for i, y in enumerate(y_pred)})
+        os.replace(tmp, path)
+    return y_pred
+
+#views of a stacked array (windows of all trajectories), one per trajectory
+def split_by_trajectory(values, size_of_each):
+    offsets = traj_offsets(size_of_each)
+    return [values[offsets[k]:offsets[k+1]] for k in range(len(offsets)-1)]
+
+
 '''
 generate ATE and RTE values
 
@@ -24,29 +162,21 @@ def Cal_TE(Gvx, Gvy, Pvx, Pvy, sampling_rate=100,window_size=200,stride=10,lengt
     if length==None:
         length = len(Gvx)
         
-    distance = []
+    dx = np.asarray(Gvx[0:length],dtype=float)-np.asarray(Pvx[0:length],dtype=float)
+    dy = np.asarray(Gvy[0:length],dtype=float)-np.asarray(Pvy[0:length],dtype=float)
+    distance = np.sqrt(dx*dx + dy*dy)
     
-    for i in range(length):
-        d = ((Gvx[i]-Pvx[i])*(Gvx[i]-Pvx[i])) + ((Gvy[i]-Pvy[i])*(Gvy[i]-Pvy[i]))
-        d = math.sqrt(d)
-        distance.append(d)
-    
-    mean_distance = sum(distance)/len(distance)
-    ate = mean_distance
-    at_all = distance
+    ate = float(np.mean(distance))
+    at_all = distance.tolist()
     
     n_windows_one_min= int(((sampling_rate*60)-window_size)/stride)
-    distance = []
     if(n_windows_one_min < length):
-        for i in range(n_windows_one_min):
-            d = ((Gvx[i]-Pvx[i])*(Gvx[i]-Pvx[i])) + ((Gvy[i]-Pvy[i])*(Gvy[i]-Pvy[i]))
-            d = math.sqrt(d)
-            distance.append(d)
-        rte = sum(distance)/len(distance)
+        rt_all = at_all[0:n_windows_one_min]
+        rte = float(np.mean(distance[0:n_windows_one_min]))
     else:
+        rt_all = []
         rte=ate*(n_windows_one_min/length)
     
-    rt_all = distance
     return ate, rte, at_all, rt_all
 
 
@@ -64,14 +194,10 @@ def Cal_len_meters(Gvx, Gvy, length=None):
     if length==None:
         length = len(Gvx)
         
-    distance = []
-    
-    for i in range(1, length):
-        d = ((Gvx[i]-Gvx[i-1])*(Gvx[i]-Gvx[i-1])) + ((Gvy[i]-Gvy[i-1])*(Gvy[i]-Gvy[i-1]))
-        d = math.sqrt(d)
-        distance.append(d)
+    dx = np.diff(np.asarray(Gvx[0:length],dtype=float))
+    dy = np.diff(np.asarray(Gvy[0:length],dtype=float))
     
-    sum_distance = sum(distance)
+    sum_distance = float(np.sum(np.sqrt(dx*dx + dy*dy)))
     
     return sum_distance  
 
@@ -85,35 +211,22 @@ size_of_each: index of new trajectory in windowed files
 x0_list, y0_list: initial coordinates for each trajectory 
 window_size and stride: input window size and stride for training set
 file_idx: index of the file to be considered
+as_array: return NumPy arrays instead of lists
 
 outputs:
 Gvx, Gvy: x and y position (in m)
 
 '''
 def GT_pos_generator(GT_vel_x, GT_vel_y, size_of_each, 
-                   x0_list, y0_list, window_size, stride,file_idx):  
-    if (file_idx == 0):
-        x_vel_test_sel = GT_vel_x[0:size_of_each[0]]
-        y_vel_test_sel = GT_vel_y[0:size_of_each[0]]
-    elif (file_idx == 1):
-        x_vel_test_sel = GT_vel_x[np.sum(size_of_each[0]):np.sum(size_of_each[0:file_idx+1])]
-        y_vel_test_sel = GT_vel_y[np.sum(size_of_each[0]):np.sum(size_of_each[0:file_idx+1])]
-
-    else:
-        x_vel_test_sel = GT_vel_x[np.sum(size_of_each[0:file_idx]):np.sum(size_of_each[0:file_idx+1])]
-        y_vel_test_sel = GT_vel_y[np.sum(size_of_each[0:file_idx]):np.sum(size_of_each[0:file_idx+1])]
-
-    pointx = []
-    pointy = []
-    Lx =  x0_list[file_idx]
-    Ly = y0_list[file_idx]
-    for j in range(len(x_vel_test_sel)):
-        Lx = Lx + (x_vel_test_sel[j]/(((window_size-stride)/stride)))
-        Ly = Ly + (y_vel_test_sel[j]/(((window_size-stride)/stride)))    
-        pointx.append(Lx)
-        pointy.append(Ly)   
-    Gvx = pointx
-    Gvy = pointy
+                   x0_list, y0_list, window_size, stride,file_idx, as_array=False):  
+    start, stop = traj_bounds(size_of_each, file_idx)
+    x_vel_test_sel = GT_vel_x[start:stop]
+    y_vel_test_sel = GT_vel_y[start:stop]
+
+    Gvx, Gvy = integrate_velocities(x_vel_test_sel, y_vel_test_sel, [stop-start],
+                                    x0_list[file_idx:file_idx+1], y0_list[file_idx:file_idx+1], window_size, stride)
+    if not as_array:
+        Gvx, Gvy = Gvx.tolist(), Gvy.tolist()
     
     return Gvx, Gvy
 
@@ -129,6 +242,8 @@ window_size and stride: input window size and stride for training set
 file_idx: index of the file to be considered
 decimation factor: by what factor to downsample GPS compared to  IMU stride? (e.g. if stride is 20 for 100 Hz sampling rate and window size of 100, the network runs at 4 Hz. A decimation factor of 4 would equate to 1s GPS interval
 pos_noise_var, velocity_noise_var: GPS position and velocity noise variance, in m^2 and (m/s)^2
+rng: np.random.Generator used for the noise (global np.random if None)
+as_array: return NumPy arrays instead of lists (the positions are lists when there is no noise)
 
 outputs:
 Gvx, Gvy: x and y position (in m)
@@ -138,30 +253,16 @@ GPS_vel_x, GPS_vel_y: x and y velocities from GPS position (in m/s)
 
 def gen_GPS_values(GT_vel_x, GT_vel_y, size_of_each, 
                    x0_list, y0_list, window_size, stride,  file_idx,
-                  decimation_factor, pos_noise_var, velocity_noise_var):
+                  decimation_factor, pos_noise_var, velocity_noise_var, rng=None, as_array=False):
 
-    if (file_idx == 0):
-        x_vel_test_sel = GT_vel_x[0:size_of_each[0]]
-        y_vel_test_sel = GT_vel_y[0:size_of_each[0]]
-    elif (file_idx == 1):
-        x_vel_test_sel = GT_vel_x[np.sum(size_of_each[0]):np.sum(size_of_each[0:file_idx+1])]
-        y_vel_test_sel = GT_vel_y[np.sum(size_of_each[0]):np.sum(size_of_each[0:file_idx+1])]
+    start, stop = traj_bounds(size_of_each, file_idx)
+    x_vel_test_sel = GT_vel_x[start:stop]
+    y_vel_test_sel = GT_vel_y[start:stop]
 
-    else:
-        x_vel_test_sel = GT_vel_x[np.sum(size_of_each[0:file_idx]):np.sum(size_of_each[0:file_idx+1])]
-        y_vel_test_sel = GT_vel_y[np.sum(size_of_each[0:file_idx]):np.sum(size_of_each[0:file_idx+1])]
-
-    pointx = []
-    pointy = []
-    Lx =  x0_list[file_idx]
-    Ly = y0_list[file_idx]
-    for j in range(len(x_vel_test_sel)):
-        Lx = Lx + (x_vel_test_sel[j]/(((window_size-stride)/stride)))
-        Ly = Ly + (y_vel_test_sel[j]/(((window_size-stride)/stride)))    
-        pointx.append(Lx)
-        pointy.append(Ly)   
-    Gvx = pointx
-    Gvy = pointy
+    Gvx, Gvy = integrate_velocities(x_vel_test_sel, y_vel_test_sel, [stop-start],
+                                    x0_list[file_idx:file_idx+1], y0_list[file_idx:file_idx+1], window_size, stride)
+    if not as_array:
+        Gvx, Gvy = Gvx.tolist(), Gvy.tolist()
     GPS_vel_x = np.insert(np.ediff1d(Gvx),0,0.0)
     GPS_vel_y = np.insert(np.ediff1d(Gvy),0,0.0)
     if(decimation_factor!=0):
@@ -169,11 +270,13 @@ def gen_GPS_values(GT_vel_x, GT_vel_y, size_of_each,
         Gvy = Gvy[0::decimation_factor]
         GPS_vel_x = GPS_vel_x[0::decimation_factor]
         GPS_vel_y = GPS_vel_y[0::decimation_factor]        
+    if rng is None:
+        rng = np.random
     if(pos_noise_var != 0 and velocity_noise_var!=0):
-        Gvx = Gvx + np.random.normal(0,sqrt(pos_noise_var),len(Gvx))
-        Gvy = Gvy + np.random.normal(0,sqrt(pos_noise_var),len(Gvy))
-        GPS_vel_x = GPS_vel_x + np.random.normal(0,sqrt(velocity_noise_var),len(GPS_vel_x))
-        GPS_vel_y = GPS_vel_y + np.random.normal(0,sqrt(velocity_noise_var),len(GPS_vel_y))    
+        Gvx = Gvx + rng.normal(0,sqrt(pos_noise_var),len(Gvx))
+        Gvy = Gvy + rng.normal(0,sqrt(pos_noise_var),len(Gvy))
+        GPS_vel_x = GPS_vel_x + rng.normal(0,sqrt(velocity_noise_var),len(GPS_vel_x))
+        GPS_vel_y = GPS_vel_y + rng.normal(0,sqrt(velocity_noise_var),len(GPS_vel_y))    
     
     return Gvx, Gvy, GPS_vel_x, GPS_vel_y
 
@@ -188,6 +291,7 @@ x0_list, y0_list: initial coordinates for each trajectory
 window_size and stride: input window size and stride for training set
 decimation factor: by what factor to downsample GPS compared to  IMU stride? (e.g. if stride is 20 for 100 Hz sampling rate and window size of 100, the network runs at 4 Hz. A decimation factor of 4 would equate to 1s GPS interval
 pos_noise_var, velocity_noise_var: GPS position and velocity noise variance, in m^2 and (m/s)^2
+rng: np.random.Generator used for the noise (global np.random if None)
 
 outputs:
 Gvx_list, Gvy_list: x and y position (in m)
@@ -197,7 +301,7 @@ size_of_each_GPS_list: index of new trajectory in the output velocities and posi
 '''
 def gen_GPS_values_all_traj(GT_vel_x, GT_vel_y, size_of_each, 
                    x0_list, y0_list, window_size, stride,
-                  decimation_factor, pos_noise_var,velocity_noise_var):
+                  decimation_factor, pos_noise_var,velocity_noise_var, rng=None):
     Gvx_list = []
     Gvy_list = []
     Gvx_vel_list = []
@@ -206,7 +310,7 @@ def gen_GPS_values_all_traj(GT_vel_x, GT_vel_y, size_of_each,
     
     for i in range(len(size_of_each)):
         Gvx, Gvy, GPS_vel_x, GPS_vel_y = gen_GPS_values(GT_vel_x,GT_vel_y,
-                          size_of_each,x0_list,y0_list,window_size,stride,i,decimation_factor,pos_noise_var,velocity_noise_var)
+                          size_of_each,x0_list,y0_list,window_size,stride,i,decimation_factor,pos_noise_var,velocity_noise_var,rng)
         
         Gvx_list.append(Gvx)
         Gvy_list.append(Gvy)
@@ -216,6 +320,89 @@ def gen_GPS_values_all_traj(GT_vel_x, GT_vel_y, size_of_each,
     return Gvx_list, Gvy_list,Gvx_vel_list, Gvy_vel_list, size_of_each_GPS_list
 
 
+'''
+GPS values for specific file from real GPS (e.g. GPS_xy of import_agrobot_dataset_p2)
+
+inputs:
+GPS_xy: windowed cartesian position from GPS, n X window_size X 2 (relative to the first fix of each log)
+size_of_each: index of new trajectory in windowed files 
+x0_list, y0_list: initial coordinates for each trajectory (the first fix of each log is moved there)
+file_idx: index of the file to be considered
+decimation factor: by what factor to downsample GPS compared to  IMU stride?
+
+outputs:
+Gvx, Gvy: x and y position at the end of each window (in m)
+GPS_vel_x, GPS_vel_y: x and y velocities from GPS position (in m/s)
+
+'''
+def GPS_values_from_GPS_xy(GPS_xy, size_of_each, x0_list, y0_list, file_idx, decimation_factor):
+    start, stop = traj_bounds(size_of_each, file_idx)
+    Gvx = x0_list[file_idx] + GPS_xy[start:stop,-1,0]
+    Gvy = y0_list[file_idx] + GPS_xy[start:stop,-1,1]
+    GPS_vel_x = np.insert(np.ediff1d(Gvx),0,0.0)
+    GPS_vel_y = np.insert(np.ediff1d(Gvy),0,0.0)
+    if(decimation_factor!=0):
+        Gvx = Gvx[0::decimation_factor]
+        Gvy = Gvy[0::decimation_factor]
+        GPS_vel_x = GPS_vel_x[0::decimation_factor]
+        GPS_vel_y = GPS_vel_y[0::decimation_factor]
+    return Gvx, Gvy, GPS_vel_x, GPS_vel_y
+
+
+'''
+GNSS measurements for a whole split, generated once and cached
+
+Synthetic fixes are generated for all trajectories at once with their own np.random.Generator, and cached by
+(decimation_factor, pos_noise_var, velocity_noise_var, seed), so sweeps over trajectories or repeated runs
+reuse the same (reproducible) fixes. Real fixes (GPS_xy from import_agrobot_dataset_p2) are cached by decimation_factor.
+
+inputs:
+GT_vel_x, GT_vel_y: Ground truth velocity (in m/s)
+size_of_each: index of new trajectory in windowed files 
+x0_list, y0_list: initial coordinates for each trajectory 
+window_size and stride: input window size and stride for training set
+GPS_xy: windowed cartesian position from GPS (optional, dataset1 only)
+
+usage:
+gnss = GNSSProvider(GT_vel_x, GT_vel_y, size_of_each, x0_list, y0_list, window_size, stride)
+gps = gnss.synthetic(decimation_factor, pos_noise_var, velocity_noise_var, seed=0)
+Gvx, Gvy, GPS_vel_x, GPS_vel_y = gps[file_idx]
+neural_ekf_gnss_imu(..., my_model, gnss=gps)
+
+'''
+class GNSSProvider:
+    def __init__(self, GT_vel_x, GT_vel_y, size_of_each, x0_list, y0_list, window_size, stride, GPS_xy=None):
+        self.GT_vel_x = GT_vel_x
+        self.GT_vel_y = GT_vel_y
+        self.size_of_each = size_of_each
+        self.x0_list = x0_list
+        self.y0_list = y0_list
+        self.window_size = window_size
+        self.stride = stride
+        self.GPS_xy = GPS_xy
+        self.cache = {}
+
+    def synthetic(self, decimation_factor, pos_noise_var, velocity_noise_var, seed=0):
+        key = ('synthetic', decimation_factor, pos_noise_var, velocity_noise_var, seed)
+        if key not in self.cache:
+            rng = np.random.default_rng(seed)
+            self.cache[key] = [gen_GPS_values(self.GT_vel_x, self.GT_vel_y, self.size_of_each,
+                                              self.x0_list, self.y0_list, self.window_size, self.stride, i,
+                                              decimation_factor, pos_noise_var, velocity_noise_var, rng)
+                               for i in range(len(self.size_of_each))]
+        return self.cache[key]
+
+    def real(self, decimation_factor):
+        if self.GPS_xy is None:
+            raise ValueError('No GPS_xy was given, real GPS is only recorded in dataset1')
+        key = ('real', decimation_factor)
+        if key not in self.cache:
+            self.cache[key] = [GPS_values_from_GPS_xy(self.GPS_xy, self.size_of_each, self.x0_list, self.y0_list,
+                                                      i, decimation_factor)
+                               for i in range(len(self.size_of_each))]
+        return self.cache[key]
+
+
 '''
 generate trajectory from neural network predicted velocity for specific file
 
@@ -226,41 +413,66 @@ size_of_each: index of new trajectory in windowed files
 x0_list, y0_list: initial coordinates for each trajectory 
 window_size and stride: input window size and stride for training set
 file_idx: index of the file to be considered
-my_model: the neural network in keras, loaded using model.load(MODEL_NAME.h5)
+my_model: the neural network in keras, loaded using model.load(MODEL_NAME.h5), a numpy_tcn.StreamingTCN or a
+numpy_tcn.EnsembleTCN (position from the mean velocity of the ensemble)
+as_array: return NumPy arrays instead of lists
+return_spread: also return the standard deviation of the EnsembleTCN members for every window
 
 outputs:
 Pvx, Pvy: predicted x and y position (in m)
+Svx, Svy: ensemble standard deviation of the x and y velocity of every window (in m/s), only with return_spread
 
 '''
 
-def model_pos_generator(net_inp_mat, size_of_each, 
-                   x0_list, y0_list, window_size, stride,file_idx,my_model):
-    
-    if (file_idx == 0):
-        cur_inp = net_inp_mat[0:size_of_each[0],:,:]
-    elif (file_idx == 1):
-        cur_inp = net_inp_mat[np.sum(size_of_each[0]):np.sum(size_of_each[0:file_idx+1]),:,:]
+def model_pos_generator(net_inp_mat, size_of_each,
+                   x0_list, y0_list, window_size, stride,file_idx,my_model, as_array=False, return_spread=False):
 
+    start, stop = traj_bounds(size_of_each, file_idx)
+    cur_inp = net_inp_mat[start:stop,:,:]
+
+    if return_spread:
+        y_pred, y_std = my_model.predict_with_spread(cur_inp)
     else:
-        cur_inp = net_inp_mat[np.sum(size_of_each[0:file_idx]):np.sum(size_of_each[0:file_idx+1]),:,:]    
-    
-    y_pred = my_model.predict(cur_inp)
-    
-    pointx = []
-    pointy = []
-    Lx =  x0_list[file_idx]
-    Ly = y0_list[file_idx]
-    for j in range(len(cur_inp)):
-        Lx = Lx + (y_pred[0][j][0]/(((window_size-stride)/stride)))
-        Ly = Ly + (y_pred[1][j][0]/(((window_size-stride)/stride)))
-        pointx.append(Lx)
-        pointy.append(Ly)
-    Pvx = pointx
-    Pvy = pointy   
-    
+        y_pred = my_model.predict(cur_inp)
+
+    Pvx, Pvy = integrate_velocities(np.asarray(y_pred[0])[:,0], np.asarray(y_pred[1])[:,0], [stop-start],
+                                    x0_list[file_idx:file_idx+1], y0_list[file_idx:file_idx+1], window_size, stride)
+    if not as_array:
+        Pvx, Pvy = Pvx.tolist(), Pvy.tolist()
+    if return_spread:
+        Svx, Svy = y_std[0][:,0], y_std[1][:,0]
+        if not as_array:
+            Svx, Svy = Svx.tolist(), Svy.tolist()
+        return Pvx, Pvy, Svx, Svy
+
     return Pvx, Pvy
 
 
+'''
+predicted trajectories of all files of a split with one prediction of the whole net_inp_mat (see predict_split)
+
+inputs:
+net_inp_mat, size_of_each, x0_list, y0_list, window_size, stride, my_model: as model_pos_generator
+model_file, cache_dir, dataset_key, batch_size: prediction cache and batch size (see predict_split)
+as_array: return NumPy arrays instead of lists
+
+outputs:
+Pvx_list, Pvy_list: predicted x and y position (in m) of each trajectory
+
+'''
+
+def model_pos_generator_all(net_inp_mat, size_of_each, x0_list, y0_list, window_size, stride, my_model,
+                            model_file=None, cache_dir=None, dataset_key=None, batch_size=None, as_array=False):
+    y_pred = predict_split(net_inp_mat, my_model, model_file, cache_dir, dataset_key, batch_size)
+    Pvx, Pvy = integrate_velocities(y_pred[0][:,0], y_pred[1][:,0], size_of_each, x0_list, y0_list, window_size, stride)
+    Pvx_list = split_by_trajectory(Pvx, size_of_each)
+    Pvy_list = split_by_trajectory(Pvy, size_of_each)
+    if not as_array:
+        Pvx_list = [p.tolist() for p in Pvx_list]
+        Pvy_list = [p.tolist() for p in Pvy_list]
+    return Pvx_list, Pvy_list
+
+
 '''
 resample gps to match ground truth sampling rate, but with nearest interpolation
 